@@ -1,9 +1,32 @@
+from array import array
+import numpy as np
+
+from utils import open_formula, write_blocks
+
 class CNF:
 
-    def __init__(self):
-        self.clauses=[[1]]
+    def __init__(self,structural_hashing=False,polarity_aware=False,native_xor=False):
+        # clauses are stored one after another as 0 terminated literals,
+        # clause k starts at literals[offsets[k]]
+        self.literals=array('i')
+        self.offsets=array('q',[0])
+        self.comments=[]
         self.ind=[]
         self.var=1
+        # output literal of every gate built so far, keyed by gate type and inputs
+        self.gates={} if structural_hashing else None
+        self.stats={'gates_reused':0,'clauses_saved':0}
+        # with polarity_aware, the clauses of a gate are only added in the directions its output is
+        # used in (Plaisted-Greenbaum), required holds every literal used in a clause so far
+        self.gate_clauses={} if polarity_aware else None
+        self.required=set()
+        # with native_xor, XOR gates are kept as XOR constraints, written as CryptoMiniSat "x" lines
+        self.native_xor=native_xor
+        self.xor_clauses=[]
+        # True if the auxiliary variables are not fixed by the independent support, so solutions must
+        # be counted over it, see utils.counted_over_independent_support
+        self.projected=polarity_aware
+        self.store_clause([1])
 
 #basic functions
     def true(self):
@@ -16,84 +39,157 @@ class CNF:
         self.var+=1
         if(ind): self.ind.append(self.var)
         return self.var
+
+    def new_vars(self,count,ind=False):
+        # allocates count consecutive variables and returns the first one
+        first=self.var+1
+        self.var+=count
+        if(ind): self.ind.extend(range(first,self.var+1))
+        return first
     
+    def is_true(self,lit):
+        return lit==self.true()
+
+    def is_false(self,lit):
+        return lit==self.false()
+
+    def fold_AND(self,a,b):
+        # returns the literal a AND b is known to equal, None if a new gate is needed
+        if self.is_false(a) or self.is_false(b) or a==-b: return self.false()
+        if self.is_true(a) or a==b: return b
+        if self.is_true(b): return a
+        return None
+
+    def fold_XOR(self,a,b):
+        # returns the literal a XOR b is known to equal, None if a new gate is needed
+        if a==b: return self.false()
+        if a==-b: return self.true()
+        if self.is_false(a): return b
+        if self.is_true(a): return -b
+        if self.is_false(b): return a
+        if self.is_true(b): return -a
+        return None
+
+    def reuse_gate(self,key,num_gate_clauses,r=None):
+        # returns the output of an already built gate with the same key, None if there is none
+        if self.gates==None or key not in self.gates: return None
+        clauses_before=self.num_clauses()
+        if r==None: r=self.gates[key]
+        else: self.set_equal(r,self.gates[key])
+        self.stats['gates_reused']+=1
+        self.stats['clauses_saved']+=num_gate_clauses-(self.num_clauses()-clauses_before)
+        return r
+
     def AND(self,a,b,r=None):
+        folded=self.fold_AND(a,b)
+        if folded!=None:
+            if r==None: return folded
+            self.set_equal(r,folded)
+            return r
+        key=('AND',min(a,b),max(a,b))
+        reused=self.reuse_gate(key,3,r)
+        if reused!=None: return reused
         if (r==None): r=self.new_var()
-        self.clauses.append([r,-a,-b])
-        self.clauses.append([-r,a])
-        self.clauses.append([-r,b])
+        self.add_gate(r,[[r,-a,-b],[-r,a],[-r,b]])
+        if self.gates!=None: self.gates[key]=r
         return r
 
     def OR(self,a,b,r=None):
+        folded=self.fold_AND(-a,-b)
+        if folded!=None:
+            if r==None: return -folded
+            self.set_equal(r,-folded)
+            return r
+        # a OR b = -(-a AND -b), so OR gates are kept with the AND gates
+        key=('AND',min(-a,-b),max(-a,-b))
+        reused=self.reuse_gate(key,3,None if r==None else -r)
+        if reused!=None: return -reused
         if (r==None): r=self.new_var()
-        self.clauses.append([-r,a,b])
-        self.clauses.append([r,-a])
-        self.clauses.append([r,-b])
+        self.add_gate(r,[[-r,a,b],[r,-a],[r,-b]])
+        if self.gates!=None: self.gates[key]=-r
         return r
 
     def XOR(self,a,b,r=None):
+        folded=self.fold_XOR(a,b)
+        if folded!=None:
+            if r==None: return folded
+            self.set_equal(r,folded)
+            return r
+        # negating an input negates the output, so gates are keyed by positive inputs
+        sign=-1 if (a<0)!=(b<0) else 1
+        key=('XOR',min(abs(a),abs(b)),max(abs(a),abs(b)))
+        reused=self.reuse_gate(key,4,None if r==None else sign*r)
+        if reused!=None: return sign*reused
         if (r==None): r=self.new_var()
-        self.clauses.append([-r,a,b])
-        self.clauses.append([-r,-a,-b])
-        self.clauses.append([r,a,-b])
-        self.clauses.append([r,-a,b])
+        if self.native_xor: self.add_xor([-r,a,b])
+        else: self.add_gate(r,[[-r,a,b],[-r,-a,-b],[r,a,-b],[r,-a,b]])
+        if self.gates!=None: self.gates[key]=sign*r
         return r
     
     def only_one_in_all(self,literals):
-        self.clauses.append(literals)
+        self.add_clause(literals)
         for i in range(len(literals)):
             for j in range(i):
-                self.clauses.append([-literals[i],-literals[j]])
+                self.add_clause([-literals[i],-literals[j]])
 
     def set_true(self,lit):
-        self.clauses.append([lit])
+        if self.is_true(lit): return
+        self.add_clause([lit])
+
+    def set_equal(self,a,b):
+        if a==b: return
+        if abs(b)==1: a,b=b,a
+        if abs(a)==1:
+            self.set_true(b if self.is_true(a) else -b)
+        elif a==-b:
+            self.set_true(self.false())
+        else:
+            self.add_clause([-a,b])
+            self.add_clause([a,-b])
 
 #calculations
-    def half_adder(self,a,b,result,carry):
-        self.XOR(a,b,result)
-        self.AND(a,b,carry)
+    def half_adder(self,a,b,result=None,carry=None):
+        result=self.XOR(a,b,result)
+        carry=self.AND(a,b,carry)
+        return result,carry
     
-    def full_adder(self,a,b,c,result,carry):
-        r1=self.new_var()
-        c1=self.new_var()
-        self.half_adder(a,b,r1,c1)
-        c2=self.new_var()
-        self.half_adder(r1,c,result,c2)
-        self.OR(c1,c2,carry)
+    def full_adder(self,a,b,c,result=None,carry=None):
+        r1,c1=self.half_adder(a,b)
+        result,c2=self.half_adder(r1,c,result)
+        carry=self.OR(c1,c2,carry)
+        return result,carry
     
     def add(self,a,b,r=None):
         #clauses.append(["c","add"])
         Len=len(a)
         if r==None:
-            r=[ self.new_var() for i in range(Len)]
-        c = [self.new_var() for i in range(Len)]
+            r=[None]*Len
+        c=[None]*Len
         for i in range(Len):
             if i==0 :
-                self.half_adder(a[i],b[i],r[i],c[i])
+                r[i],c[i]=self.half_adder(a[i],b[i],r[i])
             else:
-                self.full_adder(a[i],b[i],c[i-1],r[i],c[i])
-        self.clauses.append([-c[-1]])
+                r[i],c[i]=self.full_adder(a[i],b[i],c[i-1],r[i])
+        self.set_true(-c[-1])
         #clauses.append(["c","end_add"])
         return r
     
     def leq(self,a,b,opt=0):#~a+b+1
         Len=len(a)
         comp_a=[-l for l in a]
-        r= [ self.new_var() for i in range(Len)]
-        c =[ self.new_var() for i in range(Len)]
+        c=[None]*Len
         for i in range(Len):
             if i==0 :
-                self.full_adder(comp_a[i],b[i],1,r[i],c[i])
+                _,c[i]=self.full_adder(comp_a[i],b[i],self.true())
             else:
-                self.full_adder(comp_a[i],b[i],c[i-1],r[i],c[i])
-        if(opt==0):self.clauses.append([c[-1]])
+                _,c[i]=self.full_adder(comp_a[i],b[i],c[i-1])
+        if(opt==0):self.set_true(c[-1])
         return c[-1]
     
     def eq(self,a,b):
         Len=len(a)
         for i in range(Len):
-            self.clauses.append([-a[i],b[i]])
-            self.clauses.append([a[i],-b[i]])
+            self.set_equal(a[i],b[i])
         return
     
     def max_(self,a,b,r=None):
@@ -108,45 +204,174 @@ class CNF:
     def increment(self,a,b=1,r=None):
         Len=len(a)
         if r==None:
-            r=[ self.new_var() for i in range(Len)]
-        c = [self.new_var() for i in range(Len)]
+            r=[None]*Len
+        c=[None]*Len
         for i in range(Len):
             if i==0 :
-                self.half_adder(a[i],b,r[i],c[i])
+                r[i],c[i]=self.half_adder(a[i],b,r[i])
             else:
-                self.half_adder(a[i],c[i-1],r[i],c[i])
+                r[i],c[i]=self.half_adder(a[i],c[i-1],r[i])
         #clauses.append([-c[-1]])
         return r
     
-    def add_clause(self,lits):
-        self.clauses.append(lits)
-        
+
     def ORList(self,lits,r=None):
         if r==None:
             r=self.new_var()
-        self.clauses.append([-r]+lits)
-        for lit in lits:
-            self.clauses.append([r, -lit])
+        self.add_gate(r,[[-r]+lits]+[[r, -lit] for lit in lits])
         return r
 
+#clause store
+    def add_gate(self,r,clauses):
+        # adds the clauses defining the gate output r, constant inputs are simplified away
+        clauses=[[l for l in clause if not self.is_false(l)] for clause in clauses if self.true() not in clause]
+        if self.gate_clauses==None:
+            self.add_clauses(clauses)
+            return
+        self.gate_clauses[r]=clauses
+        used=[lit for lit in (r,-r) if lit in self.required]
+        self.required.difference_update(used)
+        self.require(used)
+
+    def require(self,lits):
+        # a gate output used positively in a clause needs the clauses where it implies its inputs,
+        # used negatively the clauses where its inputs imply it, which in turn use the inputs
+        stack=list(lits)
+        while stack:
+            lit=stack.pop()
+            if lit in self.required: continue
+            self.required.add(lit)
+            for clause in self.gate_clauses.get(abs(lit),()):
+                if -lit in clause:
+                    self.store_clause(clause)
+                    stack.extend(l for l in clause if l!=-lit)
+
+    def add_clause(self,lits):
+        # a clause with the constant true literal is dropped, constant false literals are removed
+        if self.true() in lits: return
+        if self.false() in lits: lits=[l for l in lits if not self.is_false(l)] or [self.false()]
+        if self.gate_clauses!=None: self.require(lits)
+        self.store_clause(lits)
+
+    def add_xor(self,lits):
+        # the literals must XOR to true
+        if self.gate_clauses!=None: self.require([l for lit in lits for l in (lit,-lit)])
+        self.xor_clauses.append(lits)
+
+    def store_clause(self,lits):
+        self.literals.extend(lits)
+        self.literals.append(0)
+        self.offsets.append(len(self.literals))
+
+    def add_clauses(self,clauses):
+        for lits in clauses:
+            self.add_clause(lits)
+
+    def add_clause_block(self,block):
+        # adds one clause per row of a 2D integer array, 0 entries are skipped, constant
+        # literals are simplified like in add_clause
+        block=np.asarray(block,dtype=np.int32)
+        if block.size==0: return
+        if np.any(np.abs(block)==1):
+            block=block[~np.any(block==self.true(),axis=1)]
+            if block.size==0: return
+            block=np.where(block==self.false(),0,block)
+            block[~block.any(axis=1),0]=self.false()
+        if self.gate_clauses!=None: self.require(np.unique(block[block!=0]).tolist())
+        terminated=np.zeros((block.shape[0],block.shape[1]+1),dtype=np.int32)
+        terminated[:,:-1]=block
+        lengths=np.count_nonzero(block,axis=1)+1
+        literals=terminated.ravel()
+        if np.any(lengths<=block.shape[1]):
+            keep=literals!=0
+            keep[block.shape[1]::block.shape[1]+1]=True
+            literals=literals[keep]
+        offsets=len(self.literals)+np.cumsum(lengths,dtype=np.int64)
+        self.literals.frombytes(literals.tobytes())
+        self.offsets.frombytes(offsets.tobytes())
+
+    def add_comment(self,comment):
+        self.comments.append((self.num_clauses(),comment))
+
+    def num_clauses(self):
+        return len(self.offsets)-1
+
+    def clause(self,k):
+        return self.literals[self.offsets[k]:self.offsets[k+1]-1].tolist()
+
+    def iter_clauses(self):
+        for k in range(self.num_clauses()):
+            yield self.clause(k)
+
 #save_file
+    def ind_text(self):
+        # the independent support as "c ind" lines of at most 10 variables
+        lines=[]
+        for start in range(0,len(self.ind),10):
+            chunk=self.ind[start:start+10]
+            lines.append("c ind "+"%d "*len(chunk)%tuple(chunk)+"0\n")
+        return "".join(lines)
+
+    def write_ind(self,fcnf):
+        fcnf.write(self.ind_text())
+
+    def clause_blocks(self,first=0,last=None,chunk_size=1<<16):
+        # yields the text of clauses first,...,last-1 as bytes, a chunk of clauses at a time
+        if last==None: last=self.num_clauses()
+        for start in range(first,last,chunk_size):
+            end=min(start+chunk_size,last)
+            yield encode_literals(self.literals[self.offsets[start]:self.offsets[end]])
+
+    def write_clauses(self,fcnf,first=0,last=None):
+        write_blocks(fcnf,self.clause_blocks(first,last))
+
+    def xor_text(self):
+        return "".join("x"+"%d "*len(lits)%tuple(lits)+"0\n" for lits in self.xor_clauses)
+
+    def write_xors(self,fcnf):
+        fcnf.write(self.xor_text())
+
+    def cnf_blocks(self,show_additional_comments=False):
+        # yields the text of the formula as bytes
+        yield ("p cnf %d %d\n"%(self.var,self.num_clauses()+len(self.xor_clauses))).encode()
+        yield self.ind_text().encode()
+
+        first=0
+        if show_additional_comments:
+            for position,comment in self.comments:
+                yield from self.clause_blocks(first,position)
+                yield ("c %s\n"%comment).encode()
+                first=position
+        yield from self.clause_blocks(first)
+        yield self.xor_text().encode()
+
+    def write_cnf(self,fcnf,show_additional_comments=False):
+        # writes the formula to any text stream, e.g. a file or the standard input of a solver,
+        # formatting the next clauses while a separate thread writes the previous ones
+        write_blocks(fcnf,self.cnf_blocks(show_additional_comments))
+
     def to_cnf_file(self,filename,show_additional_comments=False):
-        fcnf=open(filename,"w")
-        
-        fcnf.write("p cnf %d %d\n"%(self.var,len(self.clauses)))
-
-        for i,ind_var in enumerate(self.ind):
-            if i%10 == 0: fcnf.write("c ind ")
-            fcnf.write ("%d "%ind_var)
-            if i%10 == 9 or i==len(self.ind)-1: fcnf.write("0\n")
-        
-        for cl in self.clauses:
-            if cl[0]=="c":
-                if show_additional_comments:
-                    fcnf.write("c %s\n"%cl[1])
-                continue
-            for lit in cl:
-                fcnf.write("%d "%lit)
-            fcnf.write("0\n")
-        
-        return fcnf
\ No newline at end of file
+        # compressed if filename ends in .gz, .xz or .zst
+        with open_formula(filename,"w") as fcnf:
+            self.write_cnf(fcnf,show_additional_comments)
+
+def encode_literals(literals):
+    # returns the DIMACS text of 0 terminated clauses as bytes, "%d " for every literal and "0\n"
+    # for every 0, computing the digits of all literals at once instead of formatting each
+    literals=np.frombuffer(literals,dtype=np.int32) if isinstance(literals,array) else np.asarray(literals,dtype=np.int32)
+    if len(literals)==0: return b""
+    negative=literals<0
+    values=np.abs(literals)
+    max_digits=len(str(int(values.max())))
+    # every literal right aligned in a row of max_digits+2 characters: sign, digits, separator
+    width=max_digits+2
+    grid=np.empty((len(literals),width),dtype=np.uint8)
+    grid[:,-1]=np.where(literals==0,ord("\n"),ord(" "))
+    num_digits=np.ones(len(literals),dtype=np.int32)
+    for d in range(max_digits):
+        grid[:,-2-d]=ord("0")+values%10
+        values//=10
+        num_digits+=values>0
+    grid[np.nonzero(negative)[0],(width-2-num_digits)[negative]]=ord("-")
+    keep=np.arange(width)>=(width-1-num_digits-negative)[:,None]
+    return grid[keep].tobytes()
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from functools import lru_cache
+
+from utils import open_formula
+from get_vars import VariableLayout
+
+# files whose contents decide the formula written for a given matrix and parameters
+source_files = ['CNF.py', 'get_clauses.py', 'get_vars.py', 'generate_formula.py', 'forbidden_clauses.txt']
+
+@lru_cache(maxsize=None)
+def code_version():
+    """
+    Returns a hash of the code that generates formulas, so cached formulas are not reused
+    once it changes.
+    """
+    code_hash = hashlib.sha256()
+    for filename in source_files:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), 'rb') as f:
+            code_hash.update(f.read())
+
+    return code_hash.hexdigest()
+
+def formula_cache_key(matrix, s, t, allowed_losses, fn, fp, options):
+    """
+    Returns the key of the formula for the given matrix and parameters in the cache.
+
+    options - dictionary of the encoding options passed to get_cnf
+    """
+    parameters = {'matrix': matrix,
+                'clusters': [s, t],
+                'allowed_losses': None if allowed_losses == None else sorted(allowed_losses),
+                'errors': [fn, fp],
+                'options': options,
+                'code_version': code_version()}
+
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
+
+def load_cached_formula(cache_dir, key, write_filename, forced_clauses=None):
+    """
+    Writes the cached formula for key to write_filename, followed by forced_clauses, and returns
+    its number of variables, number of clauses and VariableLayout, or None if it is not cached.
+    """
+    forced_clauses = forced_clauses or []
+
+    try:
+        with open(os.path.join(cache_dir, f'{key}.json'), 'r') as f:
+            entry = json.load(f)
+
+        with open(os.path.join(cache_dir, f'{key}.cnf'), 'r') as from_file:
+            with open_formula(write_filename, 'w') as to_file:
+                from_file.readline()
+                to_file.write(f'p cnf {entry["num_vars"]} {entry["num_clauses"] + len(forced_clauses)}\n')
+                shutil.copyfileobj(from_file, to_file)
+                for clause in forced_clauses:
+                    to_file.write(' '.join(clause.split()[:-1]) + ' 0\n')
+
+        # the most recently used formulas are evicted last
+        os.utime(os.path.join(cache_dir, f'{key}.json'))
+    except FileNotFoundError:
+        return None
+
+    return entry['num_vars'], entry['num_clauses'] + len(forced_clauses), VariableLayout.from_dict(entry['variables'])
+
+def atomic_write(filename, write):
+    """
+    Calls write on a temporary file next to filename, then renames it to filename, so other
+    processes never see a partially written file. Returns what write returns.
+    """
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    os.close(fd)
+    try:
+        result = write(tmp_filename)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+    return result
+
+def store_cached_formula(cache_dir, key, write_formula, max_cache_bytes):
+    """
+    Adds a formula to the cache under key, then evicts the least recently used formulas until the
+    cache holds at most max_cache_bytes.
+
+    write_formula - function that writes the formula to the given filename and returns its number
+    of variables, number of clauses and VariableLayout
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # the entry is only read once its .json file exists, so it is written last
+    num_vars, num_clauses, variables = atomic_write(os.path.join(cache_dir, f'{key}.cnf'), write_formula)
+
+    def write_entry(filename):
+        with open(filename, 'w') as f:
+            json.dump({'num_vars': num_vars, 'num_clauses': num_clauses, 'variables': variables.to_dict()}, f)
+
+    atomic_write(os.path.join(cache_dir, f'{key}.json'), write_entry)
+
+    evict_cached_formulas(cache_dir, max_cache_bytes)
+
+def evict_cached_formulas(cache_dir, max_cache_bytes):
+    """
+    Removes the least recently used formulas from the cache until it holds at most max_cache_bytes.
+    """
+    # key -> [last use, size in bytes]
+    entries = {}
+    for filename in os.listdir(cache_dir):
+        key, extension = os.path.splitext(filename)
+        if extension not in ('.cnf', '.json'):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, filename))
+        except FileNotFoundError:
+            continue
+        entry = entries.setdefault(key, [0, 0])
+        if extension == '.json' or entry[0] == 0:
+            entry[0] = stat.st_mtime
+        entry[1] += stat.st_size
+
+    total_bytes = sum(size for last_use, size in entries.values())
+
+    for key, (last_use, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+        if total_bytes <= max_cache_bytes:
+            break
+        for extension in ('.json', '.cnf'):
+            try:
+                os.remove(os.path.join(cache_dir, f'{key}{extension}'))
+            except FileNotFoundError:
+                pass
+        total_bytes -= size
@@ -1,13 +1,21 @@
 from get_clauses import *
-from get_vars import create_variable_matrices, write_vars
+from get_vars import (create_variable_matrices, create_pattern_witness_variables, create_nonzero_variables, create_ancestry_variables,
+                    create_cluster_assignment_variables, get_possible_values, independent_support_labels,
+                    variable_map_filename, write_variable_map)
 from CNF import CNF
-from utils import parse_allowed_losses_file, read_matrix
+from utils import parse_allowed_losses_file, read_matrix, open_formula, is_compressed, append_file
+from formula_cache import formula_cache_key, load_cached_formula, store_cached_formula
 
 import sys
 import os
 import time
+import math
 import argparse
+import multiprocessing
 import shutil
+import tempfile
+import numpy as np
+from functools import lru_cache, partial
 
 """
 USAGE
@@ -23,19 +31,56 @@ specified in LOSSES_FILENAME are allowed. The formula is in the format required
 written to FORMULA_FILENAME.
 """
 
-def get_cnf(read_filename, write_filename, s, t, allowed_losses=None, fn=1, fp=1, return_num_vars_clauses=False, forced_clauses=None):
+def create_formula_variables(matrix, s, t, forbidden_encoding, engine, clustering, F, possible=None):
     """
-    Writes a cnf formula for matrix specified in read_filename to write_filename using s
-    rows and t columns for clustered matrix.
+    Returns the VariableLayout of the variable matrices of the formula for matrix, allocated in F,
+    and sets the independent support of F.
+
+    possible - possible values of the entries returned by get_possible_values, to replace the
+    variables they fix by constants
     """
-    matrix = read_matrix(read_filename)
+    variables = create_variable_matrices(matrix, s, t, F, clustering, possible)
+
+    if clustering == 'assignment':
+        if engine != 'forbidden' or forbidden_encoding not in ('permutations', 'combinations', 'nonzero'):
+            raise ValueError('The cluster assignment encoding forbids submatrices of the clustered matrix with the '
+                            'permutations, combinations or nonzero encodings')
+        variables.update(create_cluster_assignment_variables(matrix, s, t, forbidden_encoding, F))
+    elif engine == 'ancestry':
+        variables.update(create_ancestry_variables(matrix, len(get_forbidden_tables()['ancestry_relations']), F))
+    elif engine != 'forbidden':
+        raise ValueError(f'Unknown formula engine: {engine}')
+    elif forbidden_encoding == 'witness':
+        variables.update(create_pattern_witness_variables(matrix, len(get_forbidden_tables()['forbidden_row_patterns']), F))
+    elif forbidden_encoding == 'nonzero':
+        variables.update(create_nonzero_variables(matrix, F))
+
+    F.ind = independent_support(matrix, variables)
+
+    return variables
+
+def independent_support(matrix, variables):
+    """
+    Returns the independent support of the formula for matrix: the false negative or false positive
+    variable of every entry, then is_two of every entry, in the order reconstruct_solutions expects
+    sampled values in. Entries fixed to a constant have no variable and are left out.
+    """
+    labels = independent_support_labels(matrix, variables)
 
-    num_rows = len(matrix)
-    num_cols = len(matrix[0])
+    return labels[labels > 1].tolist()
 
-    F = CNF()
+def get_clause_families(matrix, variables, allowed_losses, forbidden_encoding, engine, clustering, num_shards=1,
+                        conflicts=None):
+    """
+    Returns the families of clauses of the formula for matrix other than the cardinality
+    constraints, in the order they are added, as functions that add them to a CNF object.
+    No family allocates variables, so the families can be added to separate CNF objects.
 
-    variables = create_variable_matrices(matrix, s, t, F)
+    num_shards - number of families the clauses forbidding submatrices are split into
+    conflicts - matrix returned by get_column_conflicts, only the pairs of columns where it is True
+    get clauses forbidding submatrices of B
+    """
+    num_cols = len(matrix[0])
 
     if allowed_losses == None:
         allowed_losses = set([i for i in range(num_cols)])
@@ -45,105 +90,483 @@ def get_cnf(read_filename, write_filename, s, t, allowed_losses=None, fn=1, fp=1
     for i in range(num_cols):
         if i not in allowed_losses:
             unsupported_losses.append(i)
-    
-    false_positives = variables['false_positives']
-    false_negatives = variables['false_negatives']
 
-    pair_in_row_equal = variables['pair_in_row_equal']
-    pair_in_col_equal = variables['pair_in_col_equal']
+    is_two = variables['is_two']
+    is_one = generate_is_one(matrix, variables['false_positives'], variables['false_negatives'], is_two)
+
+    if clustering == 'assignment':
+        # submatrices are forbidden in the clustered matrix, whose rows and columns are all distinct,
+        # so no duplicate literal (0 is skipped) is added to its clauses
+        forbidden_one = variables['cluster_is_one']
+        forbidden_two = variables['cluster_is_two']
+        row_is_duplicate = np.zeros(len(forbidden_one), dtype=np.int32)
+        col_is_duplicate = np.zeros(len(forbidden_one[0]), dtype=np.int32)
+        nonzero = variables['cluster_nonzero'] if 'cluster_nonzero' in variables else None
+        # the columns of the clustered matrix are not columns of the input
+        conflicts = None
+    else:
+        forbidden_one = is_one
+        forbidden_two = is_two
+        row_is_duplicate = variables['row_is_duplicate']
+        col_is_duplicate = variables['col_is_duplicate']
+        nonzero = variables['nonzero'] if 'nonzero' in variables else None
+
+    if engine == 'ancestry':
+        families = [partial(get_ancestry_clauses, is_one, is_two, variables['relation'], col_is_duplicate)]
+    elif forbidden_encoding == 'combinations':
+        families = [partial(get_clauses_no_forbidden_combinations, forbidden_one, forbidden_two, row_is_duplicate,
+                            col_is_duplicate, shard=(k, num_shards), conflicts=conflicts) for k in range(num_shards)]
+    elif forbidden_encoding == 'witness':
+        families = [partial(get_pattern_witness_clauses, is_one, is_two, variables['pattern_in_row'],
+                            variables['exists_pattern'], col_is_duplicate)]
+    elif forbidden_encoding == 'nonzero':
+        families = [partial(get_nonzero_clauses, forbidden_one, forbidden_two, nonzero)]
+        families += [partial(get_clauses_no_forbidden_nonzero, forbidden_one, forbidden_two, nonzero, row_is_duplicate,
+                            col_is_duplicate, shard=(k, num_shards), conflicts=conflicts) for k in range(num_shards)]
+    elif forbidden_encoding == 'permutations':
+        families = [partial(get_clauses_no_forbidden, forbidden_one, forbidden_two, row_is_duplicate, col_is_duplicate,
+                            shard=(k, num_shards), conflicts=conflicts) for k in range(num_shards)]
+    else:
+        raise ValueError(f'Unknown forbidden submatrix encoding: {forbidden_encoding}')
+
+    families += [partial(get_clauses_not_one_and_two, is_one, is_two)]
+
+    if clustering == 'assignment':
+        row_cluster_is_one = variables['row_cluster_is_one']
+        row_cluster_is_two = variables['row_cluster_is_two']
+
+        families += [partial(get_cluster_assignment_clauses, variables['row_cluster']),
+                    partial(get_cluster_assignment_clauses, variables['col_cluster']),
+                    # C[row cluster of i][b] is C[a][b] for every row i in row cluster a
+                    partial(get_cluster_link_clauses, variables['row_cluster'], forbidden_one, forbidden_two,
+                            row_cluster_is_one, row_cluster_is_two),
+                    # B[i][j] is C[row cluster of i][b] for every column j in column cluster b
+                    partial(get_cluster_link_clauses, variables['col_cluster'], row_cluster_is_one.T, row_cluster_is_two.T,
+                            is_one.T, is_two.T),
+                    partial(get_distinct_clusters_clauses, forbidden_one, forbidden_two, variables['rows_differ']),
+                    partial(get_distinct_clusters_clauses, forbidden_one.T, forbidden_two.T, variables['cols_differ']),
+                    partial(clause_last_row_no_two_before_unsupported_losses, unsupported_losses, is_two)]
+    else:
+        pair_in_row_equal = variables['pair_in_row_equal']
+        pair_in_col_equal = variables['pair_in_col_equal']
 
-    row_is_duplicate = variables['row_is_duplicate']
-    col_is_duplicate = variables['col_is_duplicate']
+        families += [partial(get_row_duplicate_clauses, pair_in_col_equal, row_is_duplicate, variables['row_is_duplicate_of']),
+                    partial(get_col_duplicate_clauses, pair_in_row_equal, col_is_duplicate, unsupported_losses, is_two,
+                            variables['col_is_duplicate_of']),
+                    partial(get_col_pairs_equal_clauses, is_one, is_two, pair_in_col_equal),
+                    partial(get_row_pairs_equal_clauses, is_one, is_two, pair_in_row_equal)]
 
-    row_is_duplicate_of = variables['row_is_duplicate_of']
-    col_is_duplicate_of = variables['col_is_duplicate_of']
+    families += [partial(clause_forbid_unsupported_losses, unsupported_losses, is_two)]
 
-    is_two = variables['is_two']
-    is_one = generate_is_one(matrix, false_positives, false_negatives, is_two)
+    return families
 
-    num_row_duplicates = len(row_is_duplicate) - s
-    num_col_duplicates = len(col_is_duplicate) - t
+def add_cardinality_constraints(matrix, variables, s, t, fn, fp, cardinality_encoding, F):
+    """
+    Adds the constraints on the numbers of false positives, false negatives and duplicates to F.
+    The cluster assignment encoding has no duplicate variables, it fixes the number of clusters.
+    """
+    if 'row_is_duplicate' in variables:
+        row_is_duplicate, col_is_duplicate = variables['row_is_duplicate'].tolist(), variables['col_is_duplicate'].tolist()
+    else:
+        row_is_duplicate, col_is_duplicate = None, None
 
-    independent_lines = []
+    encode_constraints(variables['false_positives'].tolist(), variables['false_negatives'].tolist(),
+                        row_is_duplicate, col_is_duplicate,
+                        fp, fn, len(matrix) - s, len(matrix[0]) - t, F, cardinality_encoding)
 
-    c_ind = 'c ind '
-    num_ind = 0
+def build_cnf(matrix, s, t, allowed_losses, fn, fp, forbidden_encoding, engine, structural_hashing, polarity_aware,
+                cardinality_encoding, native_xor, clustering='pairs', prune=False, skip_conflict_free_pairs=False):
+    """
+    Returns the CNF formula for matrix and its variable matrices, see get_cnf for the parameters.
+    F.stats counts the gates reused by structural hashing and the clauses this saved.
+    """
+    F = CNF(structural_hashing, polarity_aware, native_xor)
+    # the relations of the ancestry engine are not fixed when several agree with the entries
+    F.projected = F.projected or engine == 'ancestry'
 
-    for i in range(len(matrix)):
-        for j in range(len(matrix[0])):
-            if matrix[i][j] == 0:
-                elem = false_negatives[i][j]
-            else:
-                elem = false_positives[i][j]
-            c_ind += f'{elem} '
-            num_ind += 1
-            if num_ind == 10:
-                c_ind += '0\n'
-                independent_lines.append(c_ind)
-                c_ind = 'c ind '
-                num_ind = 0
+    possible = get_possible_values(matrix, fn, fp, allowed_losses) if prune else None
+    conflicts = get_column_conflicts(matrix, fn, fp, allowed_losses) if skip_conflict_free_pairs else None
+    variables = create_formula_variables(matrix, s, t, forbidden_encoding, engine, clustering, F, possible)
+
+    for add_family in get_clause_families(matrix, variables, allowed_losses, forbidden_encoding, engine, clustering,
+                                            conflicts=conflicts):
+        add_family(F)
+
+    add_cardinality_constraints(matrix, variables, s, t, fn, fp, cardinality_encoding, F)
+
+    return F, variables
+
+def write_clause_family(add_family, chunk_filename):
+    """
+    Writes the clauses of a family returned by get_clause_families to chunk_filename, and returns
+    their number.
+    """
+    F = CNF()
+    add_family(F)
 
-    for row in is_two:
-        for elem in row:
-            c_ind += f'{elem} '
-            num_ind += 1
-            if num_ind == 10:
-                c_ind += '0\n'
-                independent_lines.append(c_ind)
-                c_ind = 'c ind '
-                num_ind = 0
-    if num_ind != 0:
-        c_ind += '0\n'
-        independent_lines.append(c_ind)
+    # clause 0 of every CNF object is the unit clause of the constant true variable
+    with open(chunk_filename, 'w') as fcnf:
+        F.write_clauses(fcnf, 1)
 
-    write_file = open(write_filename + '.tmp', 'w')
-    write_file.writelines(independent_lines)
+    return F.num_clauses() - 1
 
-    clause_count = 0
+def write_cnf_parallel(matrix, write_filename, s, t, allowed_losses, fn, fp, forbidden_encoding, engine,
+                        cardinality_encoding, native_xor, processes, forced_clauses=None, clustering='pairs', prune=False,
+                        skip_conflict_free_pairs=False):
+    """
+    Writes the same formula as build_cnf without structural hashing or polarity awareness, with
+    forced_clauses, to write_filename, generating the families of clauses in processes worker
+    processes. Returns its number of variables, number of clauses and variable matrices.
+    """
+    F = CNF(native_xor=native_xor)
+
+    possible = get_possible_values(matrix, fn, fp, allowed_losses) if prune else None
+    conflicts = get_column_conflicts(matrix, fn, fp, allowed_losses) if skip_conflict_free_pairs else None
+    variables = create_formula_variables(matrix, s, t, forbidden_encoding, engine, clustering, F, possible)
+
+    # a few shards per process, so processes that finish early take over the remaining ones
+    families = get_clause_families(matrix, variables, allowed_losses, forbidden_encoding, engine, clustering, 4 * processes,
+                                    conflicts)
 
-    clause_count += get_clauses_no_forbidden(is_one, is_two, row_is_duplicate, col_is_duplicate, write_file)
+    chunk_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(write_filename)), suffix='.chunks')
+    try:
+        chunk_filenames = [os.path.join(chunk_dir, f'{k}.cnf') for k in range(len(families))]
 
-    clause_count += get_clauses_not_one_and_two(is_one, is_two, write_file)
+        with multiprocessing.Pool(processes) as pool:
+            result = pool.starmap_async(write_clause_family, zip(families, chunk_filenames))
 
-    clause_count += get_row_duplicate_clauses(pair_in_col_equal, row_is_duplicate, row_is_duplicate_of, write_file)
-    
-    clause_count += get_col_duplicate_clauses(pair_in_row_equal, col_is_duplicate, unsupported_losses, is_two, col_is_duplicate_of, write_file)
+            # the cardinality constraints allocate variables, so they are added to F meanwhile
+            add_cardinality_constraints(matrix, variables, s, t, fn, fp, cardinality_encoding, F)
+            add_forced_clauses(F, forced_clauses)
 
-    clause_count += get_col_pairs_equal_clauses(is_one, is_two, pair_in_col_equal, write_file)
+            num_chunk_clauses = sum(result.get())
 
-    clause_count += get_row_pairs_equal_clauses(is_one, is_two, pair_in_row_equal, write_file)
+        num_clauses = F.num_clauses() + num_chunk_clauses + len(F.xor_clauses)
 
-    clause_count += clause_forbid_unsupported_losses(unsupported_losses, is_two, write_file)
+        # clauses in the same order as build_cnf: the unit clause of F, the families, the rest of F
+        with open_formula(write_filename, 'w') as fcnf:
+            fcnf.write(f'p cnf {F.var} {num_clauses}\n')
+            F.write_ind(fcnf)
+            F.write_clauses(fcnf, 0, 1)
 
-    num_constraints_clauses = encode_constraints(false_positives, false_negatives,
-                                                row_is_duplicate, col_is_duplicate,
-                                                fp, fn, num_row_duplicates, num_col_duplicates, write_file, F)
-    clause_count += num_constraints_clauses + 1
+            if is_compressed(write_filename):
+                for chunk_filename in chunk_filenames:
+                    with open(chunk_filename, 'r') as chunk:
+                        shutil.copyfileobj(chunk, fcnf)
+            else:
+                fcnf.flush()
+                for chunk_filename in chunk_filenames:
+                    append_file(chunk_filename, fcnf.fileno())
+
+            F.write_clauses(fcnf, 1)
+            F.write_xors(fcnf)
+    finally:
+        shutil.rmtree(chunk_dir)
 
+    return F.var, num_clauses, variables
+
+def add_forced_clauses(F, forced_clauses):
+    """
+    Adds forced_clauses, given as lines of a cnf file, to F.
+    """
     if forced_clauses:
-        write_file.writelines(forced_clauses)
-        clause_count += len(forced_clauses)
+        for clause in forced_clauses:
+            F.add_clause([int(lit) for lit in clause.split()[:-1]])
+
+def get_formula(read_filename, s, t, allowed_losses=None, fn=1, fp=1, forced_clauses=None,
+                forbidden_encoding='permutations', engine='forbidden', structural_hashing=False,
+                polarity_aware=False, cardinality_encoding='adder', native_xor=False, clustering='pairs', prune=False,
+                skip_conflict_free_pairs=False):
+    """
+    Returns the CNF formula for the matrix specified in read_filename and its variable matrices
+    without writing anything to disk, see get_cnf for the parameters. The formula can be passed
+    to the counters in utils, which write it to the standard input of the solver.
+    """
+    F, variables = build_cnf(read_matrix(read_filename), s, t, allowed_losses, fn, fp, forbidden_encoding, engine,
+                                structural_hashing, polarity_aware, cardinality_encoding, native_xor, clustering, prune,
+                                skip_conflict_free_pairs)
+
+    add_forced_clauses(F, forced_clauses)
+
+    return F, variables
+
+def get_cnf(read_filename, write_filename, s, t, allowed_losses=None, fn=1, fp=1, return_num_vars_clauses=False, forced_clauses=None,
+            forbidden_encoding='permutations', engine='forbidden', structural_hashing=False, polarity_aware=False,
+            cardinality_encoding='adder', native_xor=False, cache_dir=None, max_cache_bytes=10 * 2**30, processes=1,
+            variable_map=False, clustering='pairs', prune=False, skip_conflict_free_pairs=False, stats=None):
+    """
+    Writes a cnf formula for matrix specified in read_filename to write_filename using s
+    rows and t columns for clustered matrix.
+
+    write_filename - compressed with gzip, xz or zstd if it ends in .gz, .xz or .zst
+    forbidden_encoding - 'permutations' checks every ordered choice of 3 rows and 2 columns for
+    forbidden submatrices, 'combinations' checks every unordered choice against the lookup table
+    closed under row and column permutations (same solutions, fewer clauses), 'witness' adds a
+    variable per pair of columns and row pattern and forbids the row patterns of each forbidden
+    submatrix from all being present, 'nonzero' adds a variable per entry that is 1 if the entry is
+    1 or 2 and checks every unordered choice against a minimized lookup table over these variables
+    engine - 'forbidden' enforces the 1-Dollo property by forbidding submatrices, 'ancestry' places
+    every pair of mutations in the phylogeny, which gives a formula of size O(m n^2) whose
+    solutions must be counted over the independent support
+    structural_hashing - reuse the output of an AND/OR/XOR gate already built over the same inputs
+    instead of adding a new one, see stats
+    polarity_aware - only add the clauses of a gate in the directions its output is used in, which
+    gives fewer clauses with the same solutions over the independent support
+    cardinality_encoding - how the number of false positives, false negatives and duplicates are
+    constrained, 'adder', 'sequential', 'totalizer', 'modulo_totalizer', 'network' or 'auto' to pick
+    the smallest for every constraint
+    native_xor - write the XOR gates of the adders as CryptoMiniSat XOR constraints ("x" lines),
+    which the bundled UniGen handles with Gaussian elimination, instead of 4 clauses each
+    cache_dir - directory of previously generated formulas, keyed by the contents of the matrix, the
+    parameters and the code, that is shared by every process using it; the least recently used
+    formulas are evicted once it holds more than max_cache_bytes
+    processes - number of processes generating the clauses, which gives the same formula as one
+    process, but cannot be combined with structural_hashing or polarity_aware
+    variable_map - also write the variable map of the formula to variable_map_filename(write_filename),
+    so solutions can be reconstructed by another process, see read_variable_map
+    clustering - 'pairs' finds the duplicate rows and columns of the matrix by comparing every pair
+    of them, with O(m^2 n + m n^2) variables and clauses, 'assignment' assigns every row to one of s
+    row clusters and every column to one of t column clusters, with O(m s + n t) duplicate variables
+    and O(m s t + m n t) clauses, and forbids submatrices of the s x t clustered matrix; it gives the
+    same solutions, but only with the permutations, combinations and nonzero forbidden encodings
+    prune - replace the variables whose values are fixed by the input by constants and simplify
+    them out of every clause: the errors of the entries when fp or fn is 0, the 2s of the columns
+    whose loss is unsupported, and the equality of pairs of entries that follows from them; it gives
+    the same solutions, but the size of the formula depends on where the ones are, so predict_size
+    does not apply to it
+    skip_conflict_free_pairs - add no clauses forbidding submatrices on the pairs of columns that
+    cannot hold one within the fn and fp budgets and the allowed losses, see get_column_conflicts,
+    with the permutations, combinations and nonzero encodings; like prune, it gives the same
+    solutions, but predict_size does not apply to it
+    stats - a dict that is updated with the number of gates reused by structural hashing and the
+    number of clauses this saved, it stays empty if the formula comes from cache_dir or processes
+    """
+    if processes > 1 and (structural_hashing or polarity_aware):
+        raise ValueError('Formulas with structural hashing or polarity awareness are built in a single process')
+
+    matrix = read_matrix(read_filename)
+
+    options = {'forbidden_encoding': forbidden_encoding, 'engine': engine, 'structural_hashing': structural_hashing,
+                'polarity_aware': polarity_aware, 'cardinality_encoding': cardinality_encoding, 'native_xor': native_xor,
+                'clustering': clustering, 'prune': prune, 'skip_conflict_free_pairs': skip_conflict_free_pairs}
+
+    cached = None
+
+    if cache_dir != None:
+        key = formula_cache_key(matrix, s, t, allowed_losses, fn, fp, options)
+        cached = load_cached_formula(cache_dir, key, write_filename, forced_clauses)
+
+    if cached == None and processes > 1:
+        def write_formula(filename, forced_clauses=None):
+            return write_cnf_parallel(matrix, filename, s, t, allowed_losses, fn, fp, forbidden_encoding, engine,
+                                        cardinality_encoding, native_xor, processes, forced_clauses, clustering, prune,
+                                        skip_conflict_free_pairs)
+
+        if cache_dir != None:
+            store_cached_formula(cache_dir, key, write_formula, max_cache_bytes)
+            # only misses if the formula alone is larger than max_cache_bytes
+            cached = load_cached_formula(cache_dir, key, write_filename, forced_clauses)
+
+        if cached == None:
+            cached = write_formula(write_filename, forced_clauses)
+    elif cached == None:
+        F, variables = build_cnf(matrix, s, t, allowed_losses, fn, fp, forbidden_encoding, engine,
+                                    structural_hashing, polarity_aware, cardinality_encoding, native_xor, clustering, prune,
+                                    skip_conflict_free_pairs)
+
+        if cache_dir != None:
+            def write_formula(filename):
+                F.to_cnf_file(filename)
+                return F.var, F.num_clauses() + len(F.xor_clauses), variables
 
-    first_line = f'p cnf {F.var} {clause_count}\n'
+            store_cached_formula(cache_dir, key, write_formula, max_cache_bytes)
 
-    write_file.close()
+        add_forced_clauses(F, forced_clauses)
 
-    from_file = open(write_filename + '.tmp') 
-    
-    to_file = open(write_filename,mode="w")
-    to_file.write(first_line)
-    shutil.copyfileobj(from_file, to_file)
-    
-    to_file.close()
-    from_file.close()
+        if stats != None:
+            stats.update(F.stats)
 
-    os.system(f'rm {write_filename}.tmp')
+        # every clause is in F, so the header is known before anything is written
+        F.to_cnf_file(write_filename)
+
+        cached = F.var, F.num_clauses() + len(F.xor_clauses), variables
+
+    num_vars, clause_count, variables = cached
+
+    if variable_map:
+        parameters = {'formula': os.path.basename(write_filename), 'clusters': [s, t],
+                    'allowed_losses': None if allowed_losses == None else sorted(allowed_losses),
+                    'errors': [fn, fp], 'num_vars': num_vars, 'num_clauses': clause_count, 'options': options}
+        write_variable_map(variable_map_filename(write_filename), variables, independent_support(matrix, variables),
+                            matrix, parameters)
 
     if return_num_vars_clauses:
-        return F.var, clause_count
+        return num_vars, clause_count
     else:
         return variables
 
+@lru_cache(maxsize=None)
+def predict_cardinality_size(num_false_pos, num_false_neg, num_rows, num_cols, fp, fn, s, t,
+                                structural_hashing, polarity_aware, cardinality_encoding, native_xor, clustering='pairs'):
+    """
+    Returns the number of variables, clauses, literals and XOR constraints added by
+    encode_constraints. The circuits only depend on the number of summed variables and the
+    constraints, so they are built on their own over fresh variables.
+    """
+    F = CNF(structural_hashing, polarity_aware, native_xor)
+
+    false_positives = [[F.new_var() for i in range(num_false_pos)]]
+    false_negatives = [[F.new_var() for i in range(num_false_neg)]]
+    if clustering == 'assignment':
+        row_is_duplicate, col_is_duplicate = None, None
+    else:
+        row_is_duplicate = [F.new_var() for i in range(num_rows)]
+        col_is_duplicate = [F.new_var() for i in range(num_cols)]
+    num_inputs = F.var
+
+    clause_count = encode_constraints(false_positives, false_negatives, row_is_duplicate, col_is_duplicate,
+                                        fp, fn, num_rows - s, num_cols - t, F, cardinality_encoding)
+    literal_count = len(F.literals) - 2 - clause_count
+
+    return F.var - num_inputs, clause_count, literal_count, len(F.xor_clauses)
+
+def predict_size(num_rows, num_cols, num_ones, s, t, allowed_losses=None, fn=1, fp=1,
+                    forbidden_encoding='permutations', engine='forbidden', structural_hashing=False, polarity_aware=False,
+                    cardinality_encoding='adder', native_xor=False, clustering='pairs'):
+    """
+    Returns the number of variables and clauses get_cnf writes for a num_rows x num_cols matrix
+    with num_ones entries equal to 1, the number of clauses and literals of every clause family,
+    and an estimate of the size of the formula file in bytes, without building the formula.
+
+    The counts do not depend on where the ones are. The arguments are the same as for get_cnf.
+    """
+    m = num_rows
+    n = num_cols
+
+    if allowed_losses == None:
+        allowed_losses = set([i for i in range(n)])
+    unsupported_losses = [i for i in range(n) if i not in allowed_losses]
+
+    row_pairs = m * (m - 1) // 2
+    col_pairs = n * (n - 1) // 2
+
+    # (clauses, literals) of every clause family
+    families = {'constant': (1, 1)}
+
+    tables = get_forbidden_tables()
+
+    if clustering == 'assignment':
+        if engine != 'forbidden' or forbidden_encoding not in ('permutations', 'combinations', 'nonzero'):
+            raise ValueError('The cluster assignment encoding forbids submatrices of the clustered matrix with the '
+                            'permutations, combinations or nonzero encodings')
+
+        cluster_row_pairs = s * (s - 1) // 2
+        cluster_col_pairs = t * (t - 1) // 2
+        variables = 1 + 2 * m * n + m * s + n * t + 2 * s * t + 2 * m * t + 2 * cluster_row_pairs * t + 2 * cluster_col_pairs * s
+
+        # submatrices of the clustered matrix, which has no duplicate rows or columns
+        m, n, row_pairs, col_pairs, duplicate_literals = s, t, cluster_row_pairs, cluster_col_pairs, 0
+    elif clustering == 'pairs':
+        variables = 1 + 2 * m * n + m * col_pairs + row_pairs * n + row_pairs + col_pairs + m + n
+        duplicate_literals = 5
+    else:
+        raise ValueError(f'Unknown clustering encoding: {clustering}')
+
+    def entry_length(value):
+        return 2 if value == '0' else 1
+
+    if engine == 'ancestry':
+        all_patterns = [f'{value1}{value2}' for value1 in '012' for value2 in '012']
+        num_relations = len(tables['ancestry_relations'])
+        variables += col_pairs * num_relations
+
+        excluded = [pattern for allowed in tables['ancestry_relations'] for pattern in all_patterns if pattern not in allowed]
+        families['ancestry'] = (col_pairs * (1 + 2 * num_relations + num_relations * (num_relations - 1) // 2 + m * len(excluded)),
+                                col_pairs * (2 + 5 * num_relations + num_relations * (num_relations - 1) +
+                                            m * sum(1 + entry_length(p[0]) + entry_length(p[1]) for p in excluded)))
+    elif engine != 'forbidden':
+        raise ValueError(f'Unknown formula engine: {engine}')
+    elif forbidden_encoding == 'witness':
+        num_patterns = len(tables['forbidden_row_patterns'])
+        variables += (m + 1) * col_pairs * num_patterns
+
+        entry_lengths = [entry_length(p[0]) + entry_length(p[1]) for p in tables['forbidden_row_patterns']]
+        families['witness'] = (col_pairs * (sum(m * (length + 2) + 1 for length in entry_lengths) + len(tables['forbidden_pattern_sets'])),
+                                col_pairs * (sum(m * (3 * length + 4) + 1 for length in entry_lengths) +
+                                            5 * len(tables['forbidden_pattern_sets'])))
+    elif forbidden_encoding in ('permutations', 'combinations', 'nonzero'):
+        if forbidden_encoding == 'permutations':
+            index, sign = tables['lookup_templates']
+            num_choices = m * (m - 1) * (m - 2) * n * (n - 1)
+        elif forbidden_encoding == 'nonzero':
+            variables += m * n
+            index, sign = get_nonzero_lookup_templates()
+            num_choices = math.comb(m, 3) * col_pairs
+            # with polarity awareness, the definitions are only added once the lookup uses them
+            families['nonzero_definition'] = (0, 0) if polarity_aware and num_choices == 0 else (3 * m * n, 7 * m * n)
+        else:
+            index, sign = tables['symmetric_lookup_templates']
+            num_choices = math.comb(m, 3) * col_pairs
+        families[forbidden_encoding] = (num_choices * len(index),
+                                        num_choices * (int(np.count_nonzero(sign)) + duplicate_literals * len(index)))
+    else:
+        raise ValueError(f'Unknown forbidden submatrix encoding: {forbidden_encoding}')
+
+    m = num_rows
+    n = num_cols
+
+    families['not_one_and_two'] = (m * n, 2 * m * n)
+
+    if clustering == 'assignment':
+        def cluster_assignment_size(num_members, num_clusters):
+            # exactly one cluster per member, clusters in the order of their first member, last cluster not empty
+            return (num_members * (num_clusters * (num_clusters + 1) // 2) + 1,
+                    num_members * num_clusters * num_clusters + (num_clusters - 1) * num_members * (num_members + 1) // 2 + num_members)
+
+        def distinct_clusters_size(num_pairs, num_entries):
+            # differ is only used positively, so polarity awareness keeps half of its XOR clauses
+            return (num_pairs * (2 * num_entries * (2 if polarity_aware else 4) + 1),
+                    num_pairs * (2 * num_entries * (6 if polarity_aware else 12) + 2 * num_entries))
+
+        families['row_clusters'] = cluster_assignment_size(m, s)
+        families['col_clusters'] = cluster_assignment_size(n, t)
+        families['row_cluster_entries'] = (4 * m * s * t, 12 * m * s * t)
+        families['col_cluster_entries'] = (4 * n * t * m, 12 * n * t * m)
+        families['distinct_rows'] = distinct_clusters_size(cluster_row_pairs, t)
+        families['distinct_cols'] = distinct_clusters_size(cluster_col_pairs, s)
+        families['unsupported_losses'] = (m * len(unsupported_losses) + sum(unsupported_losses),
+                                            m * len(unsupported_losses) + sum(unsupported_losses))
+    else:
+        families['row_duplicates'] = (row_pairs * (n + 2) + m, row_pairs * (3 * n + 4) + m)
+        # a column that cannot be lost gets a clause for every column before it
+        families['col_duplicates'] = (col_pairs * (m + 2) + n + sum(unsupported_losses),
+                                        col_pairs * (3 * m + 4) + n + 2 * sum(unsupported_losses))
+        families['col_pairs_equal'] = (row_pairs * n * len(pairs_equal_clauses), row_pairs * n * int(np.count_nonzero(pairs_equal_sign)))
+        families['row_pairs_equal'] = (m * col_pairs * len(pairs_equal_clauses), m * col_pairs * int(np.count_nonzero(pairs_equal_sign)))
+        families['unsupported_losses'] = (m * len(unsupported_losses), m * len(unsupported_losses))
+
+    cardinality_variables, cardinality_clauses, cardinality_literals, num_xors = predict_cardinality_size(
+        num_ones, m * n - num_ones, m, n, fp, fn, s, t, structural_hashing, polarity_aware, cardinality_encoding, native_xor,
+        clustering)
+    variables += cardinality_variables
+    families['cardinality'] = (cardinality_clauses, cardinality_literals)
+    if native_xor:
+        families['xor'] = (num_xors, 3 * num_xors)
+
+    clauses = sum(clause_count for clause_count, literal_count in families.values())
+    literals = sum(literal_count for clause_count, literal_count in families.values())
+
+    # every literal is written as its variable, about half of them with a sign, and a space
+    digits = sum(9 * 10**(d - 1) * d for d in range(1, len(str(variables)))) + (variables - 10**(len(str(variables)) - 1) + 1) * len(str(variables))
+    file_bytes = len(f'p cnf {variables} {clauses}\n') + 2 * m * n * (len(str(2 * m * n)) + 1) + math.ceil(2 * m * n / 10) * 8
+    file_bytes += round(literals * (digits / variables + 1.5)) + 2 * clauses
+
+    return {'variables': variables,
+            'clauses': clauses,
+            'bytes': file_bytes,
+            'families': {family: {'clauses': clause_count, 'literals': literal_count}
+                        for family, (clause_count, literal_count) in families.items()}}
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate samples for given directories')
 
@@ -157,7 +580,7 @@ if __name__ == '__main__':
         '--outfile',
         type=str,
         default='formula.cnf',
-        help='outfile to write formula to'
+        help='outfile to write formula to, compressed if it ends in .gz, .xz or .zst'
     )
     parser.add_argument(
         '--s',
@@ -189,6 +612,76 @@ if __name__ == '__main__':
         default=None,
         help='Filename containing allowed mutation losses, listed on one line, separated by commas.'
     )
+    parser.add_argument(
+        '--forbidden_encoding',
+        type=str,
+        default='permutations',
+        choices=['permutations', 'combinations', 'witness', 'nonzero'],
+        help='How forbidden submatrices are encoded, combinations, witness and nonzero give smaller formulas with the same solutions'
+    )
+    parser.add_argument(
+        '--engine',
+        type=str,
+        default='forbidden',
+        choices=['forbidden', 'ancestry'],
+        help='How the 1-Dollo property is encoded, ancestry gives formulas that grow in O(m n^2)'
+    )
+    parser.add_argument(
+        '--structural_hashing',
+        action='store_true',
+        help='Reuse gates built over the same inputs and report how many gates and clauses were saved'
+    )
+    parser.add_argument(
+        '--polarity_aware',
+        action='store_true',
+        help='Only encode gates in the directions they are used in, solutions must be counted over the independent support'
+    )
+    parser.add_argument(
+        '--cardinality_encoding',
+        type=str,
+        default='adder',
+        choices=['adder', 'auto', 'sequential', 'totalizer', 'modulo_totalizer', 'network'],
+        help='How the numbers of false positives, false negatives and duplicates are constrained, auto picks the smallest encoding for every constraint'
+    )
+    parser.add_argument(
+        '--native_xor',
+        action='store_true',
+        help='Write the XOR gates of the adders as XOR constraints, only supported by CryptoMiniSat based samplers such as UniGen'
+    )
+    parser.add_argument(
+        '--clustering',
+        type=str,
+        default='pairs',
+        choices=['pairs', 'assignment'],
+        help='How duplicate rows and columns are found, assignment assigns them to clusters with O(m s + n t) variables'
+    )
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help='Replace the variables fixed by the input, e.g. the errors when fp or fn is 0, by constants and simplify them out'
+    )
+    parser.add_argument(
+        '--skip_conflict_free_pairs',
+        action='store_true',
+        help='Add no clauses forbidding submatrices on the pairs of columns that cannot hold one within the fn and fp budgets'
+    )
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='Number of processes generating the clauses, the formula is the same for any number'
+    )
+    parser.add_argument(
+        '--cache_dir',
+        type=str,
+        default=None,
+        help='Directory of previously generated formulas to reuse, and to add this formula to'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Print the number of variables and clauses of the formula and its estimated size without writing it'
+    )
 
     args = parser.parse_args()
 
@@ -202,10 +695,43 @@ if __name__ == '__main__':
     else:
         allowed_losses = None
 
+    if args.dry_run:
+        if args.prune or args.skip_conflict_free_pairs:
+            parser.error('with --prune or --skip_conflict_free_pairs the size depends on the matrix, build the formula to find it')
+
+        matrix = read_matrix(filename)
+        size = predict_size(len(matrix), len(matrix[0]), sum(map(sum, matrix)), s, t, allowed_losses, args.fn, args.fp,
+                            forbidden_encoding=args.forbidden_encoding, engine=args.engine,
+                            structural_hashing=args.structural_hashing, polarity_aware=args.polarity_aware,
+                            cardinality_encoding=args.cardinality_encoding, native_xor=args.native_xor,
+                            clustering=args.clustering)
+
+        for family, counts in size['families'].items():
+            print(f'{family}: {counts["clauses"]} clauses, {counts["literals"]} literals')
+        print(f'{size["variables"]} variables, {size["clauses"]} clauses, about {size["bytes"]} bytes')
+
+        # the same formula with every cardinality encoding, to weigh its variables against its clauses
+        for cardinality_encoding in ['adder', 'auto', 'sequential', 'totalizer', 'modulo_totalizer', 'network']:
+            size = predict_size(len(matrix), len(matrix[0]), sum(map(sum, matrix)), s, t, allowed_losses, args.fn, args.fp,
+                                forbidden_encoding=args.forbidden_encoding, engine=args.engine,
+                                structural_hashing=args.structural_hashing, polarity_aware=args.polarity_aware,
+                                cardinality_encoding=cardinality_encoding, native_xor=args.native_xor,
+                                clustering=args.clustering)
+            print(f'--cardinality_encoding {cardinality_encoding}: {size["variables"]} variables, {size["clauses"]} clauses')
+        sys.exit(0)
+
+    stats = {}
     start = time.time()
-    variables = get_cnf(filename, outfile, s, t, allowed_losses, args.fn, args.fp)
+    variables = get_cnf(filename, outfile, s, t, allowed_losses, args.fn, args.fp,
+                        forbidden_encoding=args.forbidden_encoding, engine=args.engine,
+                        structural_hashing=args.structural_hashing, polarity_aware=args.polarity_aware,
+                        cardinality_encoding=args.cardinality_encoding, native_xor=args.native_xor,
+                        clustering=args.clustering, prune=args.prune,
+                        skip_conflict_free_pairs=args.skip_conflict_free_pairs, cache_dir=args.cache_dir, processes=args.processes,
+                        variable_map=True, stats=stats)
     end = time.time()
 
-    write_vars("formula.vars", variables)
-
-    print(f'Generated cnf formula in {end - start} seconds')
\ No newline at end of file
+    print(f'Generated cnf formula in {end - start} seconds')
+    if args.structural_hashing and stats:
+        print(f'Structural hashing reused {stats["gates_reused"]} gates, saving {stats["clauses_saved"]} clauses')
+    print(f'Wrote its variable map to {variable_map_filename(outfile)}')
\ No newline at end of file
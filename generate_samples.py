@@ -6,41 +6,57 @@ $ python3 generate_samples.py [-h] [--filename FILENAME] [--outfile OUTFILE]
                            [--timeout TIMEOUT] [--num_samples NUM_SAMPLES]
                            [--sampler SAMPLER] [--s S] [--t T] [--fn FALSE_NEGATIVES]
                            [--fp FALSE_POSITIVES] [--allowed_losses ALLOWED_LOSSES]
-                           [--debug]
+                           [--engine ENGINE]
+                           [--cardinality_encoding CARDINALITY_ENCODING]
+                           [--native_xor] [--clustering CLUSTERING] [--prune]
+                           [--skip_conflict_free_pairs] [--debug]
 
 This will attempt to sample NUMBER_OF_SAMPLES 1-dollo phylogeny matrices for the matrix in INPUT_MATRIX_FILENAME using the sampler of your choosing, where only mutations specified in LOSSES_FILENAME can be lost. The solutions will contain exactly FALSE_NEGATIVES false negatives and exactly FALSE_POSITIVES false positives.
 
-The reconstructed 1-dollo matrices will be saved to SOLUTIONS_OUTFILE.
+The reconstructed 1-dollo matrices will be saved to SOLUTIONS_OUTFILE. The variable map of the formula and the samples of UniGen are kept in SOLUTIONS_OUTFILE.vmap and SOLUTIONS_OUTFILE.samples, from which reconstruct_solutions.py can reconstruct them again.
 
 SAMPLER_TYPE can either be 1 for Quicksampler or 2 for Unigen. Note that Unigen is not Mac compatible.
 """
 
 from generate_formula import get_cnf
-from get_vars import write_vars
-from reconstruct_solutions import reconstruct_solutions
-from utils import parse_allowed_losses_file, read_matrix
+from get_vars import variable_map_filename
+from reconstruct_solutions import reconstruct_solutions_from_variable_map
+from utils import parse_allowed_losses_file, read_matrix, open_formula, is_compressed
 
 import sys
 import time
 import os 
+import shutil
 import argparse
 import platform
 
 QUICKSAMPLER = 1
 UNIGEN = 2
 
+# next to this file, so samples can be generated from any working directory
+unigen_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samplers', 'unigen')
+
 def unigensampler_generator(infile, outfile, num_samples, timeout):
-    unigen_cmd = f'./samplers/unigen --samples={num_samples} --maxTotalTime={timeout} --verbosity=0  --threads=20 {infile} {outfile}'
+    # UniGen reads gzip compressed formulas itself, but reads its input more than once, so other
+    # compressed formulas are decompressed to a file first
+    decompressed = is_compressed(infile) and not infile.endswith('.gz')
+    if decompressed:
+        with open_formula(infile) as from_file:
+            infile = os.path.splitext(infile)[0] + '.unigen.cnf'
+            with open(infile, 'w') as to_file:
+                shutil.copyfileobj(from_file, to_file)
+
+    unigen_cmd = f'{unigen_path} --samples={num_samples} --maxTotalTime={timeout} --verbosity=0  --threads=20 {infile} {outfile}'
 
     os.system(unigen_cmd)
 
+    if decompressed:
+        os.remove(infile)
+
 def clean_up(shortened_filename):
     remove_formula = f'rm {shortened_filename}.tmp.formula.cnf'
     os.system(remove_formula)
 
-    remove_unigen_file = f'rm {shortened_filename}.tmp.formula.cnf.unigen'
-    os.system(remove_unigen_file)
-
 if __name__=='__main__':
     parser = argparse.ArgumentParser(description='Generate samples for given directories')
 
@@ -98,6 +114,42 @@ if __name__=='__main__':
         default=None,
         help='Filename containing allowed mutation losses, listed on one line, separated by commas.'
     )
+    parser.add_argument(
+        '--engine',
+        type=str,
+        default='forbidden',
+        choices=['forbidden', 'ancestry'],
+        help='How the 1-Dollo property is encoded, ancestry gives formulas that grow in O(m n^2)'
+    )
+    parser.add_argument(
+        '--cardinality_encoding',
+        type=str,
+        default='adder',
+        choices=['adder', 'auto', 'sequential', 'totalizer', 'modulo_totalizer', 'network'],
+        help='How the numbers of false positives, false negatives and duplicates are constrained, auto picks the smallest encoding for every constraint'
+    )
+    parser.add_argument(
+        '--native_xor',
+        action='store_true',
+        help='Write the XOR gates of the adders as XOR constraints, which UniGen handles with Gaussian elimination'
+    )
+    parser.add_argument(
+        '--clustering',
+        type=str,
+        default='pairs',
+        choices=['pairs', 'assignment'],
+        help='How duplicate rows and columns are found, assignment assigns them to clusters with O(m s + n t) variables'
+    )
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help='Replace the variables fixed by the input, e.g. the errors when fp or fn is 0, by constants and simplify them out'
+    )
+    parser.add_argument(
+        '--skip_conflict_free_pairs',
+        action='store_true',
+        help='Add no clauses forbidding submatrices on the pairs of columns that cannot hold one within the fn and fp budgets'
+    )
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -119,24 +171,28 @@ if __name__=='__main__':
 
     shortened_filename = args.filename.split('.')[0]
     cnf_filename = f'{shortened_filename}.tmp.formula.cnf'
-    variables_filename = f'{shortened_filename}.variables'
 
     if args.allowed_losses:
         allowed_losses = parse_allowed_losses_file(args.allowed_losses)
     else:
         allowed_losses = None
 
-    variables = get_cnf(args.filename, cnf_filename, args.s, args.t, allowed_losses, args.fn, args.fp)
-    
-    if args.debug:
-        write_vars(variables_filename, variables)
+    get_cnf(args.filename, cnf_filename, args.s, args.t, allowed_losses, args.fn, args.fp,
+            engine=args.engine, cardinality_encoding=args.cardinality_encoding,
+            native_xor=args.native_xor, clustering=args.clustering, prune=args.prune,
+            skip_conflict_free_pairs=args.skip_conflict_free_pairs, variable_map=True)
+
+    # the variable map and the raw samples are kept next to the outfile, so the samples can be
+    # reconstructed again later without the formula, see reconstruct_solutions.py
+    variable_map = variable_map_filename(args.outfile)
+    shutil.move(variable_map_filename(cnf_filename), variable_map)
 
     if os_name == 'macOS':
         print('Unigen not compatible with OS X')
     else:
-        unigen_outfile = cnf_filename + '.unigen'
+        unigen_outfile = f'{args.outfile}.samples'
         unigensampler_generator(cnf_filename, unigen_outfile, args.num_samples, args.timeout)
 
-        reconstruct_solutions(args.filename, unigen_outfile, args.outfile, variables, args.debug)
+        reconstruct_solutions_from_variable_map(variable_map, unigen_outfile, args.outfile, args.debug)
         if not args.debug:
             clean_up(shortened_filename)
\ No newline at end of file
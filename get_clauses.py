@@ -1,7 +1,10 @@
-from itertools import permutations 
+from itertools import permutations, combinations, product
+from functools import lru_cache
 import os 
 import math
+import numpy as np
 from CNF import CNF
+from get_vars import pair_index
 
 def get_lookup(lookup_filename):
     """
@@ -18,8 +21,6 @@ def get_lookup(lookup_filename):
 
     return lookup
 
-lookup = get_lookup('forbidden_clauses.txt')
-
 """
 Lookup table that shows location of each variable in is_one or is_two
 """
@@ -36,309 +37,888 @@ variable_mapping = {'a': [0, [0,0]],
                     'k': [1, [2,0]],
                     'l': [1, [2,1]],}
 
+def permute_raw_clause(raw_clause, row_order, col_order):
+    """
+    Returns the raw clause obtained by reordering the rows and columns of the
+    3x2 submatrix the given raw clause refers to.
+
+    raw_clause - clause composed of letters that correspond to a position in the submatrix
+    row_order - new position of rows 0, 1 and 2 of the submatrix
+    col_order - new position of columns 0 and 1 of the submatrix
+    """
+    letters = {(use_is_two, location[0], location[1]): label
+                for label, (use_is_two, location) in variable_mapping.items()}
+    permuted = []
+    for argument in raw_clause.split()[:-1]:
+        sign = '-' if argument[0] == '-' else ''
+        use_is_two, location = variable_mapping[argument[-1]]
+        label = letters[(use_is_two, row_order[location[0]], col_order[location[1]])]
+        permuted.append(f'{sign}{label}')
+    return ' '.join(permuted) + ' 0\n'
+
+def get_symmetric_lookup(lookup):
+    """
+    Returns the closure of the given lookup table under row and column permutations
+    of the 3x2 submatrix, in the same format as the lookup table.
+
+    Checking every combination of 3 rows and 2 columns against this table forbids
+    exactly the submatrices that checking every permutation of 3 rows and 2 columns
+    against lookup forbids.
+    """
+    symmetric_lookup = dict(lookup)
+    for possible_submatrix, clause_raw in lookup.items():
+        for row_order in permutations(range(3)):
+            for col_order in permutations(range(2)):
+                permuted_submatrix = ['0'] * 6
+                for row in range(3):
+                    for col in range(2):
+                        permuted_submatrix[2*row_order[row] + col_order[col]] = possible_submatrix[2*row + col]
+                permuted_submatrix = ''.join(permuted_submatrix)
+                if permuted_submatrix not in symmetric_lookup:
+                    symmetric_lookup[permuted_submatrix] = permute_raw_clause(clause_raw, row_order, col_order)
+    return symmetric_lookup
+
+def compile_lookup(lookup):
+    """
+    Returns the clauses of the given lookup table as integer templates (index, sign).
+
+    Clause k of the table is sign[k][x] * submatrix[index[k][x]] for every x with sign[k][x] != 0,
+    where submatrix lists the is_one labels of the 3x2 submatrix in row-major order followed by
+    its is_two labels.
+    """
+    raw_clauses = [clause_raw.split()[:-1] for clause_raw in lookup.values()]
+    width = max([len(raw_clause) for raw_clause in raw_clauses])
+
+    index = np.zeros((len(raw_clauses), width), dtype=np.int64)
+    sign = np.zeros((len(raw_clauses), width), dtype=np.int32)
+
+    for k, raw_clause in enumerate(raw_clauses):
+        for x, argument in enumerate(raw_clause):
+            use_is_two, location = variable_mapping[argument[-1]]
+            index[k][x] = 6*use_is_two + 2*location[0] + location[1]
+            sign[k][x] = -1 if argument[0] == '-' else 1
+
+    return index, sign
+
+def get_forbidden_pattern_sets(symmetric_lookup):
+    """
+    Returns the sets of row patterns of the forbidden submatrices in symmetric_lookup, and a
+    list of every row pattern that appears in one of them.
+
+    The 3 rows of every forbidden submatrix are distinct, so a forbidden submatrix is present
+    on a pair of columns if and only if each of its row patterns is present in some row.
+    """
+    pattern_sets = []
+    for possible_submatrix in symmetric_lookup.keys():
+        rows = sorted([possible_submatrix[0:2], possible_submatrix[2:4], possible_submatrix[4:6]])
+        if len(set(rows)) != 3:
+            raise ValueError(f'Forbidden submatrix {possible_submatrix} has duplicate rows')
+        if rows not in pattern_sets:
+            pattern_sets.append(rows)
+
+    patterns = sorted(set([pattern for rows in pattern_sets for pattern in rows]))
+
+    return pattern_sets, patterns
+
+def get_ancestry_relations(pattern_sets):
+    """
+    Returns the maximal sets of row patterns that can be present on a pair of columns
+    without containing the row patterns of a forbidden submatrix.
+
+    Each set corresponds to a relation between the two mutations in a 1-Dollo phylogeny:
+    the mutations are gained in different subtrees, or one is gained below the other,
+    with each loss placed above, at or below the gain of the other mutation.
+    """
+    all_patterns = [f'{value1}{value2}' for value1 in '012' for value2 in '012']
+
+    allowed_sets = []
+    for size in range(len(all_patterns), 0, -1):
+        for patterns in combinations(all_patterns, size):
+            if any(set(rows) <= set(patterns) for rows in pattern_sets):
+                continue
+            if any(set(patterns) <= set(allowed) for allowed in allowed_sets):
+                continue
+            allowed_sets.append(list(patterns))
+
+    return allowed_sets
+
+def get_prime_cubes(forbidden):
+    """
+    Returns the prime cubes of the given set of forbidden submatrices, in sorted order.
+
+    A cube lists for every entry of the 3x2 submatrix in row-major order the values it may take,
+    e.g. ('12', '0', '0', '12', '12', '12'), and stands for every submatrix taking those values.
+    A cube is prime if all the submatrices it stands for are forbidden and it cannot be extended
+    by another value in any entry.
+    """
+    def submatrices(cube):
+        return [''.join(values) for values in product(*cube)]
+
+    def is_forbidden(cube):
+        return all(submatrix in forbidden for submatrix in submatrices(cube))
+
+    # every cube inside forbidden is reached by adding one value at a time to a forbidden submatrix
+    cubes = set()
+    frontier = set(tuple(submatrix) for submatrix in forbidden)
+    while frontier:
+        cubes |= frontier
+        extended = set()
+        for cube in frontier:
+            for entry in range(6):
+                for value in '012':
+                    if value not in cube[entry]:
+                        larger = cube[:entry] + (''.join(sorted(cube[entry] + value)),) + cube[entry+1:]
+                        if larger not in cubes and is_forbidden(larger):
+                            extended.add(larger)
+        frontier = extended
+
+    def contains(cube, other):
+        return all(set(other_values) <= set(values) for values, other_values in zip(cube, other))
+
+    return sorted([cube for cube in cubes if not any(other != cube and contains(other, cube) for other in cubes)])
+
+def minimize_lookup(lookup):
+    """
+    Returns a small list of cubes (see get_prime_cubes) that together stand for exactly the
+    forbidden submatrices in lookup, chosen by two-level minimization: the prime cubes that are
+    the only ones standing for some forbidden submatrix, then greedily the prime cube standing
+    for the most submatrices not yet covered, preferring fewer literals.
+    """
+    forbidden = set(lookup.keys())
+    primes = get_prime_cubes(forbidden)
+    covers = {cube: set(''.join(values) for values in product(*cube)) for cube in primes}
+
+    def num_literals(cube):
+        return sum(1 for values in cube if values != '012')
+
+    chosen = []
+    for submatrix in sorted(forbidden):
+        covering = [cube for cube in primes if submatrix in covers[cube]]
+        if len(covering) == 1 and covering[0] not in chosen:
+            chosen.append(covering[0])
+
+    uncovered = forbidden.difference(*[covers[cube] for cube in chosen])
+    while uncovered:
+        cube = max(primes, key=lambda cube: (len(covers[cube] & uncovered), -num_literals(cube)))
+        chosen.append(cube)
+        uncovered -= covers[cube]
+
+    return chosen
+
+"""
+Literal of the clause forbidding a cube that restricts an entry to the given values, as (label,
+sign) over the labels [is_one, is_two, nonzero] of the entry, where nonzero is 1 if the entry is 1 or 2
+"""
+cube_literals = {'0': (2, 1),
+                '1': (0, -1),
+                '2': (1, -1),
+                '12': (2, -1),
+                '01': (1, 1),
+                '02': (0, 1)}
+
+def compile_cubes(cubes):
+    """
+    Returns the clauses forbidding the given cubes as integer templates (index, sign), like
+    compile_lookup but over is_one, is_two and nonzero labels of the 3x2 submatrix in this order.
+    """
+    width = max([sum(1 for values in cube if values != '012') for cube in cubes])
+
+    index = np.zeros((len(cubes), width), dtype=np.int64)
+    sign = np.zeros((len(cubes), width), dtype=np.int32)
+
+    for k, cube in enumerate(cubes):
+        x = 0
+        for entry, values in enumerate(cube):
+            if values != '012':
+                label, literal_sign = cube_literals[values]
+                index[k][x] = 6*label + entry
+                sign[k][x] = literal_sign
+                x += 1
+
+    return index, sign
+
+@lru_cache(maxsize=None)
+def get_nonzero_lookup_templates():
+    """
+    Returns the integer templates of the minimized lookup table closed under row and column
+    permutations, see minimize_lookup and compile_cubes. It is built the first time it is needed.
+    """
+    return compile_cubes(minimize_lookup(get_forbidden_tables()['symmetric_lookup']))
+
+# next to this file, so formulas can be generated from any working directory
+lookup_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'forbidden_clauses.txt')
+
+@lru_cache(maxsize=None)
+def get_forbidden_tables():
+    """
+    Returns the lookup table of forbidden submatrices and the tables derived from it, which are
+    built the first time they are needed and shared afterwards.
+
+    lookup - lookup table read from lookup_filename
+    symmetric_lookup - lookup closed under row and column permutations
+    lookup_templates, symmetric_lookup_templates - integer templates of both, see compile_lookup
+    forbidden_pattern_sets, forbidden_row_patterns - see get_forbidden_pattern_sets
+    ancestry_relations - see get_ancestry_relations
+    """
+    lookup = get_lookup(lookup_filename)
+    symmetric_lookup = get_symmetric_lookup(lookup)
+    forbidden_pattern_sets, forbidden_row_patterns = get_forbidden_pattern_sets(symmetric_lookup)
+
+    return {'lookup': lookup,
+            'symmetric_lookup': symmetric_lookup,
+            'lookup_templates': compile_lookup(lookup),
+            'symmetric_lookup_templates': compile_lookup(symmetric_lookup),
+            'forbidden_pattern_sets': forbidden_pattern_sets,
+            'forbidden_row_patterns': forbidden_row_patterns,
+            'ancestry_relations': get_ancestry_relations(forbidden_pattern_sets)}
+
+def __getattr__(name):
+    # the tables can still be imported by name, e.g. from get_clauses import lookup
+    if name in ('lookup', 'symmetric_lookup', 'lookup_templates', 'symmetric_lookup_templates',
+                'forbidden_pattern_sets', 'forbidden_row_patterns', 'ancestry_relations'):
+        return get_forbidden_tables()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 def generate_is_one(matrix, false_pos, false_neg, is_two):
-    m = len(matrix)
-    n = len(matrix[0])
-    is_one = []
-
-    for i in range(m):
-        curr_row = []
-        for j in range(n):
-            if matrix[i][j] == 1:
-                curr_row.append(-false_pos[i][j])
-            else:
-                curr_row.append(false_neg[i][j])
-        is_one.append(curr_row)
-    
-    return is_one
-
-def get_forbidden_clause(is_one_sub, is_two_sub, raw_clause):
-    """
-    Returns a string that enforces the abscence of the given submatrix.
-
-    is_one_sub - 3x2 matrix of labels corresponding to a certain entry of the clustered matrix
-    being 1
-    is_two_sub - 3x2 matrix of labels corresponding to a certain entry of the clustered matrix
-    being 2
-    raw_clause - clause composed of letters that correspond to a position in the given submatrix
-    """
-    split_cnf = raw_clause.split()[:-1]
-    clause_cnf = ''
-    for argument in split_cnf:
-        if argument[0] == '-':
-            label = argument[1]
-            use_is_two, location = variable_mapping[label][0], variable_mapping[label][1]
-            if use_is_two:
-                clause_cnf += f'{-is_two_sub[location[0]][location[1]]} '
-            else:
-                clause_cnf += f'{-is_one_sub[location[0]][location[1]]} '
-        else:
-            label = argument[0]
-            use_is_two, location = variable_mapping[label][0], variable_mapping[label][1]
-            if use_is_two:
-                clause_cnf += f'{is_two_sub[location[0]][location[1]]} '
-            else:
-                clause_cnf += f'{is_one_sub[location[0]][location[1]]} '
-    return clause_cnf
-
-def get_clauses_no_forbidden(is_one, is_two, row_is_duplicate, col_is_duplicate, write_file):
-    """
-    Returns a list of clauses that enforce that no forbidden submatrices can
-    be present in clustered matrix.
+    """
+    Returns the matrix of literals that are 1 if the corresponding entry of the clustered matrix
+    is 1: not a false positive where matrix is 1, a false negative where it is 0.
+    """
+    return np.where(np.array(matrix) == 1, -np.asarray(false_pos), np.asarray(false_neg)).astype(np.int32)
+
+# (false positives, false negatives, needs a loss) of turning an entry of the input into a value of the clustered matrix
+entry_costs = {('0', '0'): (0, 0, False), ('0', '1'): (0, 1, False), ('0', '2'): (0, 0, True),
+                ('1', '0'): (1, 0, False), ('1', '1'): (0, 0, False), ('1', '2'): (1, 0, True)}
+
+@lru_cache(maxsize=None)
+def get_forbidden_requirements():
+    """
+    Returns every way of turning 3 rows of the input into a forbidden submatrix on a pair of
+    columns, as an array with one row per way listing the number of false positives and false
+    negatives it takes, whether it puts a 2 in the first and in the second column, and then how
+    many rows it uses whose entries on the pair of columns are 00, 01, 10 and 11. It is built the
+    first time it is needed.
+    """
+    requirements = set()
+    for submatrix in get_forbidden_tables()['symmetric_lookup']:
+        for row_entries in product(['00', '01', '10', '11'], repeat=3):
+            costs = [entry_costs[(entries[c], submatrix[2*r+c])] for r, entries in enumerate(row_entries) for c in range(2)]
+            requirements.add((sum(cost[0] for cost in costs), sum(cost[1] for cost in costs),
+                                any(cost[2] for cost in costs[0::2]), any(cost[2] for cost in costs[1::2]),
+                                *[row_entries.count(entries) for entries in ['00', '01', '10', '11']]))
+
+    return np.array(sorted(requirements), dtype=np.int64)
+
+def get_column_conflicts(matrix, fn, fp, allowed_losses=None):
+    """
+    Returns the boolean matrix whose entry [k][l] is False if no clustered matrix with at most fn
+    false negatives and fp false positives, and 2s only in the columns whose loss is allowed, has a
+    forbidden submatrix on columns k and l, so they need no clauses forbidding submatrices.
+
+    Turning a row into a row of a forbidden submatrix only depends on its entries on the pair of
+    columns, so it is enough to count the rows with each pair of entries. The fp and fn budgets of
+    the whole matrix are compared to the flips of a single submatrix, so entries that are True may
+    still be impossible, but entries that are False always are.
+
+    matrix - input matrix for which we are creating a formula
+    allowed_losses - columns whose loss is allowed, all of them if None
+    """
+    ones = np.array(matrix, dtype=np.int64)
+    zeros = 1 - ones
+    n = ones.shape[1]
+
+    # counts[e][k][l] - number of rows whose entries on columns k and l are 00, 01, 10 or 11
+    counts = np.array([zeros.T @ zeros, zeros.T @ ones, ones.T @ zeros, ones.T @ ones])
+    loss_allowed = np.array([allowed_losses == None or col in allowed_losses for col in range(n)])
+
+    conflicts = np.zeros((n, n), dtype=bool)
+    for num_fp, num_fn, two_first, two_second, *num_rows in get_forbidden_requirements():
+        if num_fp > fp or num_fn > fn:
+            continue
+        possible = np.all(counts >= np.array(num_rows)[:, None, None], axis=0)
+        if two_first:
+            possible &= loss_allowed[:, None]
+        if two_second:
+            possible &= loss_allowed[None, :]
+        conflicts |= possible
+
+    # a column and itself are no pair of columns
+    np.fill_diagonal(conflicts, False)
+
+    return conflicts
+
+def add_forbidden_clauses(is_one, is_two, row_is_duplicate, col_is_duplicate, templates, CNF_obj, choose=combinations,
+                            shard=(0, 1), conflicts=None, max_block_size=1<<24, nonzero=None):
+    """
+    Adds the clauses of the compiled lookup table for every choice of 3 rows and 2 columns to
+    CNF_obj, a block of row triples at a time, and returns the number of clauses added.
+
+    Clauses are added in the same order as looping over the row triples, then the column pairs,
+    then the clauses of the lookup table.
+
+    templates - (index, sign) of the lookup table as returned by compile_lookup, or by compile_cubes
+    if nonzero is given
+    choose - permutations to visit every ordered choice of rows and columns, combinations to visit
+    every unordered one
+    shard - (k, num_shards) to only add the clauses of the k-th of num_shards consecutive ranges
+    of row triples, so the clauses of shards 0, ..., num_shards - 1 in order are all the clauses
+    conflicts - matrix returned by get_column_conflicts, pairs of columns where it is False get no
+    clauses
+    max_block_size - upper bound on the number of literals generated at once
+    nonzero - matrix of boolean variables that are 1 if corresponding entry in matrix is 1 or 2
+    """
+    index, sign = templates
+
+    m = len(is_one)
+    n = len(is_one[0])
+
+    row_triples = np.array(list(choose(range(m), 3)), dtype=np.int64).reshape(-1, 3)
+    row_triples = np.array_split(row_triples, shard[1])[shard[0]]
+    column_pairs = np.array(list(choose(range(n), 2)), dtype=np.int64).reshape(-1, 2)
+    if conflicts is not None:
+        column_pairs = column_pairs[conflicts[column_pairs[:, 0], column_pairs[:, 1]]]
+
+    labels = np.array([is_one, is_two] + ([nonzero] if nonzero is not None else []), dtype=np.int32)
+    row_is_duplicate = np.array(row_is_duplicate, dtype=np.int32)
+    col_is_duplicate = np.array(col_is_duplicate, dtype=np.int32)
+
+    num_pairs = len(column_pairs)
+    num_templates, width = index.shape
+    block_rows = max(1, max_block_size // max(1, num_pairs * num_templates * (width + 5)))
+
+    col_duplicates = col_is_duplicate[column_pairs]
+
+    for start in range(0, len(row_triples), block_rows):
+        rows = row_triples[start:start+block_rows]
+
+        # submatrix[t][c] lists the is_one labels of rows[t] and column_pairs[c], then the is_two labels
+        # and the nonzero labels
+        submatrix = labels[:, rows[:, None, :, None], column_pairs[None, :, None, :]]
+        submatrix = submatrix.transpose(1, 2, 0, 3, 4).reshape(len(rows), num_pairs, 6 * len(labels))
+
+        clauses = submatrix[:, :, index] * sign
+
+        row_duplicates = np.broadcast_to(row_is_duplicate[rows][:, None, None, :], (len(rows), num_pairs, num_templates, 3))
+        column_duplicates = np.broadcast_to(col_duplicates[None, :, None, :], (len(rows), num_pairs, num_templates, 2))
+
+        block = np.concatenate([clauses, row_duplicates, column_duplicates], axis=-1)
+        CNF_obj.add_clause_block(block.reshape(-1, width + 5))
+
+    return len(row_triples) * num_pairs * num_templates
+
+def get_clauses_no_forbidden(is_one, is_two, row_is_duplicate, col_is_duplicate, CNF_obj, shard=(0, 1), conflicts=None):
+    """
+    Adds clauses to CNF_obj that enforce that no forbidden submatrices can
+    be present in clustered matrix, and returns the number of clauses added.
 
     is_one - matrix of boolean variables that are 1 if corresponding entry in matrix being 1
     is_two - matrix of boolean variables that are 1 if corresponding entry in matrix being 2
+    shard, conflicts - see add_forbidden_clauses
+    """
+    return add_forbidden_clauses(is_one, is_two, row_is_duplicate, col_is_duplicate,
+                                    get_forbidden_tables()['lookup_templates'], CNF_obj, permutations, shard, conflicts)
+
+def get_clauses_no_forbidden_combinations(is_one, is_two, row_is_duplicate, col_is_duplicate, CNF_obj, shard=(0, 1), conflicts=None):
+    """
+    Adds clauses to CNF_obj that enforce that no forbidden submatrices
+    can be present in clustered matrix, and returns the number of clauses added.
+
+    Equivalent to get_clauses_no_forbidden, but only visits each set of 3 rows and 2 columns
+    once and checks it against the lookup table closed under row and column permutations,
+    so no clause is added twice.
+    """
+    return add_forbidden_clauses(is_one, is_two, row_is_duplicate, col_is_duplicate,
+                                    get_forbidden_tables()['symmetric_lookup_templates'], CNF_obj, combinations, shard, conflicts)
+
+def get_clauses_no_forbidden_nonzero(is_one, is_two, nonzero, row_is_duplicate, col_is_duplicate, CNF_obj, shard=(0, 1), conflicts=None):
+    """
+    Adds clauses to CNF_obj that enforce that no forbidden submatrices can be present in
+    clustered matrix, and returns the number of clauses added.
+
+    Equivalent to get_clauses_no_forbidden_combinations, but checks every set of 3 rows and 2
+    columns against the minimized lookup table, whose clauses each forbid several submatrices
+    by only requiring an entry to be nonzero, instead of 1 or 2.
+
+    nonzero - matrix of boolean variables that are 1 if corresponding entry in matrix is 1 or 2
+    """
+    return add_forbidden_clauses(is_one, is_two, row_is_duplicate, col_is_duplicate, get_nonzero_lookup_templates(),
+                                    CNF_obj, combinations, shard, conflicts, nonzero=nonzero)
+
+def get_nonzero_clauses(is_one, is_two, nonzero, CNF_obj):
+    """
+    Adds clauses to CNF_obj enforcing nonzero[i][j] <=> is_one[i][j] or is_two[i][j], and returns
+    the number of clauses added.
+    """
+    for one, two, entry_nonzero in zip(np.ravel(is_one).tolist(), np.ravel(is_two).tolist(), np.ravel(nonzero).tolist()):
+        CNF_obj.OR(one, two, entry_nonzero)
+
+    return 3 * np.size(is_one)
+
+def get_entry_literals(is_one, is_two, row, col, value):
+    """
+    Returns the literals that all hold if and only if B[row][col] == value.
+    """
+    if value == '1':
+        return [is_one[row][col]]
+    elif value == '2':
+        return [is_two[row][col]]
+    else:
+        return [-is_one[row][col], -is_two[row][col]]
+
+def get_pattern_witness_clauses(is_one, is_two, pattern_in_row, exists_pattern, col_is_duplicate, CNF_obj):
+    """
+    Adds clauses to CNF_obj that enforce that no forbidden submatrices can be present in
+    clustered matrix, using one variable per pair of columns and row pattern that is 1 if
+    that row pattern is present on the pair of columns in some row. Returns the number of
+    clauses added.
+
+    Duplicate rows do not need to be excluded: a duplicate row has the same pattern as the
+    row it duplicates, and the rows of a forbidden submatrix have distinct patterns.
+
+    is_one - matrix of boolean variables that are 1 if corresponding entry in matrix being 1
+    is_two - matrix of boolean variables that are 1 if corresponding entry in matrix being 2
+    pattern_in_row - pattern_in_row[i][pair_index(k, l, n)][p] is 1 if (B[i][k], B[i][l]) is forbidden_row_patterns[p]
+    exists_pattern - exists_pattern[pair_index(k, l, n)][p] is 1 if pattern_in_row[i][pair_index(k, l, n)][p] for some row i
     """
     m = len(is_one)
     n = len(is_one[0])
 
-    row_permutations = list(permutations(range(m), 3))
-    column_permutations = list(permutations([i for i in range(n)], 2))
+    is_one = np.asarray(is_one).tolist()
+    is_two = np.asarray(is_two).tolist()
+    pattern_in_row = np.asarray(pattern_in_row).tolist()
+    exists_pattern = np.asarray(exists_pattern).tolist()
+    col_is_duplicate = np.asarray(col_is_duplicate).tolist()
+
+    forbidden_pattern_sets = get_forbidden_tables()['forbidden_pattern_sets']
+    forbidden_row_patterns = get_forbidden_tables()['forbidden_row_patterns']
+
+    pattern_index = {pattern: p for p, pattern in enumerate(forbidden_row_patterns)}
 
     clause_count = 0
 
-    for rows in row_permutations:
-        for columns in column_permutations:
-            row1, row2, row3 = rows[0], rows[1], rows[2]
-            col1, col2 = columns[0], columns[1]
+    for col1 in range(n):
+        for col2 in range(col1 + 1, n):
+            pair = pair_index(col1, col2, n)
+            exists = exists_pattern[pair]
 
-            is_one_sub = [[is_one[row1][col1], is_one[row1][col2]],
-                            [is_one[row2][col1], is_one[row2][col2]],
-                            [is_one[row3][col1], is_one[row3][col2]]]
+            for p, pattern in enumerate(forbidden_row_patterns):
+                # exists_pattern[col1][col2][p] => pattern_in_row[0][col1][col2][p] or ... pattern_in_row[m-1][col1][col2][p]
+                clause_only_if = [-exists[p]]
 
-            is_two_sub = [[is_two[row1][col1], is_two[row1][col2]],
-                            [is_two[row2][col1], is_two[row2][col2]],
-                            [is_two[row3][col1], is_two[row3][col2]]]
+                for row in range(m):
+                    in_row = pattern_in_row[row][pair][p]
+                    entry_literals = (get_entry_literals(is_one, is_two, row, col1, pattern[0]) +
+                                        get_entry_literals(is_one, is_two, row, col2, pattern[1]))
 
-            for possible_submatrix in lookup.keys():
-                clause_raw = lookup[possible_submatrix]
-                clause = get_forbidden_clause(is_one_sub, is_two_sub, clause_raw)
+                    # pattern_in_row[row][col1][col2][p] <=> B[row][col1] == pattern[0] and B[row][col2] == pattern[1]
+                    for literal in entry_literals:
+                        CNF_obj.add_clause([-in_row, literal])
+                    CNF_obj.add_clause([-literal for literal in entry_literals] + [in_row])
 
-                row_duplicates = f'{row_is_duplicate[row1]} {row_is_duplicate[row2]} {row_is_duplicate[row3]}'
-                col_duplicates = f'{col_is_duplicate[col1]} {col_is_duplicate[col2]}'
+                    # pattern_in_row[row][col1][col2][p] => exists_pattern[col1][col2][p]
+                    CNF_obj.add_clause([-in_row, exists[p]])
+                    clause_count += len(entry_literals) + 2
 
-                total_clause = f'{clause} {row_duplicates} {col_duplicates} 0\n'
+                    clause_only_if.append(in_row)
 
-                write_file.write(total_clause)
+                CNF_obj.add_clause(clause_only_if)
+                clause_count += 1
+
+            # the row patterns of a forbidden submatrix cannot all be present on a pair of non-duplicate columns
+            col_duplicates = [col_is_duplicate[col1], col_is_duplicate[col2]]
+            for pattern_set in forbidden_pattern_sets:
+                clause = [-exists[pattern_index[pattern]] for pattern in pattern_set]
+                CNF_obj.add_clause(clause + col_duplicates)
                 clause_count += 1
 
     return clause_count
 
-def get_clauses_not_one_and_two(is_one, is_two, write_file):
+def get_ancestry_clauses(is_one, is_two, relation, col_is_duplicate, CNF_obj):
     """
-    Returns list of clauses enforcing that an entry of the clustered matrix cannot be 
-    both 1 and 2 at the same time.
+    Adds clauses to CNF_obj that enforce that every pair of non-duplicate columns is placed
+    in a 1-Dollo phylogeny in one of the ways listed in ancestry_relations, and that the
+    entries of every row on that pair of columns agree with it. Returns the number of
+    clauses added.
+
+    Instead of ancestor, descendant and incomparable variables with gain and loss consistency
+    per entry, every pair of columns gets one variable per maximal set of row patterns that
+    contains no forbidden submatrix, the 11 relations of get_ancestry_relations. These are false
+    for a pair with a duplicate column, but not fixed by the independent support when more than
+    one relation agrees with the entries, so solutions must be counted over the independent
+    support, not with get_num_solutions_sharpSAT.
 
     is_one - matrix of boolean variables that are 1 if corresponding entry in matrix being 1
     is_two - matrix of boolean variables that are 1 if corresponding entry in matrix being 2
+    relation - relation[pair_index(k, l, n)][r] is 1 if columns k and l are placed as in ancestry_relations[r]
     """
+    m = len(is_one)
+    n = len(is_one[0])
+
+    is_one = np.asarray(is_one).tolist()
+    is_two = np.asarray(is_two).tolist()
+    relation = np.asarray(relation).tolist()
+    col_is_duplicate = np.asarray(col_is_duplicate).tolist()
+
+    all_patterns = [f'{value1}{value2}' for value1 in '012' for value2 in '012']
+    # row patterns that contradict each relation
+    excluded_patterns = [[pattern for pattern in all_patterns if pattern not in allowed]
+                            for allowed in get_forbidden_tables()['ancestry_relations']]
+
     clause_count = 0
-    for i in range(len(is_one)):
-        for j in range(len(is_one[0])):
-            write_file.write(f'{-is_one[i][j]} {-is_two[i][j]} 0\n')
+
+    for col1 in range(n):
+        for col2 in range(col1 + 1, n):
+            relations = relation[pair_index(col1, col2, n)]
+
+            # columns are placed in exactly one way, unless one of them is a duplicate, and then in none
+            CNF_obj.add_clause([col_is_duplicate[col1], col_is_duplicate[col2]] + relations)
             clause_count += 1
-    
+            for r in range(len(relations)):
+                CNF_obj.add_clause([-col_is_duplicate[col1], -relations[r]])
+                CNF_obj.add_clause([-col_is_duplicate[col2], -relations[r]])
+                clause_count += 2
+            for r1 in range(len(relations)):
+                for r2 in range(r1 + 1, len(relations)):
+                    CNF_obj.add_clause([-relations[r1], -relations[r2]])
+                    clause_count += 1
+
+            for row in range(m):
+                for r, patterns in enumerate(excluded_patterns):
+                    # relation[col1][col2][r] => (B[row][col1], B[row][col2]) != pattern
+                    for pattern in patterns:
+                        entry_literals = (get_entry_literals(is_one, is_two, row, col1, pattern[0]) +
+                                            get_entry_literals(is_one, is_two, row, col2, pattern[1]))
+                        CNF_obj.add_clause([-relations[r]] + [-literal for literal in entry_literals])
+                        clause_count += 1
+
     return clause_count
 
-def get_row_duplicate_clauses(pair_in_col_equal, row_is_duplicate, row_is_duplicate_of, write_file):
+def get_clauses_not_one_and_two(is_one, is_two, CNF_obj):
+    """
+    Adds clauses to CNF_obj enforcing that an entry of the clustered matrix cannot be 
+    both 1 and 2 at the same time, and returns the number of clauses added.
+
+    is_one - matrix of boolean variables that are 1 if corresponding entry in matrix being 1
+    is_two - matrix of boolean variables that are 1 if corresponding entry in matrix being 2
+    """
+    labels = np.stack([np.asarray(is_one, dtype=np.int32), np.asarray(is_two, dtype=np.int32)], axis=-1)
+    CNF_obj.add_clause_block(-labels.reshape(-1, 2))
+
+    return labels.size // 2
+
+def get_row_duplicate_clauses(pair_in_col_equal, row_is_duplicate, row_is_duplicate_of, CNF_obj):
+    """
+    Adds clauses to CNF_obj enforcing that row_is_duplicate[row] is 1 if and only if row is equal
+    to an earlier row, and returns the number of clauses added.
+
+    pair_in_col_equal - pair_in_col_equal[pair_index(row1, row2, m)][col] is 1 if B[row1][col] == B[row2][col]
+    row_is_duplicate_of - row_is_duplicate_of[pair_index(row1, row2, m)] is 1 if row2 is a duplicate of row1
+    """
     clause_count = 0
 
     num_rows = len(row_is_duplicate)
-    num_columns = len(pair_in_col_equal[0][0])
+    num_columns = np.shape(pair_in_col_equal)[1]
+
+    pair_in_col_equal = np.asarray(pair_in_col_equal).tolist()
+    row_is_duplicate = np.asarray(row_is_duplicate).tolist()
+    row_is_duplicate_of = np.asarray(row_is_duplicate_of).tolist()
 
     for row in range(1, num_rows):
         # Clause that is satisfied if
         # row_is_duplicate[row] => row_is_duplicate_of[0][row] or row_is_duplicate_of[1][row] or ... row_is_duplicate_of[row-1][row]
         # is satisfied
-        clause_only_if = f'{-row_is_duplicate[row]} '
+        clause_only_if = [-row_is_duplicate[row]]
         for smaller_row in range(row):
             # Clause that is satisfied if
             # pair_in_col_equal[smaller][row][0] and pair_in_col_equal[smaller][row][1] and ... pair_in_col_equal[smaller][row][n]
             # => row_is_duplicate_of[smaller][row]
             # is satisfied
-            clause_if = ''
-            
+            clause_if = []
+            pair = pair_index(smaller_row, row, num_rows)
+
             for col in range(num_columns):
-                clause_if += f'{-pair_in_col_equal[smaller_row][row][col]} '
+                clause_if.append(-pair_in_col_equal[pair][col])
                 # Clause that enforces
                 # row_is_duplicate_of[smaller][row] => pair_in_col_equal[smaller][row][col]
                 # is satisfied
-                write_file.write(f'{-row_is_duplicate_of[smaller_row][row]} {pair_in_col_equal[smaller_row][row][col]} 0\n')
+                CNF_obj.add_clause([-row_is_duplicate_of[pair], pair_in_col_equal[pair][col]])
                 clause_count += 1
             
-            clause_if += f'{row_is_duplicate_of[smaller_row][row]} 0\n'
-            write_file.write(clause_if)
+            clause_if.append(row_is_duplicate_of[pair])
+            CNF_obj.add_clause(clause_if)
 
             # Clause that enforces
             # row_is_duplicate_of[smaller][row] => row_is_duplicate[row]
             # is satisfied
-            write_file.write(f'{-row_is_duplicate_of[smaller_row][row]} {row_is_duplicate[row]} 0\n')
+            CNF_obj.add_clause([-row_is_duplicate_of[pair], row_is_duplicate[row]])
             clause_count += 2
 
-            clause_only_if += f'{row_is_duplicate_of[smaller_row][row]} '
+            clause_only_if.append(row_is_duplicate_of[pair])
         
-        clause_only_if += '0\n'
-        write_file.write(clause_only_if)
+        CNF_obj.add_clause(clause_only_if)
         clause_count += 1
     
     # first row cannot be a duplicate
-    write_file.write(f'{-row_is_duplicate[0]} 0\n')
+    CNF_obj.add_clause([-row_is_duplicate[0]])
     clause_count += 1
 
     return clause_count
 
-def get_col_duplicate_clauses(pair_in_row_equal, col_is_duplicate, unsupported_losses, is_two, col_is_duplicate_of, write_file):
+def get_col_duplicate_clauses(pair_in_row_equal, col_is_duplicate, unsupported_losses, is_two, col_is_duplicate_of, CNF_obj):
+    """
+    Adds clauses to CNF_obj enforcing that col_is_duplicate[col] is 1 if and only if col is equal
+    to an earlier column, and that a column whose loss is unsupported has no 2 unless it is a
+    duplicate, and returns the number of clauses added.
+
+    pair_in_row_equal - pair_in_row_equal[row][pair_index(col1, col2, n)] is 1 if B[row][col1] == B[row][col2]
+    col_is_duplicate_of - col_is_duplicate_of[pair_index(col1, col2, n)] is 1 if col2 is a duplicate of col1
+    """
     clause_count = 0
 
     num_cols = len(col_is_duplicate)
     num_rows = len(pair_in_row_equal)
 
+    pair_in_row_equal = np.asarray(pair_in_row_equal).tolist()
+    col_is_duplicate = np.asarray(col_is_duplicate).tolist()
+    col_is_duplicate_of = np.asarray(col_is_duplicate_of).tolist()
+    is_two = np.asarray(is_two).tolist()
+
     for col in range(1, num_cols):
         # Clause that is satisfied if
         # col_is_duplicate[col] => col_is_duplicate_of[0][col] or col_is_duplicate_of[1][col] or ... col_is_duplicate_of[col-1][col]
         # is satisfied
-        clause_only_if = f'{-col_is_duplicate[col]} '
+        clause_only_if = [-col_is_duplicate[col]]
 
         for smaller_col in range(col):
             # Clause that is satisfied if
             # pair_in_row_equal[0][smaller_col][col] and pair_in_row_equal[1][smaller_col][col] and ... pair_in_row_equal[n][smaller_col][col]
-            # => col_is_duplicate_of[smaller_col][col]
+            # => col_is_duplicate_of[pair]
             # is satisfied
-            clause_if = ''
+            clause_if = []
+            pair = pair_index(smaller_col, col, num_cols)
 
             for row in range(num_rows):
-                clause_if += f'{-pair_in_row_equal[row][smaller_col][col]} '
+                clause_if.append(-pair_in_row_equal[row][pair])
                 # Clause that enforces
-                # col_is_duplicate_of[smaller_col][col] => pair_in_row_equal[row][smaller_col][col]
+                # col_is_duplicate_of[pair] => pair_in_row_equal[row][pair]
                 # is satisfied
-                write_file.write(f'{-col_is_duplicate_of[smaller_col][col]} {pair_in_row_equal[row][smaller_col][col]} 0\n')
+                CNF_obj.add_clause([-col_is_duplicate_of[pair], pair_in_row_equal[row][pair]])
                 clause_count += 1
             
             if col in unsupported_losses:
-                clause_forbid_is_two = f'{col_is_duplicate_of[smaller_col][col]} {-is_two[row][smaller_col]} 0\n'
-                write_file.write(clause_forbid_is_two)
+                clause_forbid_is_two = [col_is_duplicate_of[pair], -is_two[row][smaller_col]]
+                CNF_obj.add_clause(clause_forbid_is_two)
                 clause_count +=1
 
-            clause_if += f'{col_is_duplicate_of[smaller_col][col]} 0\n'
-            write_file.write(clause_if)
+            clause_if.append(col_is_duplicate_of[pair])
+            CNF_obj.add_clause(clause_if)
 
             # Clause that enforces
             # col_is_duplicate_of[smaller][col] => col_is_duplicate[col]
             # is satisfied
-            write_file.write(f'{-col_is_duplicate_of[smaller_col][col]} {col_is_duplicate[col]} 0\n')
+            CNF_obj.add_clause([-col_is_duplicate_of[pair], col_is_duplicate[col]])
             clause_count += 2
 
-            clause_only_if += f'{col_is_duplicate_of[smaller_col][col]} '
+            clause_only_if.append(col_is_duplicate_of[pair])
         
-        clause_only_if += '0\n'
-        write_file.write(clause_only_if)
+        CNF_obj.add_clause(clause_only_if)
         clause_count += 1
     
     # first col cannot be a duplicate
-    write_file.write(f'{-col_is_duplicate[0]} 0\n')
+    CNF_obj.add_clause([-col_is_duplicate[0]])
     clause_count += 1
 
     return clause_count
 
-def get_col_pairs_equal_clauses(is_one, is_two, pair_in_col_equal, write_file):
+def get_cluster_assignment_clauses(cluster, CNF_obj):
+    """
+    Adds clauses to CNF_obj enforcing that every row (or column) x is in exactly one cluster, that
+    no cluster is empty, and that clusters are numbered in the order of their first member, so
+    every way of grouping the rows into clusters has a single assignment. Returns the number of
+    clauses added.
+
+    cluster - cluster[x][k] is 1 if x is in cluster k
+    """
+    num_members, num_clusters = np.shape(cluster)
+    cluster = np.asarray(cluster).tolist()
+
     clause_count = 0
 
-    num_rows = len(is_one)
-    num_cols = len(is_one[0])
+    for x in range(num_members):
+        CNF_obj.add_clause(cluster[x])
+        for k1 in range(num_clusters):
+            for k2 in range(k1 + 1, num_clusters):
+                CNF_obj.add_clause([-cluster[x][k1], -cluster[x][k2]])
 
-    for col in range(num_cols):
-        for row1 in range(num_rows):
-            for row2 in range(row1 + 1, num_rows):
-                ## BOTH ENTRIES ARE 1
-                # B[row1][col] == 1 and B[row2][col] == 1 => pair_in_col_equal[row1][row2][col]
-                write_file.write(f'{-is_one[row1][col]} {-is_one[row2][col]} {pair_in_col_equal[row1][row2][col]} 0\n')
+        # x is only in cluster k if an earlier member is in cluster k - 1
+        for k in range(1, num_clusters):
+            CNF_obj.add_clause([-cluster[x][k]] + [cluster[y][k-1] for y in range(x)])
 
-                # pair_in_col_equal[row1][row2][col] and B[row1][col] == 1 => B[row2][col] == 1
-                write_file.write(f'{-pair_in_col_equal[row1][row2][col]} {-is_one[row1][col]} {is_one[row2][col]} 0\n')
+        clause_count += 1 + num_clusters * (num_clusters - 1) // 2 + num_clusters - 1
 
-                # pair_in_col_equal[row1][row2][col] and B[row2][col] == 1 => B[row1][col] == 1
-                write_file.write(f'{-pair_in_col_equal[row1][row2][col]} {-is_one[row2][col]} {is_one[row1][col]} 0\n')
+    # the last cluster has a member, so every cluster does
+    CNF_obj.add_clause([cluster[x][num_clusters-1] for x in range(num_members)])
 
-                ## BOTH ENTRIES ARE 2
-                # B[row1][col] == 2 and B[row2][col] == 2 => pair_in_col_equal[row1][row2][col]
-                write_file.write(f'{-is_two[row1][col]} {-is_two[row2][col]} {pair_in_col_equal[row1][row2][col]} 0\n')
+    return clause_count + 1
 
-                # pair_in_col_equal[row1][row2][col] and B[row1][col] == 2 => B[row2][col] == 2
-                write_file.write(f'{-pair_in_col_equal[row1][row2][col]} {-is_two[row1][col]} {is_two[row2][col]} 0\n')
+def get_cluster_link_clauses(cluster, source_one, source_two, target_one, target_two, CNF_obj):
+    """
+    Adds clauses to CNF_obj enforcing target[x][y] == source[k][y] for every x in cluster k, where
+    the entries of source and target are given by their is_one and is_two labels, and returns the
+    number of clauses added.
 
-                # pair_in_col_equal[row1][row2][col] and B[row1][col] == 2 => B[row2][col] == 2
-                write_file.write(f'{-pair_in_col_equal[row1][row2][col]} {-is_two[row2][col]} {is_two[row1][col]} 0\n')
+    cluster - cluster[x][k] is 1 if x is in cluster k
+    """
+    cluster = np.asarray(cluster, dtype=np.int32)
+    source = np.asarray([source_one, source_two], dtype=np.int32)
+    target = np.asarray([target_one, target_two], dtype=np.int32)
+
+    num_members, num_clusters = cluster.shape
+    num_entries = source.shape[2]
+    shape = (num_members, num_clusters, num_entries)
 
-                ## BOTH ENTRIES ARE 0
-                # B[row1][col] == 0 and B[row2][col] == 0 => pair_in_col_equal[row1][row2][col]
-                #
-                # equivalent to B[row1][col] != 1 and B[row2][col] != 1 
-                # and B[row1][col] != 2 and B[row2][col] != 2
-                write_file.write(f'{is_one[row1][col]} {is_one[row2][col]} {is_two[row1][col]} {is_two[row2][col]} {pair_in_col_equal[row1][row2][col]} 0\n')
+    in_cluster = np.broadcast_to(cluster[:, :, None], shape)
+    clauses = []
+    for label in range(2):
+        source_label = np.broadcast_to(source[label][None, :, :], shape)
+        target_label = np.broadcast_to(target[label][:, None, :], shape)
+        # x in cluster k => (target[x][y] <=> source[k][y])
+        clauses += [np.stack([-in_cluster, -source_label, target_label], axis=-1),
+                    np.stack([-in_cluster, source_label, -target_label], axis=-1)]
 
-                # pair_in_col_equal[row1][row2][col] and B[row1][col] != 1 and B[row1][col] != 2 => B[row2][col] != 1 and B[row2][col] != 2
-                # (expands into 2 clauses)
-                write_file.write(f'{-pair_in_col_equal[row1][row2][col]} {is_one[row1][col]} {is_two[row1][col]} {-is_one[row2][col]} 0\n')
-                write_file.write(f'{-pair_in_col_equal[row1][row2][col]} {is_one[row1][col]} {is_two[row1][col]} {-is_two[row2][col]} 0\n')
+    block = np.stack(clauses, axis=-2)
+    CNF_obj.add_clause_block(block.reshape(-1, 3))
 
-                # pair_in_col_equal[row1][row2][col] and B[row2][col] != 1 and B[row2][col] != 2 => B[row1][col] != 1 and B[row1][col] != 2
-                # (expands into 2 clauses)
-                write_file.write(f'{-pair_in_col_equal[row1][row2][col]} {is_one[row2][col]} {is_two[row2][col]} {-is_one[row1][col]} 0\n')
-                write_file.write(f'{-pair_in_col_equal[row1][row2][col]} {is_one[row2][col]} {is_two[row2][col]} {-is_two[row1][col]} 0\n')
+    return 4 * num_members * num_clusters * num_entries
+
+def get_distinct_clusters_clauses(cluster_one, cluster_two, differ, CNF_obj):
+    """
+    Adds clauses to CNF_obj enforcing that the rows of the clustered matrix, given by the is_one
+    and is_two labels of its entries, are pairwise different, and returns the number of clauses
+    added.
 
-                clause_count += 11
+    differ - differ[pair_index(a1, a2, s)][b] are 1 if cluster_one[a1][b] != cluster_one[a2][b],
+    then if cluster_two[a1][b] != cluster_two[a2][b]
+    """
+    num_rows, num_cols = np.shape(cluster_one)
+    labels = [np.asarray(cluster_one).tolist(), np.asarray(cluster_two).tolist()]
+    differ = np.asarray(differ).tolist()
+
+    clause_count = 0
+
+    for a1 in range(num_rows):
+        for a2 in range(a1 + 1, num_rows):
+            pair = pair_index(a1, a2, num_rows)
+            for b in range(num_cols):
+                for label in range(2):
+                    # written as clauses instead of CNF_obj.XOR, since with processes > 1 only the
+                    # clauses of a family are kept, not its XOR constraints
+                    r, x, y = differ[pair][b][label], labels[label][a1][b], labels[label][a2][b]
+                    CNF_obj.add_gate(r, [[-r, x, y], [-r, -x, -y], [r, x, -y], [r, -x, y]])
+                    clause_count += 4
+
+            CNF_obj.add_clause([r for b in range(num_cols) for r in differ[pair][b]])
+            clause_count += 1
 
     return clause_count
 
-def get_row_pairs_equal_clauses(is_one, is_two, pair_in_row_equal, write_file):
+def clause_last_row_no_two_before_unsupported_losses(unsupported_losses, is_two, CNF_obj):
+    """
+    Adds the clauses get_col_duplicate_clauses adds for columns whose loss is unsupported when
+    duplicate columns are not compared in pairs: the last row has no 2 in a column before a column
+    whose loss is unsupported. Returns the number of clauses added.
+    """
+    is_two = np.asarray(is_two).tolist()
     clause_count = 0
+    for forbidden_loss in unsupported_losses:
+        for col in range(forbidden_loss):
+            CNF_obj.add_clause([-is_two[-1][col]])
+            clause_count += 1
+
+    return clause_count
+
+"""
+Clauses enforcing pair_equal <=> B[x] == B[y] for a pair of entries x and y, as lists of
+(label, sign) over the labels [is_one[x], is_one[y], is_two[x], is_two[y], pair_equal]
+"""
+pairs_equal_clauses = [
+    # B[x] == 1 and B[y] == 1 => pair_equal
+    [(0, -1), (1, -1), (4, 1)],
+    # pair_equal and B[x] == 1 => B[y] == 1 (and vice versa)
+    [(4, -1), (0, -1), (1, 1)],
+    [(4, -1), (1, -1), (0, 1)],
+    # B[x] == 2 and B[y] == 2 => pair_equal
+    [(2, -1), (3, -1), (4, 1)],
+    # pair_equal and B[x] == 2 => B[y] == 2 (and vice versa)
+    [(4, -1), (2, -1), (3, 1)],
+    [(4, -1), (3, -1), (2, 1)],
+    # B[x] == 0 and B[y] == 0 => pair_equal
+    [(0, 1), (1, 1), (2, 1), (3, 1), (4, 1)],
+    # pair_equal and B[x] == 0 => B[y] != 1 and B[y] != 2
+    [(4, -1), (0, 1), (2, 1), (1, -1)],
+    [(4, -1), (0, 1), (2, 1), (3, -1)],
+    # pair_equal and B[y] == 0 => B[x] != 1 and B[x] != 2
+    [(4, -1), (1, 1), (3, 1), (0, -1)],
+    [(4, -1), (1, 1), (3, 1), (2, -1)]]
+
+pairs_equal_index = np.array([[label for label, sign in clause] + [0] * (5 - len(clause)) for clause in pairs_equal_clauses])
+pairs_equal_sign = np.array([[sign for label, sign in clause] + [0] * (5 - len(clause)) for clause in pairs_equal_clauses], dtype=np.int32)
+
+def add_pairs_equal_clauses(one_x, one_y, two_x, two_y, pair_equal, CNF_obj):
+    """
+    Adds the 11 clauses enforcing pair_equal[k] <=> B[x_k] == B[y_k] for every pair k of entries
+    to CNF_obj, and returns the number of clauses added.
+
+    one_x, one_y, two_x, two_y - arrays of is_one and is_two labels of the entries x_k and y_k
+    pair_equal - array of labels that are 1 if B[x_k] == B[y_k]
+    """
+    labels = np.stack([one_x, one_y, two_x, two_y, pair_equal], axis=-1)
+    block = labels[:, pairs_equal_index] * pairs_equal_sign
+    CNF_obj.add_clause_block(block.reshape(-1, pairs_equal_index.shape[1]))
+
+    return len(labels) * len(pairs_equal_index)
+
+def get_col_pairs_equal_clauses(is_one, is_two, pair_in_col_equal, CNF_obj):
+    """
+    Adds clauses to CNF_obj enforcing pair_in_col_equal[pair_index(row1, row2, m)][col] <=> B[row1][col] == B[row2][col],
+    and returns the number of clauses added.
+    """
+    num_rows = len(is_one)
+    num_cols = len(is_one[0])
 
+    is_one = np.array(is_one, dtype=np.int32)
+    is_two = np.array(is_two, dtype=np.int32)
+    pair_in_col_equal = np.array(pair_in_col_equal, dtype=np.int32)
+
+    # every col, and every row1 < row2 in that col
+    row1, row2 = np.triu_indices(num_rows, 1)
+    col = np.repeat(np.arange(num_cols), len(row1))
+    row1 = np.tile(row1, num_cols)
+    row2 = np.tile(row2, num_cols)
+
+    return add_pairs_equal_clauses(is_one[row1, col], is_one[row2, col], is_two[row1, col], is_two[row2, col],
+                                    pair_in_col_equal[pair_index(row1, row2, num_rows), col], CNF_obj)
+
+def get_row_pairs_equal_clauses(is_one, is_two, pair_in_row_equal, CNF_obj):
+    """
+    Adds clauses to CNF_obj enforcing pair_in_row_equal[row][pair_index(col1, col2, n)] <=> B[row][col1] == B[row][col2],
+    and returns the number of clauses added.
+    """
     num_rows = len(is_one)
     num_cols = len(is_one[0])
 
-    for row in range(num_rows):
-        for col1 in range(num_cols):
-            for col2 in range(col1 + 1, num_cols):
-                # BOTH ENTRIES ARE 1
-                # B[row][col1] == 1 and B[row][col2] == 1 => pair_in_row_equal[row][col1][col2]
-                write_file.write(f'{-is_one[row][col1]} {-is_one[row][col2]} {pair_in_row_equal[row][col1][col2]} 0\n')
-
-                # pair_in_row_equal[row][col1][col2] and B[row][col1] == 1 => B[row][col2] == 1
-                write_file.write(f'{-pair_in_row_equal[row][col1][col2]} {-is_one[row][col1]} {is_one[row][col2]} 0\n')
-
-                # pair_in_row_equal[row][col1][col2] and B[row][col2] == 1 => B[row][col1] == 1
-                write_file.write(f'{-pair_in_row_equal[row][col1][col2]} {-is_one[row][col2]} {is_one[row][col1]} 0\n')
-
-                # BOTH ENTRIES ARE 2
-                # B[row1][col] == 2 and B[row2][col] == 2 => pair_in_row_equal[row][col1][col2]
-                write_file.write(f'{-is_two[row][col1]} {-is_two[row][col2]} {pair_in_row_equal[row][col1][col2]} 0\n')
-
-                # pair_in_row_equal[row][col1][col2] and B[row][col1] == 2 => B[row][col2] == 2
-                write_file.write(f'{-pair_in_row_equal[row][col1][col2]} {-is_two[row][col1]} {is_two[row][col2]} 0\n')
-
-                # pair_in_row_equal[row][col1][col2] and B[row][col2] == 2 => B[row][col1] == 2
-                write_file.write(f'{-pair_in_row_equal[row][col1][col2]} {-is_two[row][col2]} {is_two[row][col1]} 0\n')
-
-                # BOTH ENTRIES ARE 0
-                # B[row][col1] == 0 and B[row][col2] == 0 => pair_in_row_equal[row][col1][col2]
-                #
-                # equivalent to B[row][col1] != 1 and B[row][col2] != 1 
-                # and B[row][col1] != 2 and B[row][col2] != 2
-                write_file.write(f'{is_one[row][col1]} {is_one[row][col2]} {is_two[row][col1]} {is_two[row][col2]} {pair_in_row_equal[row][col1][col2]} 0\n')
-
-                # pair_in_row_equal[row][col1][col2] and B[row][col1] != 1 and B[row][col1] != 2 => B[row][col2] != 1 and B[row][col2] != 2
-                # (expands into 2 clauses)
-                write_file.write(f'{-pair_in_row_equal[row][col1][col2]} {is_one[row][col1]} {is_two[row][col1]} {-is_one[row][col2]} 0\n')
-                write_file.write(f'{-pair_in_row_equal[row][col1][col2]} {is_one[row][col1]} {is_two[row][col1]} {-is_two[row][col2]} 0\n')
-
-                # pair_in_row_equal[row][col1][col2] and B[row][col2] != 1 and B[row][col2] != 2 => B[row][col1] != 1 and B[row][col1] != 2
-                # (expands into 2 clauses)
-                write_file.write(f'{-pair_in_row_equal[row][col1][col2]} {is_one[row][col2]} {is_two[row][col2]} {-is_one[row][col1]} 0\n')
-                write_file.write(f'{-pair_in_row_equal[row][col1][col2]} {is_one[row][col2]} {is_two[row][col2]} {-is_two[row][col1]} 0\n')
-                
-                clause_count += 11
-    
-    return clause_count
+    is_one = np.array(is_one, dtype=np.int32)
+    is_two = np.array(is_two, dtype=np.int32)
+    pair_in_row_equal = np.array(pair_in_row_equal, dtype=np.int32)
+
+    # every row, and every col1 < col2 in that row
+    col1, col2 = np.triu_indices(num_cols, 1)
+    row = np.repeat(np.arange(num_rows), len(col1))
+    col1 = np.tile(col1, num_rows)
+    col2 = np.tile(col2, num_rows)
+
+    return add_pairs_equal_clauses(is_one[row, col1], is_one[row, col2], is_two[row, col1], is_two[row, col2],
+                                    pair_in_row_equal[row, pair_index(col1, col2, num_cols)], CNF_obj)
 
 # credit to:
 # https://github.com/elkebir-group/UniPPM/blob/dd650648c7b04cfa083ff0af3c4f1e0f926854ba/PPM2SAT.py#L143
@@ -352,9 +932,205 @@ def to_bin_list(val,n_bits,CNF_obj):
         else: ans.append(CNF_obj.false())
     return ans
 
+def threshold_literals(counts, thresholds, CNF_obj):
+    """
+    Returns a literal for every threshold c that is true iff at least c of the summed variables
+    are true, where counts[j] is true iff at least j + 1 of them are.
+    """
+    return [CNF_obj.true() if c <= 0 else counts[c-1] if c <= len(counts) else CNF_obj.false()
+            for c in thresholds]
+
+def unary_merge(a, b, cap, CNF_obj):
+    """
+    Returns the unary sum, up to cap, of the unary numbers a and b, where a[i] is true iff
+    A >= i + 1. Every output is defined in both directions, so it is fixed by a and b.
+    """
+    a = [CNF_obj.true()] + a + [CNF_obj.false()]
+    b = [CNF_obj.true()] + b + [CNF_obj.false()]
+    len_a = len(a) - 2
+    len_b = len(b) - 2
+
+    out = []
+    for m in range(1, min(len_a + len_b, cap) + 1):
+        o = CNF_obj.new_var()
+        # A >= i and B >= m - i gives a sum of at least m
+        clauses = [[-a[i], -b[m-i], o] for i in range(max(0, m - len_b), min(m, len_a) + 1)]
+        # A <= i and B <= m - 1 - i gives a sum of at most m - 1
+        clauses += [[a[i+1], b[m-i], -o] for i in range(max(0, m - 1 - len_b), min(m - 1, len_a) + 1)]
+        CNF_obj.add_gate(o, clauses)
+        out.append(o)
+
+    return out
+
+def count_sequential(vars_to_sum, thresholds, CNF_obj):
+    """
+    Sequential counter: counts[j] of the first i variables is true iff at least j + 1 of them are,
+    which takes O(n k) variables and clauses for the largest threshold k.
+    """
+    cap = max(thresholds)
+    counts = []
+
+    for var in vars_to_sum:
+        if len(counts) == 0:
+            counts = [var]
+            continue
+
+        prev = [CNF_obj.true()] + counts + [CNF_obj.false()]
+        new_counts = []
+        for j in range(1, min(len(counts) + 1, cap) + 1):
+            s = CNF_obj.new_var()
+            # at least j so far iff at least j before or var and at least j - 1 before
+            CNF_obj.add_gate(s, [[-prev[j], s], [-var, -prev[j-1], s], [-s, prev[j], var], [-s, prev[j], prev[j-1]]])
+            new_counts.append(s)
+        counts = new_counts
+
+    return threshold_literals(counts, thresholds, CNF_obj)
+
+def count_totalizer(vars_to_sum, thresholds, CNF_obj):
+    """
+    Totalizer: a balanced tree of unary sums capped at the largest threshold k, which takes
+    O(n log n) variables and O(n k) clauses.
+    """
+    cap = max(thresholds)
+    to_sum = [[var] for var in vars_to_sum]
+
+    while len(to_sum) > 1:
+        result = []
+        for i in range(0, len(to_sum) - (len(to_sum) % 2), 2):
+            result.append(unary_merge(to_sum[i], to_sum[i+1], cap, CNF_obj))
+        if len(to_sum) % 2 != 0:
+            result.append(to_sum[-1])
+        to_sum = result
+
+    return threshold_literals(to_sum[0], thresholds, CNF_obj)
+
+def count_modulo_totalizer(vars_to_sum, thresholds, CNF_obj):
+    """
+    Modulo totalizer: every node of the totalizer tree keeps its sum as a unary quotient and a unary
+    remainder modulo p ~ sqrt(k), which takes O(n sqrt(k)) clauses for the largest threshold k.
+    """
+    p = max(2, math.ceil(math.sqrt(max(thresholds))))
+    quotient_cap = max(thresholds) // p + 1
+
+    # (quotient, remainder) of every subtree
+    to_sum = [([], [var]) for var in vars_to_sum]
+
+    while len(to_sum) > 1:
+        result = []
+        for i in range(0, len(to_sum) - (len(to_sum) % 2), 2):
+            (quotient_a, remainder_a), (quotient_b, remainder_b) = to_sum[i], to_sum[i+1]
+
+            remainder_sum = [CNF_obj.true()] + unary_merge(remainder_a, remainder_b, 2*p - 2, CNF_obj)
+            remainder_sum += [CNF_obj.false()] * (2*p - len(remainder_sum))
+            carry = remainder_sum[p]
+            remainder = [CNF_obj.OR(CNF_obj.AND(remainder_sum[j], -carry), remainder_sum[p+j]) for j in range(1, p)]
+
+            quotient_sum = [CNF_obj.true()] + unary_merge(quotient_a, quotient_b, quotient_cap, CNF_obj)
+            quotient_sum += [CNF_obj.false()] * (quotient_cap + 1 - len(quotient_sum))
+            quotient = [CNF_obj.OR(quotient_sum[j], CNF_obj.AND(quotient_sum[j-1], carry))
+                        for j in range(1, quotient_cap + 1)]
+
+            result.append(([q for q in quotient if not CNF_obj.is_false(q)], [r for r in remainder if not CNF_obj.is_false(r)]))
+        if len(to_sum) % 2 != 0:
+            result.append(to_sum[-1])
+        to_sum = result
+
+    quotient, remainder = to_sum[0]
+    quotient = [CNF_obj.true()] + quotient + [CNF_obj.false()] * (quotient_cap + 1 - len(quotient))
+    remainder = [CNF_obj.true()] + remainder + [CNF_obj.false()] * (p - len(remainder))
+
+    # at least c iff the quotient is above c // p, or equal to it and the remainder is at least c % p
+    return [CNF_obj.true() if c <= 0 else
+            CNF_obj.OR(quotient[c//p + 1], CNF_obj.AND(quotient[c//p], remainder[c % p])) if c // p < quotient_cap else
+            CNF_obj.false() for c in thresholds]
+
+def count_network(vars_to_sum, thresholds, CNF_obj):
+    """
+    Cardinality network: sorts the variables with odd-even merges of comparators, keeping only the
+    largest k outputs of every merge, which takes O(n log^2 k) variables and clauses.
+    """
+    cap = max(thresholds)
+
+    def merge(a, b):
+        # a and b are sorted with true first and have the same power of 2 length
+        if len(a) == 1:
+            return [CNF_obj.OR(a[0], b[0]), CNF_obj.AND(a[0], b[0])]
+        evens = merge(a[::2], b[::2])
+        odds = merge(a[1::2], b[1::2])
+        out = [evens[0]]
+        for i in range(len(a) - 1):
+            out += [CNF_obj.OR(evens[i+1], odds[i]), CNF_obj.AND(evens[i+1], odds[i])]
+        return out + [odds[-1]]
+
+    def sort(vars):
+        if len(vars) == 1:
+            return vars
+        size = 1 << (len(vars) - 1).bit_length()
+        half = size // 2
+        a = sort(vars[:half])[:cap]
+        b = sort(vars[half:])[:cap]
+        width = 1 << (max(len(a), len(b)) - 1).bit_length()
+        a += [CNF_obj.false()] * (width - len(a))
+        b += [CNF_obj.false()] * (width - len(b))
+        return merge(a, b)[:cap]
+
+    counts = [count for count in sort(list(vars_to_sum)) if not CNF_obj.is_false(count)]
+    return threshold_literals(counts, thresholds, CNF_obj)
+
+# encodings that give literals for "at least c of the variables are true"
+cardinality_encodings = {'sequential': count_sequential, 'totalizer': count_totalizer,
+                        'modulo_totalizer': count_modulo_totalizer, 'network': count_network}
+
+@lru_cache(maxsize=None)
+def totalizer_size(num_vars, cap):
+    """
+    Returns the number of clauses count_totalizer adds for num_vars variables and largest
+    threshold cap, without building the totalizer.
+    """
+    def merge_size(len_a, len_b):
+        # the clauses of unary_merge for every output, see there
+        return sum((min(m, len_a) - max(0, m - len_b) + 1) + (min(m - 1, len_a) - max(0, m - 1 - len_b) + 1)
+                    for m in range(1, min(len_a + len_b, cap) + 1))
+
+    sizes = [1] * num_vars
+    clauses = 0
+
+    while len(sizes) > 1:
+        clauses += sum(merge_size(len_a, len_b) for len_a, len_b in zip(sizes[0::2], sizes[1::2]))
+        result = [min(len_a + len_b, cap) for len_a, len_b in zip(sizes[0::2], sizes[1::2])]
+        if len(sizes) % 2 != 0:
+            result.append(sizes[-1])
+        sizes = result
+
+    return clauses
+
+def choose_cardinality_encoding(num_vars, constraint):
+    """
+    Returns the encoding expected to give the smallest formula for summing num_vars variables
+    and comparing the sum to constraint.
+
+    The totalizer takes O(num_vars constraint) clauses, counted exactly by totalizer_size, and the
+    adder about 24 num_vars whatever the constraint, so unary counting, which propagates better, is
+    used while it is not larger. From 30 to 1000 variables this is every constraint up to 7 or 8. The
+    sequential counter and the cardinality network never give fewer clauses than the totalizer,
+    and the modulo totalizer is at most 7% smaller than both around a constraint of 7.
+    """
+    if totalizer_size(num_vars, constraint + 1) <= 24 * num_vars:
+        return 'totalizer'
+    return 'adder'
+
 # credit to:
 # https://github.com/elkebir-group/UniPPM/blob/dd650648c7b04cfa083ff0af3c4f1e0f926854ba/PPM2SAT.py#L143
-def encode_at_most_k(vars_to_sum, constraint, CNF_obj, N):
+def encode_at_most_k(vars_to_sum, constraint, CNF_obj, N, encoding='adder'):
+    if constraint == 0:
+        encode_none(vars_to_sum, CNF_obj)
+        return
+
+    if encoding != 'adder':
+        [at_least] = cardinality_encodings[encoding](vars_to_sum, [constraint + 1], CNF_obj)
+        CNF_obj.set_true(-at_least)
+        return
+
     to_sum = [[var] for var in vars_to_sum]
 
     while len(to_sum) > 1:
@@ -373,7 +1149,17 @@ def encode_at_most_k(vars_to_sum, constraint, CNF_obj, N):
 
 # credit to:
 # https://github.com/elkebir-group/UniPPM/blob/dd650648c7b04cfa083ff0af3c4f1e0f926854ba/PPM2SAT.py#L143
-def encode_eq_k(vars_to_sum, constraint, CNF_obj, N):
+def encode_eq_k(vars_to_sum, constraint, CNF_obj, N, encoding='adder'):
+    if constraint == 0:
+        encode_none(vars_to_sum, CNF_obj)
+        return
+
+    if encoding != 'adder':
+        at_least, more = cardinality_encodings[encoding](vars_to_sum, [constraint, constraint + 1], CNF_obj)
+        CNF_obj.set_true(at_least)
+        CNF_obj.set_true(-more)
+        return
+
     to_sum = [[var] for var in vars_to_sum]
 
     while len(to_sum) > 1:
@@ -397,38 +1183,54 @@ def encode_none(vars, CNF_obj):
 
 def encode_constraints(false_pos, false_neg, row_duplicates, col_duplicates,
                         false_pos_constraint, false_neg_constraint,
-                        row_dup_constraint, col_dup_constraint, write_file, CNF_obj):
+                        row_dup_constraint, col_dup_constraint, CNF_obj, cardinality_encoding='adder'):
+    """
+    Adds the constraints on the number of false positives, false negatives and duplicate rows and
+    columns to CNF_obj and returns the number of clauses added.
+
+    row_duplicates, col_duplicates - None when the number of distinct rows and columns is already
+    fixed, as with the cluster assignment encoding
+
+    cardinality_encoding - 'adder' sums the variables with a binary adder tree, 'sequential',
+    'totalizer', 'modulo_totalizer' and 'network' count them in unary, 'auto' picks the encoding
+    expected to give the smallest formula for every constraint
+    """
+    def encoding(vars, constraint):
+        if cardinality_encoding == 'auto':
+            return choose_cardinality_encoding(len(vars), constraint)
+        if cardinality_encoding != 'adder' and cardinality_encoding not in cardinality_encodings:
+            raise ValueError(f'Unknown cardinality encoding: {cardinality_encoding}')
+        return cardinality_encoding
 
-    false_pos_vars = [var for row in false_pos for var in row if var != 0]
+    clauses_before = CNF_obj.num_clauses()
+
+    # entries without a variable are 0, those fixed to not be an error are the constant false
+    false_pos_vars = [var for row in false_pos for var in row if var not in (0, CNF_obj.false())]
     if (len(false_pos_vars) > 0):
         N=math.ceil(math.log(len(false_pos_vars), 2)) # bits required to encode sum of fp variables
-        encode_at_most_k(false_pos_vars, false_pos_constraint, CNF_obj, N)
+        encode_at_most_k(false_pos_vars, false_pos_constraint, CNF_obj, N, encoding(false_pos_vars, false_pos_constraint))
     
-    false_neg_vars = [var for row in false_neg for var in row if var != 0]
+    false_neg_vars = [var for row in false_neg for var in row if var not in (0, CNF_obj.false())]
     if (len(false_neg_vars) > 0):
         N=math.ceil(math.log(len(false_neg_vars), 2)) # bits required to encode sum of fp variables
-        encode_at_most_k(false_neg_vars, false_neg_constraint, CNF_obj, N)
+        encode_at_most_k(false_neg_vars, false_neg_constraint, CNF_obj, N, encoding(false_neg_vars, false_neg_constraint))
     
-    N=math.ceil(math.log(len(row_duplicates), 2))
-    encode_eq_k(row_duplicates, row_dup_constraint, CNF_obj, N)
-
-    N=math.ceil(math.log(len(col_duplicates), 2))
-    encode_eq_k(col_duplicates, col_dup_constraint, CNF_obj, N)
+    if row_duplicates != None:
+        N=math.ceil(math.log(len(row_duplicates), 2))
+        encode_eq_k(row_duplicates, row_dup_constraint, CNF_obj, N, encoding(row_duplicates, row_dup_constraint))
 
-    for cl in CNF_obj.clauses:
-        if cl[0]=="c":
-            continue
-        for lit in cl:
-            write_file.write("%d "%lit)
-        write_file.write("0\n")
+    if col_duplicates != None:
+        N=math.ceil(math.log(len(col_duplicates), 2))
+        encode_eq_k(col_duplicates, col_dup_constraint, CNF_obj, N, encoding(col_duplicates, col_dup_constraint))
         
-    return len(CNF_obj.clauses)
+    return CNF_obj.num_clauses() - clauses_before
 
-def clause_forbid_unsupported_losses(forbidden_losses, is_two, write_file):
+def clause_forbid_unsupported_losses(forbidden_losses, is_two, CNF_obj):
     clause_count = 0
+    is_two = np.asarray(is_two).tolist()
     for forbidden_loss in forbidden_losses:
         for row in range(len(is_two)):
-            write_file.write(f'{-is_two[row][forbidden_loss]} 0\n')
+            CNF_obj.add_clause([-is_two[row][forbidden_loss]])
             clause_count += 1
     
     return clause_count
\ No newline at end of file
@@ -1,109 +1,338 @@
+import json
+import numpy as np
+
 from CNF import CNF
 
-def create_variable_matrices(matrix, s, t, CNF_obj):
+def pair_index(k, l, n):
+    """
+    Returns the position of the pair (k, l), k < l, among the pairs of 0..n-1 listed as
+    (0, 1), (0, 2), ... (0, n-1), (1, 2), ... which is the order of combinations(range(n), 2).
+    Works on integers and on NumPy arrays of indices.
+    """
+    return k * (2 * n - k - 1) // 2 + l - k - 1
+
+class VariableLayout:
+    """
+    Variables of a formula allocated in consecutive blocks, each described by the label of its
+    first variable and its shape, so a block takes O(1) memory however many variables it holds.
+    The labels of a block are computed by index arithmetic when it is looked up, as a NumPy array
+    of its shape.
+
+    A block can hold a variable for only some entries of its shape, given by a boolean mask, with 0
+    in the other entries, or with the label of a constant (1 for true, -1 for false) given by fill.
+    Blocks over the pairs of rows or columns only hold the pairs k < l, listed in the order of
+    pair_index.
+    """
+
+    def __init__(self):
+        # name -> (label of first variable, shape, mask or None, fill or None)
+        self.blocks = {}
+
+    def add_block(self, name, shape, CNF_obj, ind=False, mask=None, fill=None):
+        """
+        Allocates the variables of a block in CNF_obj.
+
+        ind - add the variables to the independent support of CNF_obj
+        mask - boolean array of the given shape, only its true entries get a variable
+        fill - labels of the entries outside mask, an integer or an array of the given shape
+        """
+        shape = tuple(shape)
+        size = int(np.count_nonzero(mask)) if mask is not None else int(np.prod(shape))
+        self.blocks[name] = (CNF_obj.new_vars(size, ind), shape, None if mask is None else np.asarray(mask, dtype=bool),
+                            None if fill is None else np.asarray(fill, dtype=np.int8))
+
+    def __getitem__(self, name):
+        base, shape, mask, fill = self.blocks[name]
+        if mask is None:
+            return np.arange(base, base + int(np.prod(shape)), dtype=np.int32).reshape(shape)
+
+        labels = np.zeros(shape, dtype=np.int32)
+        if fill is not None:
+            labels[...] = fill
+        labels[mask] = np.arange(base, base + int(np.count_nonzero(mask)), dtype=np.int32)
+        return labels
+
+    def __contains__(self, name):
+        return name in self.blocks
+
+    def keys(self):
+        return self.blocks.keys()
+
+    def shape(self, name):
+        return self.blocks[name][1]
+
+    def __eq__(self, other):
+        return isinstance(other, VariableLayout) and self.to_dict() == other.to_dict()
+
+    def update(self, layout):
+        """
+        Adds the blocks of another layout over the same formula.
+        """
+        self.blocks.update(layout.blocks)
+
+    def to_dict(self):
+        """
+        Returns the blocks as a dictionary that can be written as JSON.
+        """
+        return {name: {'base': base, 'shape': list(shape), 'mask': None if mask is None else mask.astype(int).tolist(),
+                        'fill': None if fill is None else fill.tolist()}
+                for name, (base, shape, mask, fill) in self.blocks.items()}
+
+    @staticmethod
+    def from_dict(blocks):
+        """
+        Returns the layout of blocks as returned by to_dict.
+        """
+        layout = VariableLayout()
+        for name, block in blocks.items():
+            mask = None if block['mask'] == None else np.array(block['mask'], dtype=bool).reshape(block['shape'])
+            fill = None if block['fill'] == None else np.array(block['fill'], dtype=np.int8)
+            layout.blocks[name] = (block['base'], tuple(block['shape']), mask, fill)
+
+        return layout
+
+def get_possible_values(matrix, fn, fp, allowed_losses=None):
     """
-    Returns dictionary where keys are the names of the variable matrices,
-    and values are matrices containing labels for boolean variables in formula.
+    Returns the matrix whose entry [i][j] has bit v set if B[i][j] can be v as far as the input
+    tells: an entry that is 1 stays 1 without false positives, an entry that is 0 cannot become
+    1 without false negatives, and there is no 2 in a column whose loss is unsupported, nor in
+    the last row before such a column (see get_col_duplicate_clauses).
+
+    matrix - input matrix for which we are creating a formula
+    allowed_losses - columns whose loss is allowed, all of them if None
+    """
+    matrix = np.array(matrix)
+    unsupported_losses = [] if allowed_losses == None else [j for j in range(matrix.shape[1]) if j not in allowed_losses]
+
+    possible = np.full(matrix.shape, 0b111, dtype=np.int8)
+    if fp == 0:
+        possible[matrix == 1] = 0b010
+    if fn == 0:
+        possible[matrix == 0] = 0b101
+
+    if len(unsupported_losses) > 0:
+        no_two = np.zeros(matrix.shape, dtype=bool)
+        no_two[:, unsupported_losses] = True
+        no_two[-1, :max(unsupported_losses)] = True
+        possible[no_two] &= 0b011
+
+    return possible
+
+def fixed_pair_labels(possible_x, possible_y):
+    """
+    Returns the mask of the pairs of entries whose equality is not known from their possible
+    values, and the labels of the constants the others are equal to (1 if both are the same
+    value, -1 if they cannot be equal).
+    """
+    disjoint = (possible_x & possible_y) == 0
+    same = (possible_x == possible_y) & ((possible_x & (possible_x - 1)) == 0)
+
+    return ~(disjoint | same), np.where(same, 1, -1)
+
+def create_variable_matrices(matrix, s, t, CNF_obj, clustering='pairs', possible=None):
+    """
+    Returns the VariableLayout of the variable matrices used by every encoding, where the
+    keys are the names of the variable matrices.
+
+    pair_in_row_equal[i][pair_index(k, l, n)] is 1 if B[i][k] == B[i][l], and
+    pair_in_col_equal[pair_index(i, j, m)][k] is 1 if B[i][k] == B[j][k].
 
     matrix - input matrix for which we are creating a formula
     s - number of rows in clustered matrix
     t - number of columns in clustered matrix
+    clustering - 'pairs' for the variables comparing every pair of rows and columns, 'assignment'
+    for only the entries of B, see create_cluster_assignment_variables
+    possible - possible values of the entries of B returned by get_possible_values, the variables
+    they fix are not allocated and replaced by constants
     """
     m = len(matrix)
     n = len(matrix[0])
 
-    false_positives = [[0 for x in range(n)] for y in range(m)]
-    false_negatives = [[0 for x in range(n)] for y in range(m)]
-    
-    for i in range(m):
-        for j in range(n):
-            if matrix[i][j] == 1:
-                false_positives[i][j] = CNF_obj.new_var(True)
-    
-    for i in range(m):
-        for j in range(n):
-            if matrix[i][j] == 0:
-                false_negatives[i][j] = CNF_obj.new_var(True)
-    
-    is_two = [[CNF_obj.new_var(True) for j in range(n)] for i in range(m)]
-
-    pair_in_row_equal = [[[0 for l in range(n)] for k in range(n)] for i in range(m)]
-
-    for i in range(m):
-        for k in range(n):
-            for l in range(k+1,n):
-                pair_in_row_equal[i][k][l] = CNF_obj.new_var()
-
-    pair_in_col_equal = [[[0 for k in range(n)] for j in range(m)] for i in range(m)]
-
-    for i in range(m):
-        for j in range(i+1,m):
-            for k in range(n):
-                pair_in_col_equal[i][j][k] = CNF_obj.new_var()
-    
-    row_is_duplicate_of = [[0 for i in range(m)] for j in range(m)]
-    
-    for i in range(m):
-        for j in range(i+1, m):
-            row_is_duplicate_of[i][j] = CNF_obj.new_var()
-
-    col_is_duplicate_of = [[0 for i in range(n)] for j in range(n)]
-    
-    for i in range(n):
-        for j in range(i+1, n):
-            col_is_duplicate_of[i][j] = CNF_obj.new_var()
-
-    row_is_duplicate = [CNF_obj.new_var() for i in range(m)]
-
-    col_is_duplicate = [CNF_obj.new_var() for i in range(n)]
-
-    variables = {'false_positives': false_positives,
-                'false_negatives': false_negatives,
-                'is_two': is_two,
-                'pair_in_row_equal': pair_in_row_equal,
-                'pair_in_col_equal': pair_in_col_equal,
-                'row_is_duplicate_of': row_is_duplicate_of,
-                'col_is_duplicate_of': col_is_duplicate_of,
-                'row_is_duplicate': row_is_duplicate,
-                'col_is_duplicate': col_is_duplicate}
-        
+    row_pairs = m * (m - 1) // 2
+    col_pairs = n * (n - 1) // 2
+
+    matrix = np.array(matrix)
+
+    variables = VariableLayout()
+    if possible is None:
+        variables.add_block('false_positives', (m, n), CNF_obj, ind=True, mask=matrix == 1)
+        variables.add_block('false_negatives', (m, n), CNF_obj, ind=True, mask=matrix == 0)
+        variables.add_block('is_two', (m, n), CNF_obj, ind=True)
+    else:
+        # an entry that can only be 1 is no false positive, one that cannot be 1 no false negative
+        variables.add_block('false_positives', (m, n), CNF_obj, ind=True, mask=(matrix == 1) & (possible != 0b010), fill=-1)
+        variables.add_block('false_negatives', (m, n), CNF_obj, ind=True, mask=(matrix == 0) & ((possible & 0b010) != 0), fill=-1)
+        variables.add_block('is_two', (m, n), CNF_obj, ind=True, mask=(possible & 0b100) != 0, fill=-1)
+
+    if clustering == 'assignment':
+        return variables
+    elif clustering != 'pairs':
+        raise ValueError(f'Unknown clustering encoding: {clustering}')
+
+    if possible is None:
+        variables.add_block('pair_in_row_equal', (m, col_pairs), CNF_obj)
+        variables.add_block('pair_in_col_equal', (row_pairs, n), CNF_obj)
+        variables.add_block('row_is_duplicate_of', (row_pairs,), CNF_obj)
+        variables.add_block('col_is_duplicate_of', (col_pairs,), CNF_obj)
+    else:
+        row_k, row_l = np.triu_indices(m, 1)
+        col_k, col_l = np.triu_indices(n, 1)
+
+        row_equal_mask, row_equal_fill = fixed_pair_labels(possible[:, col_k], possible[:, col_l])
+        col_equal_mask, col_equal_fill = fixed_pair_labels(possible[row_k], possible[row_l])
+        variables.add_block('pair_in_row_equal', (m, col_pairs), CNF_obj, mask=row_equal_mask, fill=row_equal_fill)
+        variables.add_block('pair_in_col_equal', (row_pairs, n), CNF_obj, mask=col_equal_mask, fill=col_equal_fill)
+
+        # two rows are duplicates if all their entries are equal, they are not if one pair cannot be
+        row_differ = np.any(~col_equal_mask & (col_equal_fill == -1), axis=1)
+        col_differ = np.any(~row_equal_mask & (row_equal_fill == -1), axis=0)
+        variables.add_block('row_is_duplicate_of', (row_pairs,), CNF_obj, mask=~row_differ, fill=-1)
+        variables.add_block('col_is_duplicate_of', (col_pairs,), CNF_obj, mask=~col_differ, fill=-1)
+    variables.add_block('row_is_duplicate', (m,), CNF_obj)
+    variables.add_block('col_is_duplicate', (n,), CNF_obj)
+
     return variables
 
-def write_vars(var_filename, variables):
-    """
-    Writes variables to given file for debugging purposes.
-
-    var_filename - file to write variables to
-    variables - dictionary of variable matrices
-    """
-    lines = []
-    for key in variables.keys():
-        lines.append(f'{key}\n')
-        if key == 'pair_in_row_equal':
-            for i, row in enumerate(variables[key]):
-                lines.append(f'row {i}\n')
-                for j, col1 in enumerate(row):
-                    for k, col2 in enumerate(col1):
-                        if k > j:
-                            lines.append(f'B[{i}][{j}] == B[{i}][{k}] = var {col2}\n')
-        elif key == 'pair_in_col_equal':
-            for k in range(len(variables[key][0][0])):
-                lines.append(f'col {k}\n')
-                for i in range(len(variables[key][0])):
-                    for j in range(i+1,len(variables[key][0])):
-                        if j > i:
-                            lines.append(f'B[{i}][{k}] == B[{j}][{k}] = var {variables[key][i][j][k]}\n')
-        elif key == 'row_is_duplicate':
-            lines.append(' '.join([str(elem) for elem in variables[key]]))
-            lines.append('\n')
-        elif key == 'col_is_duplicate':
-            lines.append(' '.join([str(elem) for elem in variables[key]]))
-            lines.append('\n')
-        else:
-            for row in variables[key]:
-                lines.append(' '.join([str(elem) for elem in row]))
-                lines.append('\n')
-        
-        lines.append('=========================\n')
-    with open(var_filename, 'w') as f:
-        f.writelines(lines)
\ No newline at end of file
+def create_cluster_assignment_variables(matrix, s, t, forbidden_encoding, CNF_obj):
+    """
+    Returns the VariableLayout of the variable matrices used by the cluster assignment encoding,
+    which assigns every row of B to one of s row clusters and every column to one of t column
+    clusters, and describes the s x t clustered matrix C directly.
+
+    row_cluster[i][a] is 1 if row i is in row cluster a, col_cluster[j][b] is 1 if column j is
+    in column cluster b, cluster_is_one[a][b] and cluster_is_two[a][b] are 1 if C[a][b] is 1 or 2,
+    row_cluster_is_one[i][b] and row_cluster_is_two[i][b] are 1 if C[row cluster of i][b] is 1 or 2,
+    rows_differ[pair_index(a1, a2, s)][b] is 1 if C[a1][b] and C[a2][b] differ in being 1, then in
+    being 2, and cols_differ[pair_index(b1, b2, t)][a] likewise for C[a][b1] and C[a][b2].
+    cluster_nonzero[a][b] is 1 if C[a][b] is 1 or 2, for the nonzero forbidden encoding.
+
+    matrix - input matrix for which we are creating a formula
+    s - number of rows in clustered matrix
+    t - number of columns in clustered matrix
+    """
+    m = len(matrix)
+    n = len(matrix[0])
+
+    variables = VariableLayout()
+    variables.add_block('row_cluster', (m, s), CNF_obj)
+    variables.add_block('col_cluster', (n, t), CNF_obj)
+    variables.add_block('cluster_is_one', (s, t), CNF_obj)
+    variables.add_block('cluster_is_two', (s, t), CNF_obj)
+    variables.add_block('row_cluster_is_one', (m, t), CNF_obj)
+    variables.add_block('row_cluster_is_two', (m, t), CNF_obj)
+    variables.add_block('rows_differ', (s * (s - 1) // 2, t, 2), CNF_obj)
+    variables.add_block('cols_differ', (t * (t - 1) // 2, s, 2), CNF_obj)
+
+    if forbidden_encoding == 'nonzero':
+        variables.add_block('cluster_nonzero', (s, t), CNF_obj)
+
+    return variables
+
+def create_nonzero_variables(matrix, CNF_obj):
+    """
+    Returns the VariableLayout of the variable matrix used by the nonzero encoding of forbidden
+    submatrices, where nonzero[i][j] is 1 if B[i][j] is 1 or 2.
+
+    matrix - input matrix for which we are creating a formula
+    """
+    variables = VariableLayout()
+    variables.add_block('nonzero', (len(matrix), len(matrix[0])), CNF_obj)
+
+    return variables
+
+def create_pattern_witness_variables(matrix, num_patterns, CNF_obj):
+    """
+    Returns the VariableLayout of the variable matrices used by the pattern witness encoding of
+    forbidden submatrices.
+
+    pattern_in_row[i][pair_index(k, l, n)][p] is 1 if (B[i][k], B[i][l]) is row pattern p, and
+    exists_pattern[pair_index(k, l, n)][p] is 1 if row pattern p appears on columns k and l in some row.
+
+    matrix - input matrix for which we are creating a formula
+    num_patterns - number of row patterns that appear in forbidden submatrices
+    """
+    m = len(matrix)
+    n = len(matrix[0])
+
+    col_pairs = n * (n - 1) // 2
+
+    variables = VariableLayout()
+    variables.add_block('pattern_in_row', (m, col_pairs, num_patterns), CNF_obj)
+    variables.add_block('exists_pattern', (col_pairs, num_patterns), CNF_obj)
+
+    return variables
+
+def create_ancestry_variables(matrix, num_relations, CNF_obj):
+    """
+    Returns the VariableLayout of the variable matrices used by the ancestry encoding of 1-Dollo
+    phylogenies.
+
+    relation[pair_index(k, l, n)][r] is 1 if mutations k and l are placed in the phylogeny as
+    described by relation r.
+
+    matrix - input matrix for which we are creating a formula
+    num_relations - number of ways two mutations can be placed in a phylogeny
+    """
+    n = len(matrix[0])
+
+    variables = VariableLayout()
+    variables.add_block('relation', (n * (n - 1) // 2, num_relations), CNF_obj)
+
+    return variables
+
+def independent_support_labels(matrix, variables):
+    """
+    Returns the labels of the false negative or false positive variable of every entry, then of
+    is_two of every entry, as a NumPy array. Entries fixed to a constant have its label, 1 or -1.
+    """
+    errors = np.where(np.array(matrix) == 0, variables['false_negatives'], variables['false_positives'])
+
+    return np.concatenate([errors.ravel(), variables['is_two'].ravel()])
+
+def variable_map_filename(formula_filename):
+    """
+    Returns the name of the variable map written next to the formula in formula_filename.
+    """
+    return f'{formula_filename}.vmap'
+
+def write_variable_map(filename, variables, independent_support, matrix, parameters):
+    """
+    Writes what is needed to reconstruct solutions of a formula without the process that
+    generated it to filename, as a compressed NumPy archive: the offsets and shapes of the blocks
+    of variables, the masks and fills of the blocks that have them, the independent support, the input
+    matrix and the parameters of the formula. read_variable_map loads it.
+
+    variables - VariableLayout of the variable matrices
+    independent_support - labels of the independent support in the order samples list them
+    parameters - dictionary of the parameters the formula was generated with, written as JSON
+    """
+    header = {'blocks': {name: {'base': base, 'shape': list(shape), 'masked': mask is not None, 'filled': fill is not None}
+                        for name, (base, shape, mask, fill) in variables.blocks.items()},
+            'parameters': parameters}
+
+    arrays = {f'mask_{name}': mask for name, (base, shape, mask, fill) in variables.blocks.items() if mask is not None}
+    arrays.update({f'fill_{name}': fill for name, (base, shape, mask, fill) in variables.blocks.items() if fill is not None})
+
+    with open(filename, 'wb') as f:
+        np.savez_compressed(f, header=np.array(json.dumps(header)),
+                            independent_support=np.array(independent_support, dtype=np.int32),
+                            matrix=np.array(matrix, dtype=np.int8), **arrays)
+
+def read_variable_map(filename):
+    """
+    Returns the dictionary with keys 'variables' (VariableLayout), 'independent_support', 'matrix'
+    and 'parameters' of the variable map written by write_variable_map to filename.
+    """
+    with np.load(filename) as archive:
+        header = json.loads(str(archive['header']))
+
+        variables = VariableLayout()
+        for name, block in header['blocks'].items():
+            mask = archive[f'mask_{name}'] if block['masked'] else None
+            fill = archive[f'fill_{name}'] if block['filled'] else None
+            variables.blocks[name] = (block['base'], tuple(block['shape']), mask, fill)
+
+        return {'variables': variables,
+                'independent_support': archive['independent_support'].tolist(),
+                'matrix': archive['matrix'].tolist(),
+                'parameters': header['parameters']}
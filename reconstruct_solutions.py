@@ -1,6 +1,9 @@
 import copy
 import sys
+import argparse
+import numpy as np
 from utils import read_matrix, cluster_matrix
+from get_vars import read_variable_map, independent_support_labels
 
 def reconstruct_solutions(matrix_filename, solution_filename, write_file, variables, debug=True):
     """
@@ -8,20 +11,36 @@ def reconstruct_solutions(matrix_filename, solution_filename, write_file, variab
     Reconstructed matrices are separated by '======================'
     solution_filename - file containing satisfying variable assignments
     write_file - file to write reconstructed solutions to
-    variables - dictionary of variable matrices
+    variables - VariableLayout of the variable matrices
     debug - if set to True, will write information about false positives/negatives and clustering to
     write_file, if set to False, only matrices will be written
     """
+    write_reconstructed_solutions(read_matrix(matrix_filename), solution_filename, write_file, variables, debug)
 
-    matrix = read_matrix(matrix_filename)
+def reconstruct_solutions_from_variable_map(variable_map_filename, solution_filename, write_file, debug=True):
+    """
+    Writes the matrices reconstructed from samples in solution_filename to write_file like
+    reconstruct_solutions, taking the input matrix and the variables from the variable map
+    written next to the formula by get_cnf, so it does not need the process that generated it.
+    """
+    variable_map = read_variable_map(variable_map_filename)
 
-    m = len(variables['false_positives'])
-    n = len(variables['false_positives'][0])
+    write_reconstructed_solutions(variable_map['matrix'], solution_filename, write_file, variable_map['variables'], debug)
 
-    solutions = get_binary_vectors(solution_filename)
+def write_reconstructed_solutions(matrix, solution_filename, write_file, variables, debug):
+    """
+    Writes the matrices reconstructed from samples in solution_filename for the input matrix to
+    write_file, see reconstruct_solutions.
+    """
+    matrix = np.array(matrix)
+
+    m, n = variables.shape('is_two')
 
-    col_is_duplicate = variables['col_is_duplicate']
-    row_is_duplicate = variables['row_is_duplicate']
+    # entries fixed to a constant have no variable, so samples only hold the others
+    labels = independent_support_labels(matrix, variables)
+    sampled_entries = labels > 1
+
+    solutions = get_binary_vectors(solution_filename)
 
     f = open(write_file, 'w')
 
@@ -31,30 +50,16 @@ def reconstruct_solutions(matrix_filename, solution_filename, write_file, variab
         if len(solution) == 0:
             continue
         
-        num_false_positives = 0
-        num_false_negatives = 0
-        idx = 0
+        # sampled values of the independent support: whether every entry is a false negative (0 -> 1)
+        # or a false positive (1 -> 0), then is_two of every entry, see independent_support in generate_formula.py
+        values = labels == 1
+        values[sampled_entries] = np.array(solution[:np.count_nonzero(sampled_entries)]) == 1
+        errors, is_two = values.reshape(2, m, n)
 
-        solution_matrix = [[0 for j in range(n)] for i in range(m)]
+        num_false_negatives = int(np.count_nonzero(errors & (matrix == 0)))
+        num_false_positives = int(np.count_nonzero(errors & (matrix == 1)))
 
-        for i in range(m):
-            for j in range(n):
-                if matrix[i][j] == 0 and solution[idx] == 1:
-                    # is false negative, 0 -> 1
-                    solution_matrix[i][j] = 1
-                    num_false_negatives += 1
-                elif matrix[i][j] == 1 and solution[idx] == 0:
-                    # is a true positive, entry is 1
-                    solution_matrix[i][j] = 1
-                elif matrix[i][j] == 1 and solution[idx] == 1:
-                    num_false_positives += 1
-                idx += 1
-        
-        for i in range(m):
-            for j in range(n):
-                if solution[idx] == 1:
-                    solution_matrix[i][j] = 2
-                idx += 1
+        solution_matrix = np.where(is_two, 2, (matrix == 1) != errors).astype(int).tolist()
 
         row_is_duplicate, col_is_duplicate = cluster_matrix(solution_matrix)
         
@@ -107,43 +112,33 @@ def get_binary_vectors(valid_sample_filename):
     
     return out
 
-def write_vars_debug(var_filename, variables, solution):
-    """
-    Writes variables to given file for debugging purposes.
-    var_filename - file to write variables to
-    variables - dictionary of variable matrices
-    """
-    lines = []
-    for key in variables.keys():
-        lines.append(f'{key}\n')
-        if key == 'pair_in_row_equal':
-            for i, row in enumerate(variables[key]):
-                lines.append(f'row {i}\n')
-                for j, col1 in enumerate(row):
-                    for k, col2 in enumerate(col1):
-                        if k > j:
-                            lines.append(f'B[{i}][{j}] == B[{i}][{k}] = {solution[col2-1]}\n')
-        elif key == 'pair_in_col_equal':
-            for k in range(len(variables[key][0][0])):
-                lines.append(f'col {k}\n')
-                for i in range(len(variables[key][0])):
-                    for j in range(i+1,len(variables[key][0])):
-                        if j > i:
-                            lines.append(f'B[{i}][{k}] == B[{j}][{k}] = {solution[variables[key][i][j][k]-1]}\n')
-        elif key == 'row_is_duplicate' or key == 'col_is_duplicate':
-            lines.append(' '.join([str(solution[elem-1]) for elem in variables[key]]))
-            lines.append('\n')
-        else:
-            for row in variables[key]:
-                line = ''
-                for elem in row:
-                    if elem != 0:
-                        line += f'{solution[elem-1]} '
-                    else: 
-                        line += f'x '
-                lines.append(line)
-                lines.append('\n')
-        
-        lines.append('=========================\n')
-    with open(var_filename, 'w') as f:
-        f.writelines(lines)
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconstruct 1-dollo matrices from samples of a formula written by get_cnf')
+
+    parser.add_argument(
+        '--variable_map',
+        type=str,
+        required=True,
+        help='Variable map written next to the formula, FORMULA_FILENAME.vmap'
+    )
+    parser.add_argument(
+        '--samples',
+        type=str,
+        required=True,
+        help='File of samples written by the sampler'
+    )
+    parser.add_argument(
+        '--outfile',
+        type=str,
+        default='solutions.txt',
+        help='Outfile to write solutions to'
+    )
+    parser.add_argument(
+        '--debug',
+        action='store_true',
+        help='Also write the number of false positives and false negatives of every solution'
+    )
+
+    args = parser.parse_args()
+
+    reconstruct_solutions_from_variable_map(args.variable_map, args.samples, args.outfile, args.debug)
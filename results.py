@@ -40,7 +40,7 @@ def get_info(infile, directory, num_samples, timeout, approxMC, parse_losses):
     fp_rate = row_info['fp_rate']
     fn_rate = row_info['fn_rate']
 
-    cnf_filename = f'{FORMULAS_DIRECTORY}/{infile}.tmp.formula.cnf'
+    cnf_filename = f'{FORMULAS_DIRECTORY}/{infile}.tmp.formula.cnf.gz'
 
     num_ones, cell_clusters, mutation_clusters = get_matrix_info(infile, directory)
     num_zeroes = m * n - num_ones
@@ -58,6 +58,8 @@ def get_info(infile, directory, num_samples, timeout, approxMC, parse_losses):
         allowed_losses = None
         row_info['use_loss_info'] = False
 
+    # UniGen reads its input more than once, so sampling still goes through a formula file, which
+    # approxMC counts as well; formula_gen_time includes writing it, as in earlier results
     start = time.time()
     row_info['num_variables'], row_info['num_clauses'] = get_cnf(full_filename, cnf_filename, cell_clusters,
                                                                 mutation_clusters, allowed_losses, expected_fn, expected_fp, True)
@@ -1,15 +1,32 @@
 import unittest
 import os, sys
+import subprocess, tempfile, itertools, json, io, contextlib
+import numpy as np
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from generate_formula import get_cnf
-from get_vars import write_vars
-from utils import get_num_solutions_sharpSAT, read_matrix
+from generate_formula import get_cnf, get_formula, predict_size
+from CNF import CNF
+from formula_cache import evict_cached_formulas
+from get_clauses import (lookup, symmetric_lookup, minimize_lookup, generate_is_one, get_col_pairs_equal_clauses,
+                        get_row_pairs_equal_clauses, get_column_conflicts, count_totalizer, totalizer_size,
+                        choose_cardinality_encoding)
+from get_vars import (create_variable_matrices, pair_index, VariableLayout, variable_map_filename, read_variable_map,
+                    independent_support_labels)
+from utils import get_num_solutions_sharpSAT, get_num_solutions_appmc, read_matrix, counted_over_independent_support
 from generate_samples import unigensampler_generator
+from reconstruct_solutions import reconstruct_solutions, reconstruct_solutions_from_variable_map
 
 sharpSAT_path = '../../../scratch/software/src/sharpSAT/build/Release/sharpSAT'
-tmp_formula_path = 'tmp_formula.cnf'
+# every file written by the tests and the solvers they run, removed once the tests are done
+scratch_dir = tempfile.TemporaryDirectory()
+tmp_formula_path = os.path.join(scratch_dir.name, 'tmp_formula.cnf')
+# counts solutions over the independent support, exact for fewer than 72 solutions; ScalMC logs
+# next to its input unless told otherwise, which is /dev/stdin for formulas it reads from a pipe
+scalmc_path = f'samplers/scalmc --seed 1 --log {os.path.join(scratch_dir.name, "scalmc.log")}'
+
+def tearDownModule():
+    scratch_dir.cleanup()
 
 class CheckFormula(unittest.TestCase):
 
@@ -220,12 +237,603 @@ class CheckFormula(unittest.TestCase):
 
         self.assertEqual(num_sols, 2)
 
+class CheckForbiddenEncodings(unittest.TestCase):
+
+    # (input matrix, s, t, allowed losses, false negatives, false positives) for every input in tests/test_inputs
+    test_inputs = [('tests/test_inputs/simple_forbidden.txt', 3, 2, [], 0, 0),
+                    ('tests/test_inputs/simple_forbidden.txt', 3, 2, None, 0, 0),
+                    ('tests/test_inputs/simple_forbidden.txt', 3, 2, [], 1, 1),
+                    ('tests/test_inputs/no_clustering.txt', 4, 4, None, 1, 0),
+                    ('tests/test_inputs/test_harder.txt', 3, 3, None, 1, 0),
+                    ('tests/test_inputs/cluster_cells.txt', 3, 2, None, 0, 0),
+                    ('tests/test_inputs/cluster_mutations.txt', 3, 2, None, 0, 0),
+                    ('tests/test_inputs/test_harder_clustering.txt', 3, 3, None, 0, 0),
+                    ('tests/test_inputs/zero_3x2.txt', 3, 2, [], 2, 0),
+                    ('tests/test_inputs/ones_3x2.txt', 3, 2, None, 0, 2),
+                    ('tests/test_inputs/cluster_small.txt', 2, 2, None, 0, 2)]
+
+    def get_num_solutions(self, test_input, **encoding):
+        filename, s, t, allowed_losses, fn, fp = test_input
+        get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp, **encoding)
+        num_sols = get_num_solutions_sharpSAT(sharpSAT_path, tmp_formula_path)
+        os.system(f'rm {tmp_formula_path}')
+        return num_sols
+
+    # Checking combinations of rows and columns against the lookup table closed under
+    # permutations must give the same solutions as checking every permutation.
+    def test_combinations_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input, forbidden_encoding='permutations')
+            num_sols = self.get_num_solutions(test_input, forbidden_encoding='combinations')
+
+            self.assertEqual(num_sols, expected, test_input)
+
+    # Forbidding the row patterns of each forbidden submatrix from all being present on a pair
+    # of columns must give the same solutions as checking every permutation.
+    def test_witness_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input, forbidden_encoding='permutations')
+            num_sols = self.get_num_solutions(test_input, forbidden_encoding='witness')
+
+            self.assertEqual(num_sols, expected, test_input)
+
+    # Checking combinations of rows and columns against the lookup table minimized over nonzero
+    # entries must give the same solutions as checking every permutation.
+    def test_nonzero_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input, forbidden_encoding='permutations')
+            num_sols = self.get_num_solutions(test_input, forbidden_encoding='nonzero')
+
+            self.assertEqual(num_sols, expected, test_input)
+
+    # Assigning rows and columns to clusters, whose numbering is fixed by their first members,
+    # must give the same solutions as comparing every pair of rows and columns.
+    def test_cluster_assignment_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input, forbidden_encoding='permutations')
+
+            for forbidden_encoding in ['permutations', 'combinations', 'nonzero']:
+                num_sols = self.get_num_solutions(test_input, forbidden_encoding=forbidden_encoding, clustering='assignment')
+
+                self.assertEqual(num_sols, expected, (test_input, forbidden_encoding))
+
+    # Replacing the variables fixed by the input by constants must give the same solutions.
+    def test_prune_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input)
+
+            for encoding in [{}, {'forbidden_encoding': 'nonzero'}, {'clustering': 'assignment'}]:
+                num_sols = self.get_num_solutions(test_input, prune=True, **encoding)
+
+                self.assertEqual(num_sols, expected, (test_input, encoding))
+
+    # Skipping the pairs of columns that cannot hold a forbidden submatrix must give the same solutions.
+    def test_skip_conflict_free_pairs_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input)
+
+            for encoding in [{}, {'forbidden_encoding': 'combinations'}, {'forbidden_encoding': 'nonzero', 'prune': True}]:
+                num_sols = self.get_num_solutions(test_input, skip_conflict_free_pairs=True, **encoding)
+
+                self.assertEqual(num_sols, expected, (test_input, encoding))
+
+    # Placing every pair of mutations in the phylogeny must give the same solutions over the
+    # independent support as forbidding submatrices.
+    def test_ancestry_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input, forbidden_encoding='permutations')
+
+            filename, s, t, allowed_losses, fn, fp = test_input
+            get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp, engine='ancestry')
+            num_sols = get_num_solutions_appmc(scalmc_path, tmp_formula_path)
+            os.system(f'rm {tmp_formula_path}')
+
+            self.assertEqual(num_sols, expected, test_input)
+
+    # Formulas whose auxiliary variables are not fixed by the independent support are not counted
+    # over every variable, whether they are kept in memory or written with their variable map.
+    def test_projected_formulas_rejected(self):
+        filename, s, t, allowed_losses, fn, fp = self.test_inputs[-1]
+        for encoding, projected in [({}, False), ({'engine': 'ancestry'}, True), ({'polarity_aware': True}, True)]:
+            F, variables = get_formula(filename, s, t, allowed_losses, fn, fp, **encoding)
+            get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp, variable_map=True, **encoding)
+
+            self.assertEqual(counted_over_independent_support(F), projected, encoding)
+            self.assertEqual(counted_over_independent_support(tmp_formula_path), projected, encoding)
+            if projected:
+                with self.assertRaises(ValueError):
+                    get_num_solutions_sharpSAT(sharpSAT_path, F)
+                with self.assertRaises(ValueError):
+                    get_num_solutions_sharpSAT(sharpSAT_path, tmp_formula_path)
+            os.system(f'rm {tmp_formula_path} {variable_map_filename(tmp_formula_path)}')
+
+    # Counting false positives, false negatives and duplicates with any cardinality encoding must
+    # give the same solutions as the binary adder.
+    def test_cardinality_encodings_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input, cardinality_encoding='adder')
+
+            for cardinality_encoding in ['sequential', 'totalizer', 'modulo_totalizer', 'network']:
+                num_sols = self.get_num_solutions(test_input, cardinality_encoding=cardinality_encoding)
+
+                self.assertEqual(num_sols, expected, (test_input, cardinality_encoding))
+
+    # Encoding gates only in the directions they are used in must give the same solutions over
+    # the independent support.
+    def test_polarity_aware_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input, forbidden_encoding='permutations')
+
+            filename, s, t, allowed_losses, fn, fp = test_input
+            get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp, polarity_aware=True)
+            num_sols = get_num_solutions_appmc(scalmc_path, tmp_formula_path)
+            os.system(f'rm {tmp_formula_path}')
+
+            self.assertEqual(num_sols, expected, test_input)
+
+    # Writing the XOR gates of the adders as XOR constraints must give the same solutions.
+    def test_native_xor_same_solutions(self):
+        for test_input in self.test_inputs:
+            expected = self.get_num_solutions(test_input, cardinality_encoding='adder')
+
+            filename, s, t, allowed_losses, fn, fp = test_input
+            get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp, cardinality_encoding='adder', native_xor=True)
+            num_sols = get_num_solutions_appmc(scalmc_path, tmp_formula_path)
+            os.system(f'rm {tmp_formula_path}')
+
+            self.assertEqual(num_sols, expected, test_input)
+
+    # A formula kept in memory and written to the standard input of the solver must give the same
+    # solutions as the formula written by get_cnf.
+    def test_formula_streamed_same_solutions(self):
+        for test_input in self.test_inputs:
+            filename, s, t, allowed_losses, fn, fp = test_input
+            get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp)
+            expected = get_num_solutions_appmc(scalmc_path, tmp_formula_path)
+            os.system(f'rm {tmp_formula_path}')
+
+            F, variables = get_formula(filename, s, t, allowed_losses, fn, fp)
+            num_sols = get_num_solutions_appmc(scalmc_path, F)
+
+            self.assertEqual(num_sols, expected, test_input)
+
+    # A formula that fails while it is streamed to the solver must raise the error instead of
+    # counting the clauses written before it.
+    def test_formula_streamed_failing_writer(self):
+        class FailingCNF(CNF):
+            def cnf_blocks(self, show_additional_comments=False):
+                blocks = super().cnf_blocks(show_additional_comments)
+                yield next(blocks)
+                yield next(blocks)
+                raise RuntimeError('failed to format clauses')
+
+        filename, s, t, allowed_losses, fn, fp = self.test_inputs[0]
+        F, variables = get_formula(filename, s, t, allowed_losses, fn, fp)
+        F.__class__ = FailingCNF
+
+        with self.assertRaises(RuntimeError):
+            get_num_solutions_appmc(scalmc_path, F)
+
+    # A formula written compressed must give the same solutions, whether the solver reads it
+    # itself (.gz) or it is decompressed into the standard input of the solver (.xz).
+    def test_compressed_formula_same_solutions(self):
+        for test_input in self.test_inputs:
+            filename, s, t, allowed_losses, fn, fp = test_input
+            get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp)
+            expected = get_num_solutions_appmc(scalmc_path, tmp_formula_path)
+            os.system(f'rm {tmp_formula_path}')
+
+            for extension in ['.gz', '.xz']:
+                get_cnf(filename, tmp_formula_path + extension, s, t, allowed_losses, fn, fp)
+                num_sols = get_num_solutions_appmc(scalmc_path, tmp_formula_path + extension)
+                os.system(f'rm {tmp_formula_path}{extension}')
+
+                self.assertEqual(num_sols, expected, (test_input, extension))
+
+    # Generating the clauses in several processes must write the same formula as one process.
+    def test_parallel_same_formula(self):
+        for test_input in self.test_inputs:
+            filename, s, t, allowed_losses, fn, fp = test_input
+            for encoding in [{}, {'forbidden_encoding': 'combinations'}, {'forbidden_encoding': 'nonzero'}, {'engine': 'ancestry'},
+                            {'clustering': 'assignment'}, {'prune': True}, {'prune': True, 'skip_conflict_free_pairs': True}]:
+                get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp, **encoding)
+                with open(tmp_formula_path) as f:
+                    expected = f.read()
+
+                get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp, processes=3, **encoding)
+                with open(tmp_formula_path) as f:
+                    formula = f.read()
+                os.system(f'rm {tmp_formula_path}')
+
+                self.assertEqual(formula, expected, (test_input, encoding))
+
+    # The lookup table is found from any working directory.
+    def test_other_working_directory(self):
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        get_cnf('tests/test_inputs/test_harder.txt', tmp_formula_path, 3, 3)
+        with open(tmp_formula_path) as f:
+            expected = f.read()
+        os.system(f'rm {tmp_formula_path}')
+
+        code = ('import sys; sys.path.insert(0, sys.argv[1]); from generate_formula import get_cnf; '
+                'get_cnf(sys.argv[2], "formula.cnf", 3, 3)')
+        with tempfile.TemporaryDirectory() as other_dir:
+            subprocess.check_call([sys.executable, '-c', code, package_dir, os.path.abspath('tests/test_inputs/test_harder.txt')],
+                                    cwd=other_dir)
+            with open(os.path.join(other_dir, 'formula.cnf')) as f:
+                self.assertEqual(f.read(), expected)
+
+    # Every one of the 25 forbidden submatrices is still checked on rows and columns in order.
+    def test_symmetric_lookup_contains_lookup(self):
+        for possible_submatrix in lookup:
+            self.assertIn(possible_submatrix, symmetric_lookup)
+            self.assertEqual(symmetric_lookup[possible_submatrix], lookup[possible_submatrix])
+
+    # The cubes of the minimized lookup tables stand for exactly the forbidden submatrices.
+    def test_minimized_lookup(self):
+        for table in [lookup, symmetric_lookup]:
+            submatrices = set()
+            for cube in minimize_lookup(table):
+                submatrices.update(''.join(values) for values in itertools.product(*cube))
+
+            self.assertEqual(submatrices, set(table.keys()))
+
+    # A pair of columns gets no clauses exactly when no choice of 3 rows can be turned into a
+    # forbidden submatrix on it within the error budgets and the allowed losses.
+    def test_column_conflicts(self):
+        def flips(entry, value):
+            # false positives and false negatives turning an entry of the input into a value
+            return {('0', '0'): (0, 0), ('0', '1'): (0, 1), ('1', '0'): (1, 0), ('1', '1'): (0, 0), ('1', '2'): (1, 0),
+                    ('0', '2'): (0, 0)}[(entry, value)]
+
+        for filename, s, t, allowed_losses, fn, fp in self.test_inputs:
+            matrix = read_matrix(filename)
+            conflicts = get_column_conflicts(matrix, fn, fp, allowed_losses)
+            for k, l in itertools.permutations(range(len(matrix[0])), 2):
+                expected = False
+                for rows in itertools.combinations(range(len(matrix)), 3):
+                    for submatrix in symmetric_lookup:
+                        entries = [(str(matrix[row][col]), submatrix[2 * r + c]) for r, row in enumerate(rows) for c, col in enumerate((k, l))]
+                        if allowed_losses != None and any(value == '2' and (k, l)[x % 2] not in allowed_losses
+                                                            for x, (entry, value) in enumerate(entries)):
+                            continue
+                        costs = [flips(entry, value) for entry, value in entries]
+                        expected |= sum(cost[0] for cost in costs) <= fp and sum(cost[1] for cost in costs) <= fn
+
+                self.assertEqual(conflicts[k][l], expected, (filename, k, l))
+
+class CheckPredictSize(unittest.TestCase):
+
+    # The predicted numbers of variables and clauses are the ones get_cnf writes.
+    def test_predict_size(self):
+        for filename, s, t, allowed_losses, fn, fp in CheckForbiddenEncodings.test_inputs:
+            matrix = read_matrix(filename)
+            for encoding in [{}, {'forbidden_encoding': 'witness'}, {'forbidden_encoding': 'nonzero'}, {'engine': 'ancestry'},
+                            {'cardinality_encoding': 'adder', 'native_xor': True}, {'clustering': 'assignment'},
+                            {'clustering': 'assignment', 'forbidden_encoding': 'nonzero', 'polarity_aware': True}]:
+                num_vars, num_clauses = get_cnf(filename, tmp_formula_path, s, t, allowed_losses, fn, fp, True, **encoding)
+                os.system(f'rm {tmp_formula_path}')
+
+                size = predict_size(len(matrix), len(matrix[0]), sum(map(sum, matrix)), s, t, allowed_losses, fn, fp, **encoding)
+
+                self.assertEqual((size['variables'], size['clauses']), (num_vars, num_clauses), (filename, encoding))
+                self.assertEqual(sum(family['clauses'] for family in size['families'].values()), num_clauses)
+
+class CheckFormulaCache(unittest.TestCase):
+
+    cache_dir = os.path.join(scratch_dir.name, 'tmp_formula_cache')
+
+    def tearDown(self):
+        os.system(f'rm -r {self.cache_dir}')
+
+    def read_formula(self, filename, **kwargs):
+        result = get_cnf('tests/test_inputs/test_harder.txt', filename, 3, 3, None, 1, 0, **kwargs)
+        with open(filename, 'r') as f:
+            lines = f.readlines()
+        os.system(f'rm {filename}')
+        return result, lines
+
+    # A formula read from the cache, with forced clauses added after it, is the one get_cnf generates.
+    def test_cached_formula(self):
+        forced_clauses = ['2 0\n', '-3 4 0\n']
+        expected = self.read_formula(tmp_formula_path, forced_clauses=forced_clauses)
+
+        self.assertEqual(self.read_formula(tmp_formula_path, forced_clauses=forced_clauses, cache_dir=self.cache_dir), expected)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertEqual(self.read_formula(tmp_formula_path, forced_clauses=forced_clauses, cache_dir=self.cache_dir), expected)
+        self.assertEqual(self.read_formula(tmp_formula_path, return_num_vars_clauses=True, cache_dir=self.cache_dir)[0],
+                            self.read_formula(tmp_formula_path, return_num_vars_clauses=True)[0])
+
+    # The least recently used formulas are evicted once the cache is full.
+    def test_cache_eviction(self):
+        keys = []
+        for encoding in [{'forbidden_encoding': 'witness'}, {'engine': 'ancestry'}, {}]:
+            self.read_formula(tmp_formula_path, cache_dir=self.cache_dir, **encoding)
+            new_keys = set(os.path.splitext(filename)[0] for filename in os.listdir(self.cache_dir)) - set(keys)
+            keys += list(new_keys)
+        witness, ancestry, permutations = keys
+
+        for last_use, key in enumerate(keys):
+            os.utime(os.path.join(self.cache_dir, f'{key}.json'), (last_use, last_use))
+        # reading the witness formula again makes the ancestry formula the least recently used
+        self.read_formula(tmp_formula_path, cache_dir=self.cache_dir, forbidden_encoding='witness')
+
+        def entry_bytes(key):
+            return sum(os.path.getsize(os.path.join(self.cache_dir, f'{key}{extension}')) for extension in ('.cnf', '.json'))
+
+        evict_cached_formulas(self.cache_dir, entry_bytes(witness) + entry_bytes(permutations))
+
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                            sorted([f'{key}{extension}' for key in (witness, permutations) for extension in ('.cnf', '.json')]))
+
+class CheckCNF(unittest.TestCase):
+
+    # Clauses added one at a time or together are stored and written in order, without the
+    # constant false literal, and clauses with the constant true literal are dropped.
+    def test_clause_store(self):
+        F = CNF()
+        a = F.new_var(True)
+        b = F.new_var(True)
+        F.add_clause([a, -b])
+        F.add_clauses([[-a], [a, b, -1], [b, 1]])
+
+        self.assertEqual(F.num_clauses(), 4)
+        self.assertEqual(list(F.iter_clauses()), [[1], [a, -b], [-a], [a, b]])
+
+        F.to_cnf_file(tmp_formula_path)
+        with open(tmp_formula_path, 'r') as f:
+            lines = f.readlines()
+        os.system(f'rm {tmp_formula_path}')
+
+        self.assertEqual(lines, ['p cnf 3 4\n', 'c ind 2 3 0\n', '1 0\n', '2 -3 0\n', '-2 0\n', '2 3 0\n'])
+
+    # Blocks of clauses are stored like clauses added one at a time, skipping 0 entries.
+    def test_clause_block(self):
+        F = CNF()
+        F.add_clause_block([[2, -3, 4], [-2, 0, 5], [0, 3, 0]])
+        F.add_clause_block([[1, 2, 3], [-1, 4, -5], [-1, 0, -1]])
+
+        self.assertEqual(F.num_clauses(), 6)
+        self.assertEqual(list(F.iter_clauses()), [[1], [2, -3, 4], [-2, 5], [3], [4, -5], [-1]])
+
+    # Gates with constant or repeated inputs return an existing literal instead of a new variable.
+    def test_constant_folding(self):
+        F = CNF()
+        a = F.new_var()
+        b = F.new_var()
+
+        self.assertEqual(F.AND(a, F.false()), F.false())
+        self.assertEqual(F.AND(a, F.true()), a)
+        self.assertEqual(F.AND(a, -a), F.false())
+        self.assertEqual(F.OR(a, F.true()), F.true())
+        self.assertEqual(F.OR(a, a), a)
+        self.assertEqual(F.XOR(a, F.true()), -a)
+        self.assertEqual(F.XOR(a, -a), F.true())
+        self.assertEqual(F.half_adder(a, F.false()), (a, F.false()))
+        self.assertEqual(F.full_adder(a, F.false(), F.true()), (-a, a))
+        self.assertEqual(F.add([a, F.false()], [F.false(), F.false()]), [a, F.false()])
+
+        self.assertEqual(F.var, 3)
+        self.assertEqual(F.num_clauses(), 1)
+
+    # With structural hashing, a gate over the same inputs is built once and its output reused.
+    def test_structural_hashing(self):
+        F = CNF(structural_hashing=True)
+        a = F.new_var()
+        b = F.new_var()
+
+        r = F.AND(a, b)
+        self.assertEqual(F.AND(b, a), r)
+        self.assertEqual(F.OR(-a, -b), -r)
+        x = F.XOR(a, b)
+        self.assertEqual(F.XOR(-a, b), -x)
+        self.assertEqual(F.XOR(b, -a, r), r)
+
+        self.assertEqual(F.var, 5)
+        self.assertEqual(F.num_clauses(), 1 + 3 + 4 + 2)
+        self.assertEqual(F.stats, {'gates_reused': 4, 'clauses_saved': 3 + 3 + 4 + 2})
+
+    # get_cnf returns the counters of structural hashing in stats instead of printing them.
+    def test_structural_hashing_stats(self):
+        F, variables = get_formula('tests/test_inputs/test_harder.txt', 3, 3, None, 1, 1, structural_hashing=True)
+
+        stats = {}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            get_cnf('tests/test_inputs/test_harder.txt', tmp_formula_path, 3, 3, None, 1, 1, structural_hashing=True,
+                    stats=stats)
+        os.system(f'rm {tmp_formula_path}')
+
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual(stats, F.stats)
+
+    # In polarity aware mode the clauses of a gate are added once its output is used, and only
+    # in the direction it is used in.
+    def test_polarity_aware(self):
+        F = CNF(polarity_aware=True)
+        a = F.new_var()
+        b = F.new_var()
+        c = F.new_var()
+
+        r = F.AND(a, F.XOR(b, c))
+        self.assertEqual(F.num_clauses(), 1)
+
+        F.add_clause([r])
+        x = r - 1
+        self.assertCountEqual(list(F.iter_clauses()), [[1], [-r, x], [-x, b, c], [-x, -b, -c], [-r, a], [r]])
+
+        F.add_clause([-r, b])
+        self.assertCountEqual(list(F.iter_clauses())[6:], [[r, -a, -x], [x, b, -c], [x, -b, c], [-r, b]])
+
+    # totalizer_size counts the clauses of the totalizer without building it, and auto only picks the
+    # totalizer while it is not larger than the adder for the number of variables.
+    def test_totalizer_size(self):
+        for num_vars in [1, 2, 5, 17, 100]:
+            for cap in [1, 2, 3, 8, 50]:
+                F = CNF()
+                count_totalizer([F.new_var() for i in range(num_vars)], [cap], F)
+                self.assertEqual(totalizer_size(num_vars, cap), F.num_clauses() - 1, (num_vars, cap))
+
+        self.assertEqual(choose_cardinality_encoding(1000, 2), 'totalizer')
+        self.assertEqual(choose_cardinality_encoding(1000, 10), 'adder')
+        self.assertEqual(choose_cardinality_encoding(10, 7), 'totalizer')
+
+    # With native_xor, XOR gates are written as a single "x" line after the clauses.
+    def test_native_xor(self):
+        F = CNF(native_xor=True)
+        a = F.new_var()
+        b = F.new_var()
+        r = F.XOR(a, b)
+        F.add_clause([r, a])
+
+        F.to_cnf_file(tmp_formula_path)
+        with open(tmp_formula_path, 'r') as f:
+            lines = f.readlines()
+        os.system(f'rm {tmp_formula_path}')
+
+        self.assertEqual(lines, ['p cnf 4 3\n', '1 0\n', '4 2 0\n', 'x-4 2 3 0\n'])
+
+class CheckVariableLayout(unittest.TestCase):
+
+    # Every variable after the constant true belongs to exactly one block, in allocation order.
+    def test_blocks_cover_variables(self):
+        matrix = read_matrix('tests/test_inputs/no_clustering.txt')
+        F = CNF()
+        variables = create_variable_matrices(matrix, 4, 4, F)
+
+        labels = [label for key in variables.keys() for label in variables[key].ravel().tolist() if label != 0]
+
+        self.assertEqual(labels, list(range(2, F.var + 1)))
+
+    # Pairs are listed in the order of combinations, and the layout can be written as JSON.
+    def test_pair_index_and_to_dict(self):
+        for n in range(1, 6):
+            pairs = list(itertools.combinations(range(n), 2))
+            self.assertEqual([pair_index(k, l, n) for k, l in pairs], list(range(len(pairs))))
+
+        matrix = read_matrix('tests/test_inputs/test_harder.txt')
+        variables = create_variable_matrices(matrix, 3, 3, CNF())
+        loaded = VariableLayout.from_dict(json.loads(json.dumps(variables.to_dict())))
+
+        for key in variables.keys():
+            self.assertEqual(loaded[key].tolist(), variables[key].tolist(), key)
+
+class CheckVariableMap(unittest.TestCase):
+
+    # The variable map written next to the formula gives back its variables, independent support
+    # and input matrix, and the same reconstructed solutions as the variables returned by get_cnf.
+    def test_variable_map(self):
+        filename = 'tests/test_inputs/test_harder.txt'
+        variables = get_cnf(filename, tmp_formula_path, 3, 3, None, 1, 1, variable_map=True)
+        with open(tmp_formula_path) as f:
+            independent_support = [int(lit) for line in f if line.startswith('c ind') for lit in line.split()[2:-1]]
+
+        variable_map = read_variable_map(variable_map_filename(tmp_formula_path))
+
+        self.assertEqual(variable_map['variables'], variables)
+        self.assertEqual(variable_map['independent_support'], independent_support)
+        self.assertEqual(variable_map['matrix'], read_matrix(filename))
+        self.assertEqual(variable_map['parameters']['errors'], [1, 1])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            samples = os.path.join(tmp_dir, 'samples')
+            with open(samples, 'w') as f:
+                for k in range(8):
+                    f.write('v' + ' '.join(str(label if (label * k) % 3 else -label) for label in independent_support) + ' 0\n')
+
+            reconstruct_solutions(filename, samples, os.path.join(tmp_dir, 'expected'), variables)
+            reconstruct_solutions_from_variable_map(variable_map_filename(tmp_formula_path), samples,
+                                                    os.path.join(tmp_dir, 'solutions'))
+            with open(os.path.join(tmp_dir, 'expected')) as f, open(os.path.join(tmp_dir, 'solutions')) as g:
+                self.assertEqual(g.read(), f.read())
+
+        os.system(f'rm {tmp_formula_path} {variable_map_filename(tmp_formula_path)}')
+
+    # Samples of a pruned formula only hold the entries that are not fixed, and give the same
+    # solutions as the samples of the formula without pruning that agree with the fixed entries.
+    def test_pruned_variable_map(self):
+        filename = 'tests/test_inputs/test_harder.txt'
+        variables = get_cnf(filename, tmp_formula_path, 3, 3, [1], 1, 0)
+        pruned_variables = get_cnf(filename, tmp_formula_path, 3, 3, [1], 1, 0, prune=True, variable_map=True)
+
+        labels = independent_support_labels(read_matrix(filename), variables)
+        pruned_labels = independent_support_labels(read_matrix(filename), pruned_variables)
+        free = pruned_labels > 1
+        self.assertLess(np.count_nonzero(free), len(labels))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            samples, pruned_samples = os.path.join(tmp_dir, 'samples'), os.path.join(tmp_dir, 'pruned_samples')
+            with open(samples, 'w') as f, open(pruned_samples, 'w') as g:
+                for k in range(8):
+                    values = np.where(free, np.arange(len(labels)) * k % 3 != 0, pruned_labels == 1)
+                    f.write('v' + ' '.join(str(label if value else -label) for label, value in zip(labels, values)) + ' 0\n')
+                    g.write('v' + ' '.join(str(label if value else -label)
+                                            for label, value in zip(pruned_labels[free], values[free])) + ' 0\n')
+
+            reconstruct_solutions(filename, samples, os.path.join(tmp_dir, 'expected'), variables)
+            reconstruct_solutions_from_variable_map(variable_map_filename(tmp_formula_path), pruned_samples,
+                                                    os.path.join(tmp_dir, 'solutions'))
+            with open(os.path.join(tmp_dir, 'expected')) as f, open(os.path.join(tmp_dir, 'solutions')) as g:
+                self.assertEqual(g.read(), f.read())
+
+        os.system(f'rm {tmp_formula_path} {variable_map_filename(tmp_formula_path)}')
+
+class CheckPairsEqualClauses(unittest.TestCase):
+
+    # The 11 clauses enforcing pair_equal <=> B[x] == B[y], as written by the loop generator
+    def expected_clauses(self, one_x, one_y, two_x, two_y, pair_equal):
+        return [[-one_x, -one_y, pair_equal], [-pair_equal, -one_x, one_y], [-pair_equal, -one_y, one_x],
+                [-two_x, -two_y, pair_equal], [-pair_equal, -two_x, two_y], [-pair_equal, -two_y, two_x],
+                [one_x, one_y, two_x, two_y, pair_equal],
+                [-pair_equal, one_x, two_x, -one_y], [-pair_equal, one_x, two_x, -two_y],
+                [-pair_equal, one_y, two_y, -one_x], [-pair_equal, one_y, two_y, -two_x]]
+
+    def setUp(self):
+        self.matrix = read_matrix('tests/test_inputs/no_clustering.txt')
+        self.F = CNF()
+        self.variables = create_variable_matrices(self.matrix, 4, 4, self.F)
+        self.is_two = self.variables['is_two'].tolist()
+        self.is_one = generate_is_one(self.matrix, self.variables['false_positives'], self.variables['false_negatives'], self.is_two).tolist()
+
+    def test_col_pairs_equal(self):
+        pair_in_col_equal = self.variables['pair_in_col_equal']
+        num_rows = len(self.matrix)
+        expected = []
+        for col in range(len(self.matrix[0])):
+            for row1 in range(len(self.matrix)):
+                for row2 in range(row1 + 1, len(self.matrix)):
+                    expected += self.expected_clauses(self.is_one[row1][col], self.is_one[row2][col],
+                                                        self.is_two[row1][col], self.is_two[row2][col],
+                                                        pair_in_col_equal[pair_index(row1, row2, num_rows)][col])
+
+        clause_count = get_col_pairs_equal_clauses(self.is_one, self.is_two, pair_in_col_equal, self.F)
+
+        self.assertEqual(clause_count, len(expected))
+        self.assertCountEqual(list(self.F.iter_clauses())[1:], expected)
+
+    def test_row_pairs_equal(self):
+        pair_in_row_equal = self.variables['pair_in_row_equal']
+        num_cols = len(self.matrix[0])
+        expected = []
+        for row in range(len(self.matrix)):
+            for col1 in range(len(self.matrix[0])):
+                for col2 in range(col1 + 1, len(self.matrix[0])):
+                    expected += self.expected_clauses(self.is_one[row][col1], self.is_one[row][col2],
+                                                        self.is_two[row][col1], self.is_two[row][col2],
+                                                        pair_in_row_equal[row][pair_index(col1, col2, num_cols)])
+
+        clause_count = get_row_pairs_equal_clauses(self.is_one, self.is_two, pair_in_row_equal, self.F)
+
+        self.assertEqual(clause_count, len(expected))
+        self.assertCountEqual(list(self.F.iter_clauses())[1:], expected)
+
 class CheckIndependentSupport(unittest.TestCase):
     def test1(self):
         get_cnf('data/example.txt', tmp_formula_path, 4, 4, None, 2, 2)
-        unigensampler_generator(tmp_formula_path, 'tmp.unigen', 100, 120)
+        unigen_outfile = os.path.join(scratch_dir.name, 'tmp.unigen')
+        unigensampler_generator(tmp_formula_path, unigen_outfile, 100, 120)
 
-        with open('tmp.unigen', 'r') as fp:
+        with open(unigen_outfile, 'r') as fp:
             lines = fp.readlines()
         
         for idx, line in enumerate(lines):
@@ -236,8 +844,9 @@ class CheckIndependentSupport(unittest.TestCase):
             split_line = cleaned_line.split(' ')[:-1]
             split_line = [f'{lit} 0\n' for lit in split_line]
             
-            tmp_formula = f'tmp{idx}.cnf'
-            get_cnf('data/example.txt', tmp_formula, 4, 4, None, 2, 2, forced_clauses=split_line)
+            tmp_formula = os.path.join(scratch_dir.name, f'tmp{idx}.cnf')
+            get_cnf('data/example.txt', tmp_formula, 4, 4, None, 2, 2, forced_clauses=split_line,
+                    cache_dir=CheckFormulaCache.cache_dir)
             
             num_sols = get_num_solutions_sharpSAT(sharpSAT_path, tmp_formula)
 
@@ -246,7 +855,8 @@ class CheckIndependentSupport(unittest.TestCase):
             os.system(f'rm {tmp_formula}')
         
         os.system(f'rm {tmp_formula_path}')
-        os.system('rm tmp.unigen')
+        os.system(f'rm {unigen_outfile}')
+        os.system(f'rm -r {CheckFormulaCache.cache_dir}')
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
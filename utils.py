@@ -1,4 +1,11 @@
+import gzip
+import lzma
+import os
+import shutil
+import signal
 import subprocess
+import threading
+from queue import Queue
 
 def read_matrix(filename):
     """
@@ -117,14 +124,191 @@ def matrix_to_str(filename):
     rows = [''.join([str(elem) for elem in row]) for row in matrix]
     return ''.join(rows)
 
-def get_num_solutions_sharpSAT(sharpSAT_path, cnf_filename):
-    output = subprocess.check_output(f'{sharpSAT_path} {cnf_filename}', shell=True)
+def open_formula(filename, mode='r'):
+    """
+    Opens a cnf file as text, which is gzip, xz or zstd compressed if filename ends in .gz, .xz or
+    .zst and plain text otherwise.
+
+    mode - 'r' to read, 'w' to write
+    """
+    if filename.endswith('.gz'):
+        # the default level 9 is several times slower for little gain on cnf files
+        return gzip.open(filename, mode + 't', compresslevel=6)
+    elif filename.endswith('.xz'):
+        # the default preset compresses a few MB/s, too slow for formulas of several GB
+        return lzma.open(filename, mode + 't', preset=1 if mode == 'w' else None)
+    elif filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f'the zstandard package is needed to open {filename}')
+        return zstandard.open(filename, mode + 't')
+    else:
+        return open(filename, mode)
+
+def is_compressed(filename):
+    return filename.endswith(('.gz', '.xz', '.zst'))
+
+def write_blocks(fcnf, blocks, max_queued_blocks=4):
+    """
+    Writes an iterable of bytes to the text file fcnf. A separate thread writes every block while
+    the next ones are produced, and at most max_queued_blocks blocks wait to be written.
+    """
+    fcnf.flush()
+    # blocks skip the text layer where there is one
+    write = fcnf.buffer.write if hasattr(fcnf, 'buffer') else lambda block: fcnf.write(block.decode())
+
+    queue = Queue(max_queued_blocks)
+    errors = []
+
+    def write_queued():
+        while True:
+            block = queue.get()
+            if block == None:
+                return
+            if not errors:
+                try:
+                    write(block)
+                except BaseException as err:
+                    # keeps emptying the queue, so the producer is never blocked
+                    errors.append(err)
+
+    writer = threading.Thread(target=write_queued, daemon=True)
+    writer.start()
+
+    try:
+        for block in blocks:
+            if errors:
+                break
+            queue.put(block)
+    finally:
+        queue.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+def append_file(filename, fd):
+    """
+    Appends the contents of filename to the file open for writing as fd, copying inside the kernel
+    where the platform supports it.
+    """
+    with open(filename, 'rb') as from_file:
+        size = os.fstat(from_file.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                count = os.copy_file_range(from_file.fileno(), fd, size - copied)
+                if count == 0:
+                    break
+                copied += count
+        except (AttributeError, OSError):
+            # copy_file_range is Linux only, and older kernels cannot copy across file systems
+            pass
+
+        from_file.seek(copied)
+        while True:
+            data = memoryview(from_file.read(1 << 20))
+            if not data:
+                break
+            while data:
+                data = data[os.write(fd, data):]
+
+def run_solver(solver_path, formula, timeout=None, reads_gzip=False):
+    """
+    Runs the solver on formula and returns its output. Raises subprocess.CalledProcessError if it
+    exits with an error and subprocess.TimeoutExpired if it runs for longer than timeout seconds.
+
+    formula - name of a cnf file, which may be compressed, or a CNF object, which is written to the
+    standard input of the solver while it runs instead of to a file
+    reads_gzip - the solver reads gzip compressed files itself, other compressed files are
+    decompressed into its standard input
+    """
+    if isinstance(formula, str) and (not is_compressed(formula) or reads_gzip and formula.endswith('.gz')):
+        return subprocess.check_output(f'{solver_path} {formula}', shell=True, timeout=timeout)
+
+    read_fd, write_fd = os.pipe()
+    solver = subprocess.Popen(f'{solver_path} /dev/stdin', shell=True, stdin=read_fd, stdout=subprocess.PIPE,
+                                start_new_session=True)
+    os.close(read_fd)
+    errors = []
+
+    def write_formula():
+        try:
+            with open(write_fd, 'w') as fcnf:
+                try:
+                    if isinstance(formula, str):
+                        with open_formula(formula) as from_file:
+                            shutil.copyfileobj(from_file, fcnf)
+                    else:
+                        formula.write_cnf(fcnf)
+                except BrokenPipeError:
+                    raise
+                except BaseException as err:
+                    # kills the solver before its input is closed, so it never counts a truncated formula
+                    errors.append(err)
+                    try:
+                        os.killpg(solver.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+        except BrokenPipeError:
+            # the solver stopped reading, its exit code tells why
+            pass
+
+    writer = threading.Thread(target=write_formula, daemon=True)
+    writer.start()
+
+    try:
+        output, _ = solver.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # kills the solver as well as the shell running it
+        os.killpg(solver.pid, signal.SIGKILL)
+        solver.communicate()
+        raise
+    finally:
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+    if solver.returncode != 0:
+        raise subprocess.CalledProcessError(solver.returncode, solver.args, output)
+
+    return output
+
+def counted_over_independent_support(formula):
+    """
+    Returns True if the solutions of formula must be counted over its independent support, because
+    it was built with engine='ancestry' or polarity_aware=True.
+
+    formula - a CNF object, or the name of a cnf file, which is only known to need it if its
+    variable map is next to it
+    """
+    if not isinstance(formula, str):
+        return formula.projected
+
+    # get_vars imports this module through CNF
+    from get_vars import variable_map_filename, read_variable_map
+
+    filename = variable_map_filename(formula)
+    if not os.path.exists(filename):
+        return False
+    options = read_variable_map(filename)['parameters']['options']
+    return options['engine'] == 'ancestry' or options['polarity_aware']
+
+def get_num_solutions_sharpSAT(sharpSAT_path, formula):
+    # sharpSAT counts the solutions over every variable
+    if counted_over_independent_support(formula):
+        raise ValueError('The solutions of this formula must be counted over its independent support, '
+                            'e.g. with get_num_solutions_appmc')
+    output = run_solver(sharpSAT_path, formula)
     num_sols = output.splitlines()[-5]
     return int(num_sols)
 
-def get_num_solutions_appmc(approxMC_path, cnf_filename):
+def get_num_solutions_appmc(approxMC_path, formula):
     try:
-        output = subprocess.check_output(f'{approxMC_path} {cnf_filename}', shell=True, timeout=3600)
+        # approxMC reads gzip compressed files like CryptoMiniSat
+        output = run_solver(approxMC_path, formula, timeout=3600, reads_gzip=True)
     except subprocess.CalledProcessError as err:
         output = err.output.splitlines()
     except subprocess.TimeoutExpired as err: